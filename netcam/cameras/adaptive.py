@@ -0,0 +1,142 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for adapting one MJPEG stream to its viewer: the send time of each frame
+# (blocking socket write) is measured and jpeg quality, width and frame rate are lowered
+# when the viewer cannot keep up, and raised again when it can.
+
+import os
+import socket
+import time
+
+MAX_FPS = 25          # [default] upper limit of the frame rate
+QUALITIES = (80, 70, 60, 50, 40) # [default] jpeg quality ladder, first = best
+SCALES = (1.0, 0.75, 0.5)        # [default] width ladder, after the lowest quality
+FPS_DIVIDERS = (1, 2, 4)         # [default] frame rate ladder, after the smallest width
+DOWN_RATIO = 0.8      # [default] degrade when sending takes more than 80% of the frame interval
+UP_RATIO = 0.3        # [default] improve when sending takes less than 30% of the frame interval
+UP_AFTER = 50         # [default] good frames in a row before improving
+SETTLE = 5            # [default] frames at a new level before degrading again
+SMOOTHING = 0.2       # [default] weight of the newest send time (exponential average)
+SEND_BUFFER = 32768   # [default] bytes, socket send buffer per viewer (kernel doubles it)
+
+
+class RateController:
+    """ per viewer frame pacing, quality and size adaptation """
+
+    def __init__(self, fps=None, width=None, quality=None):
+        """
+        initialize the controller with the viewer's targets (None: defaults)
+            fps: target frames per second
+            width: target width in pixels (None: source width)
+            quality: best jpeg quality
+        """
+        self.fps = min(fps, MAX_FPS) if fps else MAX_FPS
+        self.width = width
+        best = quality if quality else QUALITIES[0]
+        qualities = [best] + [q for q in QUALITIES if q < best]
+        # degradation levels: (quality, width scale, fps divider), level 0 is the best
+        self.levels = [(q, SCALES[0], FPS_DIVIDERS[0]) for q in qualities]
+        self.levels += [(qualities[-1], s, FPS_DIVIDERS[0]) for s in SCALES[1:]]
+        self.levels += [(qualities[-1], SCALES[-1], d) for d in FPS_DIVIDERS[1:]]
+        self.level = 0
+        self._send_avg = 0.0 # secs per frame
+        self._good = 0 # good frames in a row
+        self._settle = 0 # frames to wait before the next degradation
+        self._due = 0.0 # time the next frame is due
+        self.frames = 0
+        self.bytes = 0
+
+    def get_interval(self):
+        """ get the current frame interval in seconds """
+        return self.levels[self.level][2] / self.fps
+
+    def get_params(self, source_width=None):
+        """ get the current (width, quality) for encoding, width None: unscaled """
+        quality, scale, divider = self.levels[self.level]
+        width = self.width if self.width else source_width
+        if width is None:
+            return None, quality
+        width = int(width * scale)
+        return (None if width == source_width else width), quality
+
+    def set_source_fps(self, fps):
+        """ limit the target frame rate to the frame rate of the source (e.g. a video file) """
+        if fps and fps > 0:
+            self.fps = min(self.fps, fps)
+        pass
+
+    def get_skip(self, fps):
+        """ get the number of source frames to skip per sent frame, for a source with 'fps' """
+        return max(int(round(fps * self.get_interval())) - 1, 0)
+
+    def get_delay(self):
+        """ get the seconds to wait until the next frame is due, and schedule the frame after it """
+        now = time.time()
+        delay = max(self._due - now, 0.0)
+        self._due = max(self._due + self.get_interval(), now + delay) # no catch up bursts
+        return delay
+
+    def pace(self):
+        """ wait until the next frame is due (frame pacing) """
+        delay = self.get_delay()
+        if delay > 0:
+            time.sleep(delay)
+        pass
+
+    def sent(self, nbytes, secs):
+        """ register one sent frame: its size and the time the socket write took """
+        self.frames += 1
+        self.bytes += nbytes
+        self._send_avg = secs if self.frames == 1 else (1 - SMOOTHING) * self._send_avg + SMOOTHING * secs
+        interval = self.get_interval()
+        if self._settle > 0:
+            self._settle -= 1 # measure the new level first
+        elif self._send_avg > DOWN_RATIO * interval and self.level < len(self.levels) - 1:
+            self.level += 1 # viewer too slow: degrade
+            self._good = 0
+            self._settle = SETTLE
+        elif self._send_avg < UP_RATIO * interval and self.level > 0:
+            self._good += 1
+            if self._good >= UP_AFTER:
+                self.level -= 1 # viewer fast enough: improve
+                self._good = 0
+        else:
+            self._good = 0
+        pass
+
+    def get_throughput(self):
+        """ get the average send throughput in bytes per second """
+        if self._send_avg <= 0.0 or self.frames == 0:
+            return 0.0
+        return self.bytes / self.frames / self._send_avg
+
+
+def get_controller(fps=None, width=None, quality=None):
+    """ get a rate controller for the viewer's targets (request arguments), limited to sensible values """
+    if fps is not None and fps <= 0:
+        fps = None
+    if width is not None:
+        width = min(max(width, 64), 3840)
+    if quality is not None:
+        quality = min(max(quality, 10), 95)
+    return RateController(fps, width, quality)
+
+def limit_send_buffer(sock):
+    """
+    limit the send buffer of a viewer's socket (None: not available, e.g. other wsgi server),
+    otherwise a large (auto tuned) buffer absorbs seconds of video and the socket write never blocks
+    """
+    if sock is None:
+        return False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
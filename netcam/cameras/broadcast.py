@@ -0,0 +1,284 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the live view of the Flask application: one broadcaster per camera
+# decodes the (sub)stream once, encodes each frame once and fans it out to all viewers.
+
+import cv2
+import os
+import threading
+import time
+from cameras import camera
+
+IDLE_TIMEOUT = 30  # [default] seconds, stop decoding after the last viewer has left
+RETRY_DELAY = 5    # [default] seconds, before reconnecting a lost stream
+MAX_EMPTY = 30     # [default] empty reads before reconnecting
+JPEG_QUALITY = 80  # [default] quality of the shared encoding
+
+
+class Picture:
+    """ one decoded frame and its jpeg encoding, shared (read-only) by all viewers """
+
+    def __init__(self, seq, frame, jpeg):
+        """ initialize the picture """
+        self.seq = seq # sequence number per broadcaster
+        self.timestamp = time.time() # capture time (approx.)
+        self.frame = frame # decoded frame (numpy array), do not modify
+        self.jpeg = jpeg # encoded frame (bytes), shared encoding
+        self._lock = threading.Lock()
+        self._variants = {(None, JPEG_QUALITY): jpeg} # (width, quality): encoded frame
+
+    def get_width(self):
+        """ get the width of the decoded frame """
+        return self.frame.shape[1]
+
+    def has_jpeg(self, width=None, quality=JPEG_QUALITY):
+        """ is the variant (width, quality) already encoded? """
+        with self._lock:
+            return (width, quality) in self._variants
+
+    def get_jpeg(self, width=None, quality=JPEG_QUALITY):
+        """ get the frame encoded with width (None: unscaled) and quality, each variant is encoded once """
+        key = (width, quality)
+        with self._lock:
+            jpeg = self._variants.get(key)
+            if jpeg is None:
+                jpeg = encode(self.frame, width, quality)
+                self._variants[key] = jpeg
+            return jpeg
+
+
+def encode(frame, width=None, quality=JPEG_QUALITY):
+    """ encode a frame as jpeg, resized to width (keeping the aspect ratio) """
+    if width is not None and width != frame.shape[1]:
+        height = max(int(frame.shape[0] * width / frame.shape[1]), 1)
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    retval, buffer = cv2.imencode('.jpg', frame, (cv2.IMWRITE_JPEG_QUALITY, int(quality)))
+    return buffer.tobytes()
+
+
+def get_frame_part(jpeg, timestamp, quality):
+    """ build one part of the multipart stream, with capture time and quality for measurements """
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n'
+            b'Content-Length: ' + str(len(jpeg)).encode('ascii') + b'\r\n'
+            b'X-Timestamp: ' + ('%.3f' % timestamp).encode('ascii') + b'\r\n'
+            b'X-Quality: ' + str(quality).encode('ascii') + b'\r\n\r\n' + jpeg + b'\r\n')
+
+
+class Subscription:
+    """ one viewer: holds only the newest picture, stale pictures are dropped """
+
+    def __init__(self, broadcaster):
+        """ initialize the subscription """
+        self.broadcaster = broadcaster
+        self._cond = threading.Condition()
+        self._picture = None # newest picture, not yet consumed
+        self.dropped = 0 # pictures replaced before the viewer consumed them
+        self.closed = False
+
+    def put(self, picture):
+        """ offer a new picture (broadcaster thread), never blocks """
+        with self._cond:
+            if self._picture is not None:
+                self.dropped += 1 # slow viewer, drop the stale picture
+            self._picture = picture
+            self._cond.notify()
+        pass
+
+    def get(self, timeout=None):
+        """ wait for the next picture (viewer thread), None on timeout or when closed """
+        with self._cond:
+            if self._picture is None and not self.closed:
+                self._cond.wait(timeout)
+            picture, self._picture = self._picture, None
+            return picture
+
+    def close(self):
+        """ end the subscription """
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self.broadcaster.unsubscribe(self)
+        pass
+
+
+class Broadcaster(threading.Thread):
+    """ decode one camera stream once for any number of viewers """
+
+    def __init__(self, idx, url, lggr, looping=False):
+        """ initialize the broadcaster of camera 'idx', looping: url is a local video file (e.g. load test) """
+        threading.Thread.__init__(self)
+        self.name = 'Broadcaster-' + str(idx)
+        self.idx = idx
+        self.url = url # rtsp url (sub stream) or webcam index
+        self.looping = looping # played in a loop, at its frame rate
+        self.logger = lggr
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._idle_since = time.time()
+        self._seq = 0
+        self.stopping = False # no more subscriptions, when set
+        self.on_stop = None # function(broadcaster) called when the thread ends, set by the pool
+        self.keep_running = True
+
+    def subscribe(self, factory=Subscription):
+        """ add a viewer, subscription created by factory(broadcaster), None if already stopping """
+        with self._lock:
+            if self.stopping:
+                return None
+            sub = factory(self)
+            self._subscribers.append(sub)
+            return sub
+
+    def unsubscribe(self, sub):
+        """ remove a viewer """
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+            if len(self._subscribers) == 0:
+                self._idle_since = time.time()
+        pass
+
+    def get_subscriber_count(self):
+        """ get the number of viewers """
+        with self._lock:
+            return len(self._subscribers)
+
+    def _is_idle(self):
+        """ no viewers for IDLE_TIMEOUT seconds? then stop accepting subscriptions """
+        with self._lock:
+            if len(self._subscribers) == 0 and time.time() - self._idle_since > IDLE_TIMEOUT:
+                self.stopping = True
+            return self.stopping
+
+    def _publish(self, frame):
+        """ encode once, fan out to all viewers """
+        self._seq += 1
+        picture = Picture(self._seq, frame, encode(frame))
+        with self._lock:
+            subs = list(self._subscribers)
+        for sub in subs:
+            sub.put(picture)
+        pass
+
+    def _stream(self):
+        """ read, encode and publish frames until idle or terminated """
+        stream = cv2.VideoCapture(self.url)
+        fps = stream.get(cv2.CAP_PROP_FPS) if self.looping else 0.0
+        due = time.time()
+        empty = 0
+        try:
+            while self.keep_running and not self._is_idle():
+                if self.looping:
+                    due = camera.pace(due, fps)
+                success, frame = stream.read() # blocking
+                if self.looping and not success:
+                    stream.set(cv2.CAP_PROP_POS_FRAMES, 0) # end of the video file, play it again
+                    success, frame = stream.read()
+                if success and frame is not None:
+                    empty = 0
+                    self._publish(frame)
+                else:
+                    empty += 1
+                    if empty >= MAX_EMPTY:
+                        self.logger.warning('Broadcaster lost stream of camera '+str(self.idx))
+                        break
+        except cv2.error:
+            self.logger.error('Broadcaster cannot connect to camera '+str(self.idx))
+        finally:
+            stream.release()
+        pass
+
+    def _close(self):
+        """ stop accepting subscriptions, end the remaining ones and leave the pool """
+        with self._lock:
+            self.stopping = True
+            subs = list(self._subscribers)
+        for sub in subs:
+            sub.close() # the viewer ends its stream
+        if self.on_stop is not None:
+            self.on_stop(self)
+        pass
+
+    def run(self):
+        """ decode the camera stream while there are viewers """
+        self.logger.info('>>> Started broadcaster of camera '+str(self.idx))
+        try:
+            while self.keep_running and not self._is_idle():
+                self._stream()
+                if self.keep_running and not self._is_idle():
+                    time.sleep(RETRY_DELAY) # reconnect
+        except Exception as err:
+            self.logger.error('Broadcaster of camera '+str(self.idx)+' failed: '+str(err))
+        finally:
+            self._close()
+        self.logger.info('<<< Stopped broadcaster of camera '+str(self.idx))
+        pass
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates """
+        self.keep_running = False
+        self.stopping = True
+        pass
+
+
+class BroadcasterPool:
+    """ lazily started broadcasters, one per camera """
+
+    def __init__(self, cnfg, lggr):
+        """ initialize an empty pool """
+        self.cnfg = cnfg
+        self.logger = lggr
+        self._lock = threading.Lock()
+        self._broadcasters = {} # camera index: Broadcaster
+
+    def subscribe(self, idx, factory=Subscription):
+        """ subscribe to camera 'idx', start its broadcaster for the first viewer """
+        # 640 x 480 pixel substream, or the video source instead of the camera (e.g. load test)
+        src = self.cnfg.get_source(idx)
+        url = src if src is not None else self.cnfg.get_rtsp_url(idx, stream='sub')
+        looping = src is not None and '://' not in src # local video file
+        return self.subscribe_to(idx, lambda: Broadcaster(idx, url, self.logger, looping), factory)
+
+    def subscribe_to(self, key, create, factory=Subscription):
+        """ subscribe to the broadcaster 'key', start a new one with create() for the first viewer """
+        with self._lock:
+            brdcstr = self._broadcasters.get(key)
+            sub = brdcstr.subscribe(factory) if brdcstr is not None else None
+            if sub is None:
+                # no broadcaster, or it is stopping: start a new one
+                brdcstr = create()
+                brdcstr.daemon = True
+                brdcstr.on_stop = lambda stopped: self._remove(key, stopped)
+                sub = brdcstr.subscribe(factory)
+                brdcstr.start()
+                self._broadcasters[key] = brdcstr
+            return sub
+
+    def _remove(self, key, brdcstr):
+        """ remove the stopped broadcaster 'key', unless it was already replaced """
+        with self._lock:
+            if self._broadcasters.get(key) is brdcstr:
+                del self._broadcasters[key]
+        pass
+
+    def get_infos(self):
+        """ get the number of viewers per running broadcaster (camera index or key) """
+        with self._lock:
+            return {idx: brdcstr.get_subscriber_count()
+                    for idx, brdcstr in self._broadcasters.items() if brdcstr.is_alive()}
+
+    def terminate_thread(self):
+        """ stop all broadcasters, called when main thread terminates """
+        with self._lock:
+            brdcstrs = list(self._broadcasters.values())
+        for brdcstr in brdcstrs:
+            brdcstr.terminate_thread()
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
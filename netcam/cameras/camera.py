@@ -8,6 +8,17 @@ import time
 # constants
 MAX_SKIPPED = 30 # [30] skipped frames
 WAIT_LONG = 30 # [30] seconds
+FILE_FPS = 25.0 # [25] frames per second of a local video file without frame rate
+
+def pace(due, fps):
+    """ wait for the next frame of a local video file, like a camera: returns the time of this frame """
+    due += 1.0 / (fps or FILE_FPS)
+    delay = due - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    elif delay < -1.0:
+        due = time.time() # far behind, no burst of frames
+    return due
 
 class Camera(threading.Thread):
     """ class for one physical video cameras """
@@ -15,8 +26,10 @@ class Camera(threading.Thread):
     def __init__(self, idx, ipaddr, rtsp_url, frm, lggr):
         """
         initialize connection to one physical video camera
+        ipaddr None: rtsp_url is a local video file (e.g. load test), played in a loop at its frame rate
         """
         threading.Thread.__init__(self)
+        self.name = 'Camera-' + str(idx)
         self.idx = idx # thread index
         self.ipaddr = ipaddr # ip address of the IP camera
         self.rtsp_url = rtsp_url # url of the external camera or webcam index
@@ -25,8 +38,10 @@ class Camera(threading.Thread):
         self.frame = frm # static class: netcam-git.netcam.cameras.frame.Frame
         self.logger = lggr # logger for this camera
         self.skipped = 0 # skipped frame count
+        self.first_frame = None # time of the first frame of this process
         self.sync_event = threading.Event()
         self.sync_event.clear() # not set
+        self.looping = ipaddr is None # local video file
         self.keep_running = True # maintain video streaming from this camera
 
     def _ping_camera(self, ipaddr):
@@ -38,8 +53,8 @@ class Camera(threading.Thread):
             # IP camera
             response = os.system("ping -c 1 " + ipaddr + " > /dev/null 2>&1")
             return response == 0
-        elif isinstance(ipaddr, int):
-            # local webcam (for testing)
+        elif isinstance(ipaddr, int) or ipaddr is None:
+            # local webcam or video file (for testing)
             return True # always OK
 
     def _sleep(self, secs):
@@ -64,9 +79,16 @@ class Camera(threading.Thread):
                 self.logger.info(">>> Started video streaming in " + threading.currentThread().getName())
                 stream = cv2.VideoCapture(self.rtsp_url)
                 self.skipped = 0 # reset skip counter
+                fps = stream.get(cv2.CAP_PROP_FPS) if self.looping else 0.0
+                due = time.time()
                 while self.keep_running:
+                    if self.looping:
+                        due = pace(due, fps)
                     try:
                         success, frm = stream.read() # read one frame
+                        if self.looping and not success:
+                            stream.set(cv2.CAP_PROP_POS_FRAMES, 0) # end of the video file, play it again
+                            success, frm = stream.read()
                     except cv2.error:
                         self.logger.warning('<<< Connection problem (cv2).')
                         break
@@ -77,6 +99,8 @@ class Camera(threading.Thread):
                             break
                     else:
                         self.skipped = 0 # reset skip counter
+                        if self.first_frame is None:
+                            self.first_frame = time.time()
                         self.frame.set_frame(frm) # pass frame to a thread safe container
                         self.sync_event.set() # unblock waiting consumer threads
                         self.sync_event.clear() # block subsequent waits
@@ -91,6 +115,10 @@ class Camera(threading.Thread):
         """ get the frame count """
         return self.frame.get_frame_count()
 
+    def get_first_frame_time(self):
+        """ get the time of the first frame, None if there is none yet """
+        return self.first_frame
+
     def get_skipped_count(self):
         """ get the number of frames skipped """
         return self.skipped
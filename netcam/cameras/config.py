@@ -9,8 +9,6 @@ from dotenv import load_dotenv
 import platform
 import json
 from datetime import datetime
-import subprocess
-import shutil
 
 class Config:
     """
@@ -26,10 +24,13 @@ class Config:
     PRODUCTION_PATH = '/var/netcam/' # [default]
     LOG_FILE_NAME = 'logs/netcam.?.log' # '[default]
     VIDEO_FILE_NAME = 'videos/recorder.?1.time.?2.avi' # [default]
+    MOUNTS_FILE = '/proc/mounts' # [default] linux, otherwise the output of 'mount' is parsed
+    _mount_points = {} # drive label: mount point, resolved once per process (shared by all instances)
 
     def __init__(self):
         """ initialize an instance of the class """
-        load_dotenv()
+        if os.getenv('FLASK_DOTENV') != '0': # FLASK_DOTENV=0: environment only, e.g. netcam-tool-load.py
+            load_dotenv()
         # set confidential info
         self._flask_secret = os.getenv('FLASK_SECRET')
 
@@ -60,6 +61,14 @@ class Config:
             self._ipc_ports.append(prt)
             prt += 1
 
+        # set optional folder for logs, videos and caches, e.g. a load test (None: external or local drive)
+        s = os.getenv('FLASK_PATH')
+        self._standard_path = os.path.join(s, '') if s else None
+
+        # set optional port of the asyncio streaming server (None: streams are served by Flask)
+        s = os.getenv('FLASK_STREAM_PORT')
+        self._stream_port = int(s) if s else None
+
         # set common IPC secret
         s = os.getenv('FLASK_IPC_SECRET')
         self._ipc_authkey = s.encode('ascii') # bytes
@@ -67,15 +76,22 @@ class Config:
         # set debug_mode info
         mynode = platform.uname().node
         self._debug_mode = (mynode == 'macbook.local' or mynode == 'nvr')
-
-        # check for external disk (already mounted by admin!)
-        self._mount_point = self.check_external_disk(self.DRIVE_LABEL)
-        if self._mount_point is not None:
-            contents = self.read_external_disk(self._mount_point)
-            if 'netcam' not in contents:
-                self.make_standard_folders(self._mount_point)
         pass
 
+    def get_mount_point(self):
+        """
+        get the mount point of the external disk (already mounted by admin!), None if not connected
+        resolved with the first call (lazy), then cached for all instances of this process
+        """
+        if self.DRIVE_LABEL not in Config._mount_points:
+            mount_point = self.check_external_disk(self.DRIVE_LABEL)
+            if mount_point is not None:
+                contents = self.read_external_disk(mount_point)
+                if contents is not None and 'netcam' not in contents:
+                    self.make_standard_folders(mount_point)
+            Config._mount_points[self.DRIVE_LABEL] = mount_point
+        return Config._mount_points[self.DRIVE_LABEL]
+
     def get_ipc_port(self, idx):
         """ get the ipc port reserved for camera idx """
         if 0 <= idx < len(self._config):
@@ -87,6 +103,10 @@ class Config:
         """ get the ipc port reserved for the flask app """
         return self._ipc_port_flask
 
+    def get_stream_port(self):
+        """ get the port of the asyncio streaming server, None if streams are served by Flask """
+        return self._stream_port
+
     def get_ipc_authkey(self):
         """ get the ipc authentication key """
         return self._ipc_authkey
@@ -138,6 +158,16 @@ class Config:
         else:
             return None
 
+    def get_source(self, idx):
+        """
+        get the optional video source of camera 'idx' (key 'src'), used instead of its rtsp stream:
+        a local video file (played in a loop) or the url of a local stand-in server, None: the camera
+        """
+        if 0 <= idx < len(self._config):
+            return self._config[idx].get('src')
+        else:
+            return None
+
     def get_ip_address_list(self):
         """ get the list of IP addresses of the network cameras """
         ips = []
@@ -215,6 +245,15 @@ class Config:
         """
         try:
             # check if external disk is connected
+            if os.path.exists(self.MOUNTS_FILE):
+                # linux: read the mount table, no child process
+                with open(self.MOUNTS_FILE) as fp:
+                    for line in fp:
+                        fields = line.split() # device, mount point (spaces as \040), type, options
+                        if len(fields) > 1 and drive_label in fields[1]:
+                            return fields[1].replace('\\040', ' ') # Mount Point
+                return None
+            import subprocess # deferred, e.g. macOS only
             output = subprocess.check_output(['mount'])
             output = output.decode("utf-8")
             lines = output.split("\n")
@@ -251,6 +290,7 @@ class Config:
 
     def check_disk_capacity(self, mount_point):
         """ get drive capacity """
+        import shutil # deferred, rarely used
         stats = shutil.disk_usage(mount_point)
         hrgb = []
         for stat in stats:
@@ -263,9 +303,13 @@ class Config:
             get the path for the 'netcam' folder, for wring to netcam/logs and netcam/videos
             1. The external drive always has precedence over the local drive.
             2. The external drive must be mounted prior to usage by this app.
+            3. FLASK_PATH in .env has precedence over both, e.g. for a load test.
         """
-        if self._mount_point is not None:
-            return self._mount_point+'/netcam/'
+        if self._standard_path is not None:
+            return self._standard_path
+        mount_point = self.get_mount_point()
+        if mount_point is not None:
+            return mount_point+'/netcam/'
         if self.is_debug_mode():
             return self.DEVELOPMENT_PATH
         else:
@@ -4,7 +4,6 @@
 
 import threading
 import copy
-import imutils
 import os
 import time
 
@@ -0,0 +1,95 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the tiles page of the Flask application: one mosaic composes the live view of
+# all cameras into one grid frame, which is encoded once for all viewers (one stream per viewer).
+
+import cv2
+import numpy as np
+import os
+import time
+from cameras import broadcast
+
+MOSAIC_WIDTH = 1280  # [default] pixels, width of the grid frame
+MOSAIC_FPS = 10      # [default] upper limit of the grid frame rate
+ASPECT_RATIO = 0.75  # [default] tile height / width, 640 x 480 pixel substreams
+
+
+def get_columns(count):
+    """ get the number of grid columns for 'count' cameras (same layout as the tiles page) """
+    if count <= 1:
+        return 1
+    elif count <= 4:
+        return 2 # two columns
+    return 3 # three columns
+
+
+def get_rows(count):
+    """ get the number of grid rows for 'count' cameras """
+    cols = get_columns(count)
+    return (max(count, 1) + cols - 1) // cols
+
+
+def subscribe(pool, indices, lggr, factory=broadcast.Subscription):
+    """ subscribe to the mosaic of cameras 'indices', start it for the first viewer """
+    return pool.subscribe_to('mosaic', lambda: Mosaic(pool, indices, lggr), factory)
+
+
+class Mosaic(broadcast.Broadcaster):
+    """ compose the pictures of the camera broadcasters into one grid, for any number of viewers """
+
+    def __init__(self, pool, indices, lggr):
+        """ initialize the mosaic of cameras 'indices', subscribed through the broadcaster 'pool' """
+        broadcast.Broadcaster.__init__(self, 'mosaic', None, lggr)
+        self.name = 'Mosaic'
+        self.pool = pool
+        self.indices = list(indices)
+        cols, rows = get_columns(len(self.indices)), get_rows(len(self.indices))
+        self.tile_width = MOSAIC_WIDTH // cols
+        self.tile_height = int(self.tile_width * ASPECT_RATIO)
+        # preallocated grid, tiles are resized in place
+        self._canvas = np.zeros((rows * self.tile_height, cols * self.tile_width, 3), dtype=np.uint8)
+        self._tiles = [] # one view into the canvas per camera
+        for n in range(len(self.indices)):
+            y, x = (n // cols) * self.tile_height, (n % cols) * self.tile_width
+            self._tiles.append(self._canvas[y:y + self.tile_height, x:x + self.tile_width])
+        self.updates = 0 # tile updates
+        self.frames = 0 # composed (and encoded) grid frames
+
+    def _update_tile(self, n, picture):
+        """ resize the picture of camera n into its tile (in place) """
+        cv2.resize(picture.frame, (self.tile_width, self.tile_height),
+                   dst=self._tiles[n], interpolation=cv2.INTER_AREA)
+        self.updates += 1
+        pass
+
+    def _stream(self):
+        """ compose and publish grid frames until idle or terminated """
+        subs = [self.pool.subscribe(idx) for idx in self.indices]
+        interval = 1.0 / MOSAIC_FPS
+        due = time.time()
+        try:
+            while self.keep_running and not self._is_idle():
+                changed = False
+                for n, sub in enumerate(subs):
+                    if sub.closed: # the camera broadcaster has stopped, start a new one
+                        sub = subs[n] = self.pool.subscribe(self.indices[n])
+                    picture = sub.get(timeout=0) # newest picture, None: unchanged tile
+                    if picture is not None:
+                        self._update_tile(n, picture)
+                        changed = True
+                if changed:
+                    self.frames += 1
+                    self._publish(self._canvas.copy()) # snapshot, the canvas keeps changing
+                due = max(due + interval, time.time())
+                time.sleep(max(due - time.time(), 0.0))
+        finally:
+            for sub in subs:
+                sub.close() # camera broadcasters stop when idle
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
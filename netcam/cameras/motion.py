@@ -2,6 +2,7 @@
 
 import cv2
 import os
+import threading
 
 class Motion:
     """
@@ -12,27 +13,130 @@ class Motion:
     BG_SUB_METHODE = 'MOG2' # [default] background subtraction methods are: ( 'MOG2', 'KNN')
     FG_MIN_AREA = 500       # [default] minimal size of green boxes (sensitivity)
     WARMUP_FRAMES = 100     # [default] frames read (delay) before detecting motions
+    HISTORY = {'MOG2': 100, 'KNN': 500} # [default] frames of the background model, per methode
+    THRESHOLD = 400.0       # [default] varThreshold (MOG2) or dist2Threshold (KNN)
+    SETTINGS = ('roi', 'fg_min_area', 'bg_sub_methode', 'history', 'threshold') # live reconfigurable
 
     def __init__(self, roi):
         """ create instance of motions """
         self.roi = roi # region of interest: (x,y,w,h)Tuple
+        self.fg_min_area = self.FG_MIN_AREA
+        self.bg_sub_methode = self.BG_SUB_METHODE
+        self.history = self.HISTORY.get(self.bg_sub_methode, 500)
+        self.threshold = self.THRESHOLD
         self.warmup = self.WARMUP_FRAMES
-        if self.BG_SUB_METHODE == 'MOG2':
-            self.backSub = cv2.createBackgroundSubtractorMOG2(
-                history=100, varThreshold=400.0, detectShadows=False) # [defaults: 500, 400, False]
-        elif self.BG_SUB_METHODE == 'KNN':
-            self.backSub = cv2.createBackgroundSubtractorKNN(
-                history=500, dist2Threshold=400.0, detectShadows=False) # [defaults: 500, 400, False]
-        else:
-            self.backSub = None
-            raise ValueError('Illegal background subtraction methode defined.')
+        self.backSub = self._create_background_subtractor()
         self._bounding_box = [0,0,0,0, False] # x, y, x2(x+w), y2(y+h), empty
+        self._lock = threading.Lock()
+        self._pending = None # validated settings, swapped in at the next frame boundary
+        self._swapped = None # event of the pending settings, set after the swap
+        self._frames = 0 # parsed frames
+        self.last_swap = None # result of the last swap (dictionary): first frame, background model reset, settings
         pass
 
+    def _create_background_subtractor(self):
+        """ create a new background model with the current settings """
+        if self.bg_sub_methode == 'MOG2':
+            return cv2.createBackgroundSubtractorMOG2(
+                history=self.history, varThreshold=self.threshold, detectShadows=False) # [defaults: 500, 400, False]
+        elif self.bg_sub_methode == 'KNN':
+            return cv2.createBackgroundSubtractorKNN(
+                history=self.history, dist2Threshold=self.threshold, detectShadows=False) # [defaults: 500, 400, False]
+        else:
+            raise ValueError('Illegal background subtraction methode defined.')
+
     def __del__(self):
         """ delete instance of motions """
         pass
 
+    def get_settings(self):
+        """ get the current motion settings (dictionary) """
+        return {"roi": tuple(self.roi),
+                "fg_min_area": self.fg_min_area,
+                "bg_sub_methode": self.bg_sub_methode,
+                "history": self.history,
+                "threshold": self.threshold}
+
+    def _validate(self, changes, settings):
+        """ merge the changes into a copy of 'settings', raise ValueError for illegal settings """
+        if not isinstance(changes, dict):
+            raise ValueError('Settings must be a dictionary.')
+        unknown = [key for key in changes if key not in self.SETTINGS]
+        if unknown:
+            raise ValueError('Unknown motion settings: '+', '.join([str(key) for key in unknown]))
+        settings = dict(settings)
+        if 'bg_sub_methode' in changes and 'history' not in changes:
+            settings['history'] = self.HISTORY.get(changes['bg_sub_methode'], settings['history'])
+        settings.update(changes)
+        try:
+            roi = tuple([int(value) for value in settings['roi']])
+            settings['fg_min_area'] = int(settings['fg_min_area'])
+            settings['history'] = int(settings['history'])
+            settings['threshold'] = float(settings['threshold'])
+        except (TypeError, ValueError):
+            raise ValueError('Illegal motion settings: '+str(changes))
+        if len(roi) != 4 or min(roi) < 0 or roi[2] == 0 or roi[3] == 0:
+            raise ValueError('Illegal region of interest (x,y,w,h): '+str(settings['roi']))
+        settings['roi'] = roi # checked against the frame size at the swap (no frame yet: size unknown)
+        if settings['bg_sub_methode'] not in self.HISTORY:
+            raise ValueError('Illegal background subtraction methode: '+str(settings['bg_sub_methode']))
+        if settings['fg_min_area'] < 0 or settings['history'] <= 0 or settings['threshold'] <= 0.0:
+            raise ValueError('Illegal motion settings: '+str(changes))
+        return settings
+
+    def set_settings(self, changes):
+        """
+        called from external function (e.g. ipc thread): validate the changed settings (ValueError)
+        and swap them in at the next frame boundary, returns an event which is set after the swap
+        (changes arriving before the swap are merged into the pending settings, one swap)
+        """
+        with self._lock:
+            self._pending = self._validate(changes, self._pending or self.get_settings())
+            if self._swapped is None:
+                self._swapped = threading.Event()
+            return self._swapped
+
+    def _check_roi(self, roi, shape):
+        """ get the reason why the roi does not fit into a frame of 'shape' (height, width), None if it fits """
+        if roi[0] + roi[2] > shape[1] or roi[1] + roi[3] > shape[0]:
+            return 'Region of interest outside of the frame '+str(shape[1])+'x'+str(shape[0])
+        return None
+
+    def _swap_settings(self, shape):
+        """
+        swap in the pending settings (between two frames, in the videoclip thread): the background
+        model is kept for the same methode and geometry of the roi, otherwise it is learned again;
+        settings with a roi outside of the frame (shape: height, width) are rejected, the current stay
+        """
+        with self._lock:
+            settings, swapped = self._pending, self._swapped
+            self._pending, self._swapped = None, None
+            rejected = self._check_roi(settings['roi'], shape)
+            if rejected is not None:
+                self.last_swap = {"frame": self._frames + 1, "reset": False, "rejected": rejected,
+                                  "settings": self.get_settings()}
+                swapped.set()
+                return
+            reset = settings['bg_sub_methode'] != self.bg_sub_methode or settings['roi'] != tuple(self.roi)
+            self.roi = settings['roi']
+            self.fg_min_area = settings['fg_min_area']
+            self.bg_sub_methode = settings['bg_sub_methode']
+            self.history = settings['history']
+            self.threshold = settings['threshold']
+        if reset:
+            self.backSub = self._create_background_subtractor()
+            self.warmup = self.WARMUP_FRAMES
+        else:
+            self.backSub.setHistory(self.history)
+            if self.bg_sub_methode == 'MOG2':
+                self.backSub.setVarThreshold(self.threshold)
+            else:
+                self.backSub.setDist2Threshold(self.threshold)
+        self._bounding_box[4] = False
+        self.last_swap = {"frame": self._frames + 1, "reset": reset, "settings": settings}
+        swapped.set()
+        pass
+
     def _init_bounding_box(self):
         """ initialize bounding box """
         self._bounding_box[4] = False
@@ -51,6 +155,14 @@ class Motion:
         """ calculate the largest bounding box """
         return self._bounding_box
 
+    def get_bounding_box(self):
+        """ get the bounding box of the last parsed frame (x1, y1, x2, y2), None if empty """
+        if not self._bounding_box[4]:
+            return None
+        x1, y1 = self.roi[0], self.roi[1] # region of interest
+        return (self._bounding_box[0] + x1, self._bounding_box[1] + y1,
+                self._bounding_box[2] + x1, self._bounding_box[3] + y1)
+
     def _update_bounding_box(self, x,  y, w, h):
         """ calculate the largest bounding box """
         if not self._bounding_box[4]:
@@ -77,6 +189,9 @@ class Motion:
 
     def parse_frame(self, frame):
         """ parse ONE picture frame (roi) for motions """
+        if self._pending is not None:
+            self._swap_settings(frame.shape[:2]) # frame boundary
+        self._frames += 1
         cropped_frame = frame[int(self.roi[1]):int(self.roi[1] + self.roi[3]),
                               int(self.roi[0]):int(self.roi[0] + self.roi[2])]
         # update the background model
@@ -95,7 +210,7 @@ class Motion:
         for i in range(len(contours)):
             x, y, w, h = cv2.boundingRect(contours[i])
             area = w * h # pixels
-            if area > self.FG_MIN_AREA:
+            if area > self.fg_min_area:
                 motion_detected = True
                 pixelarea += area
                 # [debug] decorate frame with little green boxes (motions)
@@ -0,0 +1,217 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the live state of the Flask application: one producer thread compares the camera
+# states and looks for new clips once per second, changes are kept as numbered events (diffs) and
+# sent to any number of viewers as server-sent events (/events), without a poll per viewer.
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+
+INTERVAL = 1.0       # [default] seconds between two comparisons
+BACKLOG = 100        # [default] events kept for viewers that fell behind (or reconnect)
+KEEPALIVE = 15.0     # [default] seconds, comment line sent when nothing changed
+RETRY = 3000         # [default] milliseconds, reconnect delay of the browser
+POLL_RETRY = 2000    # [default] milliseconds, reconnect delay of a short stream (no thread per viewer)
+CAMERA_KEYS = ('cnnprbl', 'cam_fps', 'rec_state') # [default] values sent to the viewers
+FPS_DIGITS = 0       # [default] rounding of the frame rate, avoids an event per second and camera
+POLL_PAGE = 50       # [default] clips per database read
+
+
+def get_message(version, event, data):
+    """ format one server-sent event: id, event name and json data """
+    return 'id: ' + str(version) + '\nevent: ' + event + '\ndata: ' + json.dumps(data) + '\n\n'
+
+
+def get_keepalive():
+    """ format a comment line, keeps proxies and browsers from closing an idle stream """
+    return ': keepalive\n\n'
+
+
+def get_retry(millis=RETRY):
+    """ format the reconnect delay, sent once at the start of a stream """
+    return 'retry: ' + str(millis) + '\n\n'
+
+
+def get_version(value):
+    """ convert the Last-Event-ID header (or request argument) to a version, None if missing """
+    if value is not None and str(value).isdigit():
+        return int(value)
+    return None
+
+
+class StateHub(threading.Thread):
+    """ produce the camera state diffs and new clip events once, for all viewers """
+
+    def __init__(self, db, get_camera_info, count, lggr, interval=INTERVAL, backlog=BACKLOG):
+        """
+        initialize the hub
+            get_camera_info: function(idx) returning the (cached) information of camera 'idx'
+            count: number of cameras
+        """
+        threading.Thread.__init__(self)
+        self.name = 'StateHub'
+        self.daemon = True
+        self.db = db
+        self.get_camera_info = get_camera_info
+        self.count = count
+        self.logger = lggr
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._events = collections.deque(maxlen=backlog) # (version, event, data), oldest first
+        self._cameras = {} # camera index (string): state, as last sent
+        self._listeners = [] # functions called after each new event, e.g. to wake up an event loop
+        self._last_idx = None # last clip id seen in the database
+        self._counter = None # database change counter
+        self.version = 0 # number of the newest event
+        self.keep_running = True
+
+    # ----------
+    def _get_cameras(self):
+        """ get the current state of all cameras """
+        cameras = {}
+        for idx in range(self.count):
+            info = self.get_camera_info(idx)
+            state = {key: info.get(key) for key in CAMERA_KEYS}
+            if isinstance(state['cam_fps'], (int, float)):
+                state['cam_fps'] = round(state['cam_fps'], FPS_DIGITS)
+            cameras[str(idx)] = state
+        return cameras
+
+    def _compare_cameras(self):
+        """ publish the changed values of the cameras, nothing if unchanged """
+        cameras = self._get_cameras()
+        diff = {}
+        for idx, state in cameras.items():
+            old = self._cameras.get(idx, {})
+            changed = {key: value for key, value in state.items() if old.get(key, KeyError) != value}
+            if changed:
+                diff[idx] = changed
+        if diff:
+            self._cameras = cameras
+            self._publish('cameras', diff)
+        pass
+
+    def _look_for_clips(self):
+        """ publish the clips registered since the last look (one indexed read when nothing changed) """
+        counter = self.db.get_change_counter()
+        if counter == self._counter:
+            return
+        if self._last_idx is None:
+            self._last_idx = self.db.get_last_clip_index() # start with new clips, not the history
+            self._counter = counter
+            return
+        clips = []
+        last_idx = self._last_idx
+        rows = self.db.get_clips_after(last_idx, POLL_PAGE)
+        while len(rows) > 0:
+            for row in rows:
+                last_idx = row['id']
+                clips.append({"id": row['id'], "cam": row['cam'], "ts": row['ts'], "tzoff": row['tzoff'],
+                              "day": row['day'], "frms": row['frms']})
+            if len(rows) < POLL_PAGE:
+                break # last page
+            rows = self.db.get_clips_after(last_idx, POLL_PAGE)
+        # all pages read: a failed read (sqlite3.Error) is repeated at the next look
+        self._last_idx = last_idx
+        self._counter = counter
+        if clips:
+            self._publish('clips', clips)
+        pass
+
+    def _publish(self, event, data):
+        """ add an event, wake up all waiting viewers """
+        with self._cond:
+            self.version += 1
+            self._events.append((self.version, event, data))
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+        pass
+
+    def run(self):
+        """ compare the states every interval seconds """
+        self.logger.info('>>> Started state hub')
+        while self.keep_running:
+            self._compare_cameras()
+            try:
+                self._look_for_clips()
+            except sqlite3.Error as err: # e.g. database locked, try again later
+                self.logger.error('State hub cannot read the database: '+str(err))
+            with self._cond:
+                self._cond.wait_for(lambda: not self.keep_running, self.interval)
+        with self._cond:
+            self._cond.notify_all() # viewers leave
+        self.logger.info('<<< Stopped state hub')
+        pass
+
+    # ----------
+    def get_events(self, version):
+        """
+        get the events after 'version' as a list of (version, event, data), empty if there are none:
+        the events of a viewer that fell behind are merged, a new viewer (version None) or one that
+        is too far behind gets the complete camera state instead
+        """
+        with self._cond:
+            if version == self.version:
+                return []
+            events = [event for event in self._events if event[0] > version] if version is not None else []
+            if version is None or version > self.version or len(events) < self.version - version:
+                return [(self.version, 'cameras', dict(self._cameras))]
+        if len(events) == 1:
+            return events
+        cameras = {}
+        clips = []
+        for vrsn, event, data in events:
+            if event == 'cameras':
+                for idx, changed in data.items():
+                    cameras.setdefault(idx, {}).update(changed)
+            else:
+                clips.extend(data)
+        merged = [(events[-1][0], 'cameras', cameras)] if cameras else []
+        if clips:
+            merged.append((events[-1][0], 'clips', clips))
+        return merged
+
+    def wait(self, version, timeout=KEEPALIVE):
+        """ wait for the events after 'version', empty list on timeout or when terminated """
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version or not self.keep_running, timeout)
+        return self.get_events(version) if self.keep_running else []
+
+    def add_listener(self, listener):
+        """ call 'listener' (no arguments, from the hub thread) after each new event """
+        with self._cond:
+            self._listeners.append(listener)
+        pass
+
+    def remove_listener(self, listener):
+        """ stop calling 'listener' """
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+        pass
+
+    def get_stats(self):
+        """ get the hub statistics (dictionary) """
+        with self._cond:
+            return {"version": self.version,
+                    "backlog": len(self._events),
+                    "listeners": len(self._listeners)}
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates """
+        with self._cond:
+            self.keep_running = False
+            self._cond.notify_all()
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
@@ -0,0 +1,181 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the camera status of the Flask application: a background thread polls all
+# recorders over persistent ipc connections and caches their answers, the pages read the cache
+# (no ipc in the request path, a dead or hanging recorder only makes its own entry stale).
+
+import os
+import socket
+import struct
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Connection, answer_challenge, deliver_challenge, wait
+
+POLL_INTERVAL = 2.0     # [default] seconds between two polls
+RESPONSE_TIMEOUT = 1.0  # [default] seconds, for the answers of all recorders
+RECONNECT_DELAY = 5.0   # [default] seconds, before reconnecting a failed recorder
+STALE_AFTER = 10.0      # [default] seconds, older information is reported as a connection problem
+COMMAND_TIMEOUT = 5.0   # [default] seconds, for the answer to a command (e.g. 'configure!')
+CONNECT_TIMEOUT = 2.0   # [default] seconds, for the connection and its authentication
+
+
+def connect(address, authkey, timeout=CONNECT_TIMEOUT):
+    """
+    open an authenticated connection like multiprocessing.connection.Client, but each blocking
+    send or receive fails after 'timeout' seconds, e.g. a recorder accepting but not answering
+    """
+    sock = socket.create_connection(address, timeout=timeout)
+    try:
+        sock.settimeout(None) # blocking, the connection reads and writes the file descriptor itself
+        limit = struct.pack('ll', int(timeout), int(timeout % 1 * 1000000)) # struct timeval
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, limit)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, limit)
+        conn = Connection(sock.detach())
+    finally:
+        sock.close()
+    try:
+        answer_challenge(conn, authkey) # same handshake as Client
+        deliver_challenge(conn, authkey)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def ask_recorder(cnfg, idx, msg, timeout=COMMAND_TIMEOUT):
+    """ send one command to recorder 'idx' over its own (short) connection, None if there is no answer """
+    try:
+        conn = connect(('localhost', cnfg.get_ipc_port(idx)), cnfg.get_ipc_authkey())
+    except (OSError, EOFError, AuthenticationError):
+        return None # Connection refused, recorder not running
+    try:
+        conn.send(msg)
+        if conn.poll(timeout):
+            return conn.recv()
+    except (OSError, EOFError):
+        pass
+    finally:
+        conn.close()
+    return None
+
+
+class StatusPoller(threading.Thread):
+    """ poll the 'information?' of all recorders, cache the answers with their time """
+
+    def __init__(self, cnfg, lggr):
+        """ initialize the poller for all configured cameras """
+        threading.Thread.__init__(self)
+        self.name = 'StatusPoller'
+        self.daemon = True
+        self.cnfg = cnfg
+        self.logger = lggr
+        self.count = len(cnfg.get_ip_address_list())
+        self._lock = threading.Lock()
+        self._infos = [None] * self.count # last answer per camera (dictionary)
+        self._times = [0.0] * self.count # time of the last answer
+        self._conns = [None] * self.count # persistent connection per camera
+        self._retry = [0.0] * self.count # time of the next connection attempt
+        self._wakeup = threading.Event()
+        self.polls = 0
+        self.errors = 0
+        self.keep_running = True
+
+    def get_info(self, idx):
+        """ get the cached information of camera 'idx' (no ipc), with its age in seconds """
+        with self._lock:
+            info, updated = self._infos[idx], self._times[idx]
+        age = time.time() - updated
+        if info is None or age > STALE_AFTER:
+            return {"cnnprbl": True, "age": round(age, 1) if info is not None else None}
+        info = dict(info)
+        info["age"] = round(age, 1)
+        return info
+
+    def _connect(self, idx):
+        """ open the connection to recorder 'idx', None if it is not (yet) running """
+        if time.time() < self._retry[idx]:
+            return None
+        address = ('localhost', self.cnfg.get_ipc_port(idx))
+        try:
+            return connect(address, self.cnfg.get_ipc_authkey())
+        except (OSError, EOFError, AuthenticationError):
+            # Connection refused [Errno 61], e.g. recorder not started yet, or timed out
+            self._retry[idx] = time.time() + RECONNECT_DELAY
+            return None
+
+    def _disconnect(self, idx, reason):
+        """ close a failed connection, reconnect later """
+        if self._conns[idx] is not None:
+            self.logger.warning('Status of camera '+str(idx)+' not available: '+reason)
+            try:
+                self._conns[idx].close()
+            except OSError:
+                pass
+        self._conns[idx] = None
+        self._retry[idx] = time.time() + RECONNECT_DELAY
+        self.errors += 1
+        pass
+
+    def _poll(self):
+        """ send the requests to all recorders, then collect the answers until the timeout """
+        pending = {} # connection: camera index
+        for idx in range(self.count):
+            if self._conns[idx] is None:
+                self._conns[idx] = self._connect(idx)
+            if self._conns[idx] is not None:
+                try:
+                    self._conns[idx].send('information?') # information request
+                    pending[self._conns[idx]] = idx
+                except OSError as err:
+                    self._disconnect(idx, str(err))
+        deadline = time.time() + RESPONSE_TIMEOUT
+        while len(pending) > 0 and time.time() < deadline:
+            for conn in wait(list(pending), timeout=max(deadline - time.time(), 0.0)):
+                idx = pending.pop(conn)
+                try:
+                    info = conn.recv()
+                except (EOFError, OSError):
+                    self._disconnect(idx, 'connection closed')
+                    continue
+                if type(info) is dict:
+                    with self._lock:
+                        self._infos[idx] = info
+                        self._times[idx] = time.time()
+                else:
+                    self.logger.error('IPC response error: '+str(info))
+        for idx in pending.values():
+            # no answer in time: the late answer would be read as the next one, start over
+            self._disconnect(idx, 'timeout')
+        self.polls += 1
+        pass
+
+    def run(self):
+        """ poll all recorders every POLL_INTERVAL seconds """
+        while self.keep_running:
+            self._poll()
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+        for idx in range(self.count):
+            if self._conns[idx] is not None:
+                self._conns[idx].close()
+        pass
+
+    def get_stats(self):
+        """ get the poller statistics (dictionary) """
+        return {"polls": self.polls,
+                "errors": self.errors,
+                "connected": len([conn for conn in self._conns if conn is not None])}
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates """
+        self.keep_running = False
+        self._wakeup.set()
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
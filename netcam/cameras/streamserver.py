@@ -0,0 +1,335 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the (optional) asyncio streaming server of the Flask application: the multipart
+# streams and the status are served on their own port by one event loop, viewers wait on awaitable
+# subscriptions instead of pinning a thread each. The pages are still served by Flask.
+
+import asyncio
+import cv2
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+from cameras import adaptive
+from cameras import broadcast
+from cameras import mosaic
+from cameras import statehub
+
+HOST = '0.0.0.0'       # [default] all interfaces, like the Flask server
+BACKLOG = 256          # [default] pending connections
+HEADER_TIMEOUT = 10    # [default] seconds, to receive the request headers
+MAX_HEADER = 8192      # [default] bytes, request line and headers
+STREAM_HEADER = (b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'Connection: close\r\n\r\n')
+EVENTS_HEADER = (b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: text/event-stream\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'Access-Control-Allow-Origin: *\r\n'
+                 b'Connection: close\r\n\r\n')
+
+
+class AsyncSubscription(broadcast.Subscription):
+    """ subscription of a viewer in the event loop: the broadcaster thread wakes up the loop """
+
+    def __init__(self, broadcaster, loop):
+        """ initialize the subscription for the event loop 'loop' """
+        broadcast.Subscription.__init__(self, broadcaster)
+        self._loop = loop
+        self._event = asyncio.Event()
+
+    def put(self, picture):
+        """ offer a new picture (broadcaster thread), never blocks """
+        broadcast.Subscription.put(self, picture)
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass # event loop closed
+        pass
+
+    async def wait(self, timeout=None):
+        """ wait for the next picture (event loop), None on timeout or when closed """
+        self._event.clear() # before looking, a picture put meanwhile sets it again
+        picture = self.get(timeout=0)
+        if picture is None and not self.closed:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            picture = self.get(timeout=0)
+        return picture
+
+
+class StreamServer(threading.Thread):
+    """ serve /video_feed, /mosaic_feed, /clip_feed, /events and /status from one asyncio event loop """
+
+    def __init__(self, port, pool, cnfg, get_clip_path, lggr, hub=None):
+        """
+        initialize the server
+            port: tcp port of the server
+            pool: broadcaster pool of the live view (shared with Flask)
+            get_clip_path: function(key) returning the path of the video file of clip 'key'
+            hub: state hub of the server-sent events (shared with Flask), None: no /events
+        """
+        threading.Thread.__init__(self)
+        self.name = 'StreamServer'
+        self.daemon = True
+        self.port = port
+        self.pool = pool
+        self.cnfg = cnfg
+        self.get_clip_path = get_clip_path
+        self.logger = lggr
+        self.hub = hub
+        self.loop = None
+        self._shutdown = None
+        self._changed = None # set (and replaced) after each new event of the hub
+        self.connections = 0 # open connections
+        self.viewers = 0 # open streams
+        self.frames = 0 # sent frames
+        self.keep_running = True
+
+    # ----------
+    async def _reply(self, writer, status, body, mimetype='text/plain'):
+        """ send a complete (small) response """
+        writer.write(('HTTP/1.1 ' + status + '\r\n'
+                      'Content-Type: ' + mimetype + '\r\n'
+                      'Content-Length: ' + str(len(body)) + '\r\n'
+                      'Cache-Control: no-cache\r\n'
+                      'Access-Control-Allow-Origin: *\r\n'
+                      'Connection: close\r\n\r\n').encode('ascii') + body)
+        await writer.drain()
+        pass
+
+    async def _send(self, writer, jpeg, timestamp, quality, ctrl):
+        """ send one frame, measure the time until the socket has taken it """
+        t0 = time.time()
+        writer.write(broadcast.get_frame_part(jpeg, timestamp, quality))
+        await writer.drain()
+        ctrl.sent(len(jpeg), time.time() - t0)
+        self.frames += 1
+        pass
+
+    async def _send_pictures(self, writer, sub, ctrl):
+        """ stream the pictures of a broadcaster subscription, adapted to the viewer's connection """
+        loop = asyncio.get_running_loop()
+        self.viewers += 1
+        try:
+            writer.write(STREAM_HEADER)
+            while not sub.closed and self.keep_running:
+                await asyncio.sleep(ctrl.get_delay()) # frame rate of this viewer
+                picture = await sub.wait(timeout=1.0) # newest frame only, stale frames are dropped
+                if picture is not None:
+                    width, quality = ctrl.get_params(picture.get_width())
+                    if picture.has_jpeg(width, quality):
+                        jpeg = picture.get_jpeg(width, quality)
+                    else: # encode outside of the event loop, once for all viewers
+                        jpeg = await loop.run_in_executor(None, picture.get_jpeg, width, quality)
+                    await self._send(writer, jpeg, picture.timestamp, quality, ctrl)
+        finally:
+            self.viewers -= 1
+            sub.close()
+        pass
+
+    def _read_clip_frame(self, vcap, lock, fps, ctrl):
+        """ read and encode the next frame of a video file (executor thread), None at the end """
+        try:
+            with lock:
+                if not vcap.isOpened():
+                    return None, None # released
+                for n in range(ctrl.get_skip(fps)):
+                    vcap.grab() # slow viewer: skip frames without decoding
+                success, frame = vcap.read()
+            if not success or frame is None:
+                return None, None # end of video file
+            width, quality = ctrl.get_params(frame.shape[1])
+            return broadcast.encode(frame, width, quality), quality
+        except cv2.error:
+            return None, None
+
+    def _open_clip(self, key, start):
+        """ open the video file of clip 'key' at frame 'start' (executor thread) """
+        vcap = cv2.VideoCapture(self.get_clip_path(key))
+        if start > 0:
+            vcap.set(cv2.CAP_PROP_POS_FRAMES, start) # seek, e.g. to the peak of motion
+        return vcap
+
+    def _close_clip(self, vcap, lock):
+        """ release the video file (executor thread), after a pending read """
+        with lock:
+            vcap.release()
+        pass
+
+    async def _send_clip(self, writer, key, start, ctrl):
+        """ stream a video file, paced at the clip's frame rate """
+        loop = asyncio.get_running_loop()
+        vcap = await loop.run_in_executor(None, self._open_clip, key, start)
+        lock = threading.Lock() # the viewer may leave while a frame is read
+        self.viewers += 1
+        try:
+            fps = vcap.get(cv2.CAP_PROP_FPS)
+            ctrl.set_source_fps(fps)
+            writer.write(STREAM_HEADER)
+            while self.keep_running:
+                jpeg, quality = await loop.run_in_executor(None, self._read_clip_frame, vcap, lock, fps, ctrl)
+                if jpeg is None:
+                    break
+                await asyncio.sleep(ctrl.get_delay())
+                await self._send(writer, jpeg, time.time(), quality, ctrl)
+        finally:
+            self.viewers -= 1
+            loop.run_in_executor(None, self._close_clip, vcap, lock)
+        pass
+
+    def _notify(self):
+        """ wake up the event streams (hub thread), the next wait uses a new event """
+        def notify():
+            changed, self._changed = self._changed, asyncio.Event()
+            changed.set()
+        try:
+            self.loop.call_soon_threadsafe(notify)
+        except RuntimeError:
+            pass # event loop closed
+        pass
+
+    async def _send_events(self, writer, version):
+        """ stream the events of the state hub, a comment line when idle """
+        self.viewers += 1
+        try:
+            writer.write(EVENTS_HEADER + statehub.get_retry().encode('utf-8'))
+            while self.keep_running:
+                changed = self._changed # before looking, an event added meanwhile sets it
+                events = self.hub.get_events(version)
+                if len(events) == 0:
+                    try:
+                        await asyncio.wait_for(changed.wait(), statehub.KEEPALIVE)
+                        continue
+                    except asyncio.TimeoutError:
+                        writer.write(statehub.get_keepalive().encode('utf-8'))
+                for version, event, data in events:
+                    writer.write(statehub.get_message(version, event, data).encode('utf-8'))
+                await writer.drain()
+        finally:
+            self.viewers -= 1
+        pass
+
+    # ----------
+    def _get_controller(self, args):
+        """ get a rate controller for the request arguments fps, width, quality """
+        def arg(name, conv):
+            try:
+                return conv(args[name][0]) if name in args else None
+            except ValueError:
+                return None
+        return adaptive.get_controller(arg('fps', float), arg('width', int), arg('quality', int))
+
+    def _get_camera_index(self, idx):
+        """ get the camera index, limited to the configured cameras """
+        return min(max(idx, 0), self.cnfg.get_max_camera_index())
+
+    async def _route(self, writer, path, args, headers):
+        """ serve one request """
+        loop = asyncio.get_running_loop()
+        factory = lambda brdcstr: AsyncSubscription(brdcstr, loop)
+        parts = path.strip('/').split('/')
+        if parts[0] == 'video_feed' and len(parts) >= 2 and parts[1].isdigit():
+            sub = self.pool.subscribe(self._get_camera_index(int(parts[1])), factory)
+            await self._send_pictures(writer, sub, self._get_controller(args))
+        elif parts == ['mosaic_feed']:
+            indices = list(range(len(self.cnfg.get_ip_address_list())))
+            sub = mosaic.subscribe(self.pool, indices, self.logger, factory)
+            await self._send_pictures(writer, sub, self._get_controller(args))
+        elif parts[0] == 'clip_feed' and len(parts) == 2 and parts[1].isdigit():
+            start = int(args['start'][0]) if args.get('start', [''])[0].isdigit() else 0
+            await self._send_clip(writer, int(parts[1]), start, self._get_controller(args))
+        elif parts == ['events'] and self.hub is not None:
+            since = headers.get('last-event-id', args.get('since', [None])[0])
+            await self._send_events(writer, statehub.get_version(since))
+        elif parts == ['status']:
+            await self._reply(writer, '200 OK', json.dumps(self.get_status()).encode('utf-8'), 'application/json')
+        else:
+            await self._reply(writer, '404 Not Found', b'not found')
+        pass
+
+    async def _handle(self, reader, writer):
+        """ handle one connection: one request, the connection is closed after the response """
+        self.connections += 1
+        adaptive.limit_send_buffer(writer.get_extra_info('socket'))
+        writer.transport.set_write_buffer_limits(high=adaptive.SEND_BUFFER) # drain() waits for slow viewers
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HEADER_TIMEOUT)
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ', 2)
+            headers = dict((name.strip().lower(), value.strip()) for name, sep, value in
+                           (line.partition(':') for line in lines[1:]) if sep)
+            url = urlsplit(target)
+            if method != 'GET':
+                await self._reply(writer, '405 Method Not Allowed', b'method not allowed')
+            else:
+                await self._route(writer, url.path, parse_qs(url.query), headers)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass # viewer has left, or bad request
+        except asyncio.CancelledError:
+            pass # server stopped
+        finally:
+            self.connections -= 1
+            writer.close()
+        pass
+
+    async def _serve(self):
+        """ accept connections until terminated """
+        server = await asyncio.start_server(self._handle, HOST, self.port, backlog=BACKLOG, limit=MAX_HEADER)
+        self._changed = asyncio.Event()
+        if self.hub is not None:
+            self.hub.add_listener(self._notify)
+        async with server:
+            await self._shutdown.wait()
+        if self.hub is not None:
+            self.hub.remove_listener(self._notify)
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel() # open streams
+        await asyncio.gather(*tasks, return_exceptions=True)
+        pass
+
+    def run(self):
+        """ run the event loop of the server """
+        self.logger.info('>>> Started stream server on port '+str(self.port))
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._shutdown = asyncio.Event()
+        try:
+            if self.keep_running:
+                self.loop.run_until_complete(self._serve())
+        except OSError as err:
+            self.logger.error('Stream server cannot listen on port '+str(self.port)+': '+str(err))
+        finally:
+            self.loop.close()
+        self.logger.info('<<< Stopped stream server')
+        pass
+
+    def get_status(self):
+        """ get the status of the streaming server (dictionary) """
+        return {"connections": self.connections,
+                "viewers": self.viewers,
+                "frames": self.frames,
+                "broadcasters": {str(key): count for key, count in self.pool.get_infos().items()}}
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates """
+        self.keep_running = False
+        if self.loop is not None and self._shutdown is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._shutdown.set)
+            except RuntimeError:
+                pass # event loop already closed
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
@@ -0,0 +1,257 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the recorder processes of the Flask application: the supervisor owns one
+# netcam-recorder.py process per camera (started with the interpreter of the app, all at once),
+# watches its heartbeat (telemetry or status with an advancing frame count) and restarts it
+# after a crash or a stall, with an increasing delay for recorders which fail again and again.
+# Recorders of a previous run of the app are adopted (their process id is part of the status).
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from cameras import status
+
+CHECK_INTERVAL = 1.0    # [default] seconds between two checks
+STARTUP_TIMEOUT = 60.0  # [default] seconds, until the first heartbeat of a new recorder
+STALL_TIMEOUT = 30.0    # [default] seconds without progress (frame count) of a connected camera
+KILL_TIMEOUT = 5.0      # [default] seconds, after SIGTERM before SIGKILL
+BACKOFF_START = 2.0     # [default] seconds, delay of the first restart
+BACKOFF_MAX = 300.0     # [default] seconds, upper limit of the restart delay
+STABLE_AFTER = 120.0    # [default] seconds of running, the restart delay starts again at BACKOFF_START
+PROBE_TIMEOUT = 1.0     # [default] seconds, answer of a recorder of a previous run
+RECORDER = 'netcam-recorder.py' # [default] script, in the folder of netcam-app.py
+
+
+class Recorder:
+    """ state of one supervised recorder process """
+
+    def __init__(self, idx):
+        """ initialize the state of recorder 'idx' """
+        self.idx = idx
+        self.state = 'waiting' # waiting, starting, running, stopping
+        self.proc = None # Popen object, None for an adopted recorder
+        self.pid = None
+        self.spawned = 0.0 # time of the (last) start
+        self.running = 0.0 # time of the first heartbeat
+        self.progress = 0.0 # time of the last progress
+        self.frames = None # last frame count
+        self.due = 0.0 # waiting: time of the next start, stopping: time of SIGKILL
+        self.failures = 0 # consecutive failures, for the restart delay
+        self.restarts = 0
+        self.start_latency = None # seconds from start to first heartbeat
+        self.first_frame = None # seconds from start to first frame (reported by the recorder)
+        self.exit_code = None # of the last exit
+
+    def is_alive(self):
+        """ check whether the process is still running """
+        if self.proc is not None:
+            return self.proc.poll() is None # also reaps a terminated child
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0) # adopted: no signal, only the check
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass # running, other user
+        return True
+
+    def signal(self, sgnl):
+        """ send a signal to the process, ignore a process which has already gone """
+        try:
+            os.kill(self.pid, sgnl)
+        except (ProcessLookupError, TypeError):
+            pass
+        pass
+
+
+class Supervisor(threading.Thread):
+    """ start, watch and restart the recorder processes of all cameras """
+
+    def __init__(self, cnfg, get_camera_info, lggr):
+        """
+        initialize the supervisor for all configured cameras
+            get_camera_info: function(idx) returning the (cached) information of camera 'idx'
+        """
+        threading.Thread.__init__(self)
+        self.name = 'Supervisor'
+        self.daemon = True
+        self.cnfg = cnfg
+        self.get_camera_info = get_camera_info
+        self.logger = lggr
+        self.folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # of netcam-app.py
+        self._lock = threading.Lock()
+        self._recorders = [Recorder(idx) for idx in range(len(cnfg.get_ip_address_list()))]
+        self._wakeup = threading.Event()
+        self.keep_running = True
+
+    # ----------
+    def _probe(self, rcrdr):
+        """ ask a recorder of a previous run for its process id, None if there is none """
+        try:
+            conn = status.connect(('localhost', self.cnfg.get_ipc_port(rcrdr.idx)), self.cnfg.get_ipc_authkey())
+        except (OSError, EOFError, AuthenticationError):
+            return None # Connection refused, not running
+        try:
+            conn.send('information?')
+            if conn.poll(PROBE_TIMEOUT):
+                info = conn.recv()
+                return info.get('pid') if isinstance(info, dict) else None
+        except (OSError, EOFError):
+            pass
+        finally:
+            conn.close()
+        return None
+
+    def _adopt(self, rcrdr, pid, now):
+        """ supervise a recorder of a previous run """
+        rcrdr.pid = pid
+        rcrdr.state = 'starting'
+        rcrdr.spawned = now
+        self.logger.info('Supervisor adopted recorder '+str(rcrdr.idx)+' (pid '+str(pid)+')')
+        pass
+
+    def _spawn(self, rcrdr, now):
+        """ start the recorder process, does not wait for it """
+        out = os.path.join(self.cnfg.get_standard_path(), 'logs', 'recorder.'+str(rcrdr.idx)+'.out')
+        try:
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, 'a') as fp: # console output, e.g. a traceback before logging is set up
+                rcrdr.proc = subprocess.Popen(
+                    [sys.executable, os.path.join(self.folder, RECORDER), str(rcrdr.idx)],
+                    cwd=os.getcwd(), # same as the app: same (relative) database file
+                    stdin=subprocess.DEVNULL,
+                    stdout=fp,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True, # keeps running when the app stops
+                    shell=False)
+        except OSError as err:
+            self.logger.error('Supervisor cannot start recorder '+str(rcrdr.idx)+': '+str(err))
+            self._schedule(rcrdr, now)
+            return
+        rcrdr.pid = rcrdr.proc.pid
+        rcrdr.state = 'starting'
+        rcrdr.spawned = now
+        rcrdr.frames = None
+        self.logger.info('Supervisor started recorder '+str(rcrdr.idx)+' (pid '+str(rcrdr.pid)+')')
+        pass
+
+    def _schedule(self, rcrdr, now):
+        """ restart the recorder after a delay, doubled with every consecutive failure """
+        delay = min(BACKOFF_START * 2 ** rcrdr.failures, BACKOFF_MAX)
+        rcrdr.failures += 1
+        rcrdr.restarts += 1
+        rcrdr.state = 'waiting'
+        rcrdr.proc = None
+        rcrdr.pid = None
+        rcrdr.due = now + delay
+        self.logger.warning('Supervisor restarts recorder '+str(rcrdr.idx)+' in '+str(delay)+' secs')
+        pass
+
+    def _halt(self, rcrdr, now, reason):
+        """ stop a hanging recorder: SIGTERM now, SIGKILL after the timeout """
+        self.logger.error('Supervisor stops recorder '+str(rcrdr.idx)+' (pid '+str(rcrdr.pid)+'): '+reason)
+        rcrdr.signal(signal.SIGTERM)
+        rcrdr.state = 'stopping'
+        rcrdr.due = now + KILL_TIMEOUT
+        pass
+
+    def _get_heartbeat(self, rcrdr):
+        """ get the information of a recorder if it is current and comes from the supervised process """
+        info = self.get_camera_info(rcrdr.idx)
+        if 'frm_cnt' not in info or info.get('pid') != rcrdr.pid:
+            return None # stale, or an old process
+        return info
+
+    def _check(self, rcrdr, now):
+        """ check one recorder, act on crashes, stalls and due restarts """
+        if rcrdr.state == 'waiting':
+            if now >= rcrdr.due:
+                self._spawn(rcrdr, now)
+            return
+        alive = rcrdr.is_alive()
+        if rcrdr.state == 'stopping':
+            if not alive:
+                self._schedule(rcrdr, now)
+            elif now >= rcrdr.due:
+                rcrdr.signal(signal.SIGKILL)
+                rcrdr.due = now + KILL_TIMEOUT
+            return
+        if not alive:
+            rcrdr.exit_code = rcrdr.proc.returncode if rcrdr.proc is not None else None
+            self.logger.error('Recorder '+str(rcrdr.idx)+' has exited (code '+str(rcrdr.exit_code)+')')
+            self._schedule(rcrdr, now)
+            return
+        info = self._get_heartbeat(rcrdr)
+        if rcrdr.state == 'starting':
+            if info is not None:
+                rcrdr.state = 'running'
+                rcrdr.running = rcrdr.progress = now
+                rcrdr.frames = info['frm_cnt']
+                if rcrdr.proc is not None: # not adopted
+                    rcrdr.start_latency = round(now - rcrdr.spawned, 2)
+            elif now - rcrdr.spawned > STARTUP_TIMEOUT:
+                self._halt(rcrdr, now, 'no heartbeat after start')
+            return
+        if info is not None:
+            rcrdr.first_frame = info.get('ttff')
+        if info is not None and (info['frm_cnt'] != rcrdr.frames or info.get('cnnprbl')):
+            rcrdr.progress = now # new frames, or waiting for its camera (not a stall)
+            rcrdr.frames = info['frm_cnt']
+        if now - rcrdr.progress > STALL_TIMEOUT:
+            self._halt(rcrdr, now, 'stalled for '+str(round(now - rcrdr.progress))+' secs')
+        elif now - rcrdr.running > STABLE_AFTER:
+            rcrdr.failures = 0
+        pass
+
+    def run(self):
+        """ adopt or start all recorders at once, then check them every interval """
+        self.logger.info('>>> Started supervisor')
+        now = time.time()
+        with self._lock:
+            for rcrdr in self._recorders:
+                pid = self._probe(rcrdr)
+                if pid is not None:
+                    self._adopt(rcrdr, pid, now)
+            for rcrdr in self._recorders:
+                if rcrdr.state == 'waiting':
+                    self._spawn(rcrdr, now) # does not wait, all recorders start in parallel
+        while self.keep_running:
+            self._wakeup.wait(CHECK_INTERVAL)
+            with self._lock:
+                now = time.time()
+                for rcrdr in self._recorders:
+                    if self.keep_running:
+                        self._check(rcrdr, now)
+        self.logger.info('<<< Stopped supervisor')
+        pass
+
+    def get_stats(self):
+        """ get the state of all recorders (list of dictionaries, by camera index) """
+        now = time.time()
+        with self._lock:
+            return [{"idx": rcrdr.idx,
+                     "state": rcrdr.state,
+                     "pid": rcrdr.pid,
+                     "uptime": round(now - rcrdr.running) if rcrdr.state == 'running' else None,
+                     "restarts": rcrdr.restarts,
+                     "start_latency": rcrdr.start_latency,
+                     "first_frame": rcrdr.first_frame,
+                     "exit_code": rcrdr.exit_code} for rcrdr in self._recorders]
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates (the recorders keep running) """
+        self.keep_running = False
+        self._wakeup.set()
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
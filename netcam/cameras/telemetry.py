@@ -0,0 +1,187 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the recorder telemetry: each recorder pushes one sample per second (fps, frames,
+# quality, queue depths, stage timings, recording state) to the Flask application over a persistent
+# ipc connection (Flask ipc port), the Flask application keeps a rolling time series per camera.
+
+import collections
+import os
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from cameras import status
+
+INTERVAL = 1.0         # [default] seconds between two samples
+HISTORY = 900          # [default] samples per camera, 15 minutes
+RECONNECT_DELAY = 5.0  # [default] seconds, before reconnecting to the Flask application
+STALE_AFTER = 5.0      # [default] seconds, older samples are not reported as the current state
+
+
+class TelemetrySender(threading.Thread):
+    """ push telemetry samples of one recorder to the Flask application """
+
+    def __init__(self, cnfg, idx, collect, lggr):
+        """
+        initialize the sender of recorder 'idx'
+            collect: function returning the current sample (dictionary)
+        """
+        threading.Thread.__init__(self)
+        self.name = 'TelemetrySender'
+        self.daemon = True
+        self.address = ('localhost', cnfg.get_ipc_port_flask())
+        self.authkey = cnfg.get_ipc_authkey()
+        self.idx = idx
+        self.collect = collect
+        self.logger = lggr
+        self._conn = None
+        self._retry = 0.0 # time of the next connection attempt
+        self._wakeup = threading.Event()
+        self.sent = 0
+        self.dropped = 0 # samples not sent, e.g. Flask application not running
+        self.keep_running = True
+
+    def _send(self, sample):
+        """ send one sample, (re)connect if needed, drop it when the application is not reachable """
+        if self._conn is None and time.time() >= self._retry:
+            try:
+                self._conn = status.connect(self.address, self.authkey) # a hanging application times out
+            except (OSError, EOFError, AuthenticationError):
+                self._retry = time.time() + RECONNECT_DELAY
+        if self._conn is None:
+            self.dropped += 1
+            return
+        try:
+            self._conn.send(sample)
+            self.sent += 1
+        except OSError:
+            self.logger.warning('Telemetry connection to the Flask application lost.')
+            self._conn.close()
+            self._conn = None
+            self._retry = time.time() + RECONNECT_DELAY
+            self.dropped += 1
+        pass
+
+    def run(self):
+        """ send one sample every INTERVAL seconds """
+        while self.keep_running:
+            sample = self.collect()
+            sample["cam_idx"] = self.idx
+            sample["ts"] = time.time()
+            sample["tlm_drp"] = self.dropped
+            self._send(sample)
+            self._wakeup.wait(INTERVAL)
+        if self._conn is not None:
+            self._conn.close()
+        pass
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates """
+        self.keep_running = False
+        self._wakeup.set()
+        pass
+
+
+class TelemetryListener(threading.Thread):
+    """ receive the telemetry of all recorders, keep a rolling time series per camera """
+
+    def __init__(self, cnfg, lggr, history=HISTORY):
+        """ initialize the listener on the Flask ipc port """
+        threading.Thread.__init__(self)
+        self.name = 'TelemetryListener'
+        self.daemon = True
+        self.address = ('localhost', cnfg.get_ipc_port_flask())
+        self.authkey = cnfg.get_ipc_authkey()
+        self.logger = lggr
+        self.history = history
+        self._lock = threading.Lock()
+        self._series = {} # camera index: deque of samples, oldest first
+        self.received = 0
+        self.keep_running = True
+
+    def _add(self, sample):
+        """ add one sample to the time series of its camera """
+        idx = sample.get("cam_idx")
+        if not isinstance(idx, int):
+            return
+        with self._lock:
+            if idx not in self._series:
+                self._series[idx] = collections.deque(maxlen=self.history)
+            self._series[idx].append(sample)
+            self.received += 1
+        pass
+
+    def _receive(self, conn):
+        """ receive the samples of one recorder (own thread) until it closes the connection """
+        with conn:
+            try:
+                while self.keep_running:
+                    sample = conn.recv()
+                    if type(sample) is dict:
+                        self._add(sample)
+            except (EOFError, OSError):
+                pass # recorder stopped
+        pass
+
+    def run(self):
+        """ accept recorder connections, one thread per connection """
+        try:
+            listener = Listener(self.address, authkey=self.authkey)
+        except OSError as err:
+            self.logger.error('Telemetry listener cannot listen on port '+str(self.address[1])+': '+str(err))
+            return
+        self.logger.info('>>> Started telemetry listener on port '+str(self.address[1]))
+        while self.keep_running:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, AuthenticationError) as err:
+                self.logger.error('Telemetry connection refused: '+str(err))
+                time.sleep(0.1) # short delay for freeing resources
+                continue
+            thrd = threading.Thread(target=self._receive, args=(conn, ), daemon=True)
+            thrd.name = 'TelemetryConnection'
+            thrd.start()
+        listener.close()
+        self.logger.info('<<< Stopped telemetry listener')
+        pass
+
+    def get_latest(self, idx):
+        """ get the newest sample of camera 'idx' (with its age in seconds), None if missing or stale """
+        with self._lock:
+            series = self._series.get(idx)
+            sample = series[-1] if series else None
+        if sample is None or time.time() - sample["ts"] > STALE_AFTER:
+            return None
+        sample = dict(sample)
+        sample["age"] = round(time.time() - sample["ts"], 1)
+        return sample
+
+    def get_series(self, idx, key, seconds=None):
+        """ get the time series of 'key' for camera 'idx': list of (timestamp, value), oldest first """
+        since = time.time() - seconds if seconds else 0.0
+        with self._lock:
+            series = list(self._series.get(idx, ()))
+        return [(sample["ts"], sample.get(key)) for sample in series if sample["ts"] >= since]
+
+    def get_summary(self, idx, key, seconds=60):
+        """ get (min, average, max) of 'key' for camera 'idx' over the last seconds, None if no samples """
+        values = [value for ts, value in self.get_series(idx, key, seconds) if isinstance(value, (int, float))]
+        if len(values) == 0:
+            return None
+        return min(values), round(sum(values) / len(values), 2), max(values)
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates """
+        self.keep_running = False
+        try:
+            status.connect(self.address, self.authkey).close() # wake up accept()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
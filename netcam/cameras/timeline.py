@@ -0,0 +1,77 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the motion timeline of one video clip: one packed record per recorded frame,
+# stored as a blob in the database and read back with numpy (no parsing).
+
+import numpy as np
+import os
+
+# one record per frame in the video file, 24 bytes, little endian
+DTYPE = np.dtype([
+    ('frm', '<u4'),   # frame counter of the camera
+    ('ms', '<u4'),    # milliseconds since the first frame of the clip
+    ('area', '<u4'),  # motion pixel area
+    ('x1', '<i2'), ('y1', '<i2'), ('x2', '<i2'), ('y2', '<i2'), # bounding box, -1: no motion
+    ('pad', '<u4')])  # reserved, keeps the records 8 byte aligned
+BINS = 100 # [default] bins of the motion intensity bar
+
+
+class Timeline:
+    """ motion timeline (per frame) of one video clip """
+
+    def __init__(self):
+        """ initialize an empty timeline """
+        self._rows = []
+        self._start = None
+
+    def add(self, frame_counter, timestamp, pixel_area, bbox):
+        """ add the motion of one recorded frame """
+        if self._start is None:
+            self._start = timestamp
+        x1, y1, x2, y2 = bbox if bbox is not None else (-1, -1, -1, -1)
+        ms = int((timestamp - self._start) * 1000)
+        self._rows.append((frame_counter, ms, pixel_area, x1, y1, x2, y2, 0))
+        pass
+
+    def __len__(self):
+        """ number of frames in the timeline """
+        return len(self._rows)
+
+    def pack(self):
+        """ get the timeline as a packed blob (bytes) """
+        return np.array(self._rows, dtype=DTYPE).tobytes()
+
+
+def unpack(blob):
+    """ get the timeline (structured numpy array, read-only view) from a packed blob """
+    if blob is None:
+        return np.zeros(0, dtype=DTYPE)
+    return np.frombuffer(blob, dtype=DTYPE)
+
+def get_peak_frame(tml):
+    """ get the position (frame in the video file) with the largest motion """
+    if len(tml) == 0:
+        return 0
+    return int(np.argmax(tml['area']))
+
+def get_intensity(tml, bins=BINS):
+    """
+    get the motion intensity bar: maximum area per bin, normalized 0.0 .. 1.0
+    :returns list of (first frame position of bin, intensity)
+    """
+    if len(tml) == 0:
+        return []
+    bins = min(bins, len(tml))
+    edges = np.linspace(0, len(tml), bins + 1).astype(int)
+    peaks = np.maximum.reduceat(tml['area'].astype(np.float64), edges[:-1])
+    top = peaks.max()
+    if top > 0:
+        peaks = peaks / top
+    return [(int(pos), round(float(val), 2)) for pos, val in zip(edges[:-1], peaks)]
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
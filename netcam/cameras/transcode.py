@@ -0,0 +1,263 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the clip playback of the Flask application: closed clips are transcoded in the
+# background to a browser playable video (H.264 mp4 with ffmpeg, otherwise VP8 webm with opencv),
+# stored in an on-disk cache (least recently used files are evicted above a size limit) and
+# served as static files, so the browser seeks with http range requests (no decoding per viewer).
+
+import cv2
+import collections
+import os
+import queue
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+
+CACHE_FOLDER = 'cache/'      # [default] below the standard path
+MAX_BYTES = 2 * 1024**3      # [default] size limit of the cache
+POLL_INTERVAL = 10           # [default] seconds, check the database for new clips
+POLL_PAGE = 50               # [default] clips per database read
+TIMEOUT = 300                # [default] seconds, per transcode
+MIMETYPES = {'.mp4': 'video/mp4', '.webm': 'video/webm'}
+FFMPEG_ARGS = ['-nostdin', '-loglevel', 'error', '-y', '-an', '-c:v', 'libx264', '-preset', 'veryfast',
+               '-crf', '26', '-pix_fmt', 'yuv420p', '-movflags', '+faststart', '-threads', '1'] # [default]
+
+
+class ClipCache:
+    """ on-disk cache of transcoded clips, one file per clip id, least recently used eviction """
+
+    def __init__(self, folder, max_bytes=MAX_BYTES):
+        """ initialize the cache in 'folder', index the files of a previous run """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict() # filename: size, least recently used first
+        self._bytes = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+        entries = []
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if '.part' in name:
+                os.remove(path) # interrupted transcode
+            elif os.path.splitext(name)[1] in MIMETYPES:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(entries): # mtime: time of last use
+            self._files[name] = size
+            self._bytes += size
+
+    def get_path(self, key):
+        """ get the path of the transcoded clip 'key' and mark it as used, None if not cached """
+        with self._lock:
+            for ext in MIMETYPES:
+                name = str(key) + ext
+                if name in self._files:
+                    self._files.move_to_end(name)
+                    path = os.path.join(self.folder, name)
+                    try:
+                        os.utime(path) # keeps the order of use across restarts
+                    except OSError:
+                        pass
+                    return path
+        return None
+
+    def get_temp_path(self, key, ext):
+        """ get the path for transcoding clip 'key', the file is added when complete """
+        return os.path.join(self.folder, str(key) + '.part' + ext)
+
+    def add(self, key, temp_path):
+        """ add a completely transcoded file, evict the least recently used files above the limit """
+        name = str(key) + temp_path[temp_path.rindex('.part') + len('.part'):]
+        path = os.path.join(self.folder, name)
+        os.replace(temp_path, path) # atomic, readers never see a partial file
+        size = os.path.getsize(path)
+        with self._lock:
+            self._bytes += size - self._files.pop(name, 0)
+            self._files[name] = size
+            while self._bytes > self.max_bytes and len(self._files) > 1:
+                old, old_size = self._files.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(os.path.join(self.folder, old))
+                except OSError:
+                    pass # already removed, or still open on windows
+        pass
+
+    def get_stats(self):
+        """ get the cache statistics (dictionary) """
+        with self._lock:
+            return {"files": len(self._files),
+                    "bytes": self._bytes,
+                    "max_bytes": self.max_bytes,
+                    "evictions": self.evictions}
+
+
+def get_mimetype(path):
+    """ get the mimetype of a transcoded clip """
+    return MIMETYPES[os.path.splitext(path)[1]]
+
+
+class Transcoder(threading.Thread):
+    """ transcode new clips (and requested clips) in the background, one at a time """
+
+    def __init__(self, db, cache, lggr):
+        """ initialize the transcoder for database 'db' and clip cache 'cache' """
+        threading.Thread.__init__(self)
+        self.name = 'Transcoder'
+        self.daemon = True
+        self.db = db
+        self.cache = cache
+        self.logger = lggr
+        self.ffmpeg = shutil.which('ffmpeg') # None: opencv fallback
+        self._queue = queue.Queue()
+        self._pending = set() # queued clip ids
+        self._lock = threading.Lock()
+        self._last_idx = None # last clip id seen in the database
+        self._version = None # database change counter
+        self._process = None # running ffmpeg process, killed by terminate_thread
+        self.transcoded = 0
+        self.errors = 0
+        self.keep_running = True
+
+    def request(self, key):
+        """ queue clip 'key' for transcoding, unless it is cached or already queued """
+        if self.cache.get_path(key) is not None:
+            return
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._queue.put(key)
+        pass
+
+    def _poll_database(self):
+        """ queue the clips registered since the last poll (one indexed read when nothing changed) """
+        version = self.db.get_change_counter()
+        if version == self._version:
+            return
+        if self._last_idx is None:
+            self._last_idx = self.db.get_last_clip_index() # start with new clips, not the history
+        else:
+            rows = self.db.get_clips_after(self._last_idx, POLL_PAGE)
+            while len(rows) > 0:
+                for row in rows:
+                    self._last_idx = row['id']
+                    self.request(row['id'])
+                if len(rows) < POLL_PAGE:
+                    break # last page
+                rows = self.db.get_clips_after(self._last_idx, POLL_PAGE)
+        self._version = version # all pages read
+        pass
+
+    def _transcode_ffmpeg(self, src, tmp):
+        """ transcode with ffmpeg: H.264 mp4, index at the start of the file (fast start) """
+        with subprocess.Popen([self.ffmpeg, '-i', src] + FFMPEG_ARGS + [tmp],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as proc:
+            self._process = proc
+            try:
+                if not self.keep_running:
+                    proc.kill() # terminated meanwhile
+                stderr = proc.communicate(timeout=TIMEOUT)[1]
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                raise
+            finally:
+                self._process = None
+        if proc.returncode != 0 and self.keep_running:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=stderr)
+        pass
+
+    def _transcode_opencv(self, src, tmp):
+        """ transcode with opencv: VP8 webm (no H.264 encoder in the opencv packages) """
+        vcap = cv2.VideoCapture(src)
+        fps = vcap.get(cv2.CAP_PROP_FPS) or 25.0
+        size = (int(vcap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vcap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        writer = cv2.VideoWriter(tmp, cv2.VideoWriter_fourcc(*'VP80'), fps, size)
+        try:
+            if not writer.isOpened():
+                raise IOError('no VP8 encoder')
+            while self.keep_running:
+                success, frame = vcap.read()
+                if not success or frame is None:
+                    break # end of video file
+                writer.write(frame)
+        finally:
+            writer.release()
+            vcap.release()
+        pass
+
+    def _transcode(self, key):
+        """ transcode clip 'key' into the cache """
+        rows = self.db.get_clip(key)
+        if len(rows) == 0 or not os.path.isfile(rows[0]['filename']):
+            return # deleted meanwhile
+        t0 = time.time()
+        tmp = self.cache.get_temp_path(key, '.mp4' if self.ffmpeg is not None else '.webm')
+        try:
+            if self.ffmpeg is not None:
+                self._transcode_ffmpeg(rows[0]['filename'], tmp)
+            else:
+                self._transcode_opencv(rows[0]['filename'], tmp)
+            if self.keep_running:
+                self.cache.add(key, tmp)
+                self.transcoded += 1
+                self.logger.debug('Transcoded clip '+str(key)+' in '+str(round(time.time() - t0, 2))+' secs')
+        except (subprocess.SubprocessError, OSError, cv2.error) as err:
+            self.errors += 1
+            self.logger.error('Cannot transcode clip '+str(key)+': '+str(err))
+        if os.path.isfile(tmp):
+            os.remove(tmp) # failed or interrupted
+        pass
+
+    def run(self):
+        """ transcode queued clips, poll the database for new clips in between """
+        self.logger.info('>>> Started transcoder ('+('ffmpeg' if self.ffmpeg else 'opencv')+')')
+        polled = 0.0 # time of the last poll, also while requested clips keep the queue busy
+        while self.keep_running:
+            if time.time() - polled >= POLL_INTERVAL:
+                polled = time.time()
+                try:
+                    self._poll_database()
+                except sqlite3.Error as err: # e.g. database locked, try again later
+                    self.logger.error('Transcoder cannot read the database: '+str(err))
+            try:
+                key = self._queue.get(timeout=max(polled + POLL_INTERVAL - time.time(), 0.0))
+            except queue.Empty:
+                continue
+            if key is None:
+                continue # terminated
+            with self._lock:
+                self._pending.discard(key)
+            if self.keep_running and self.cache.get_path(key) is None:
+                self._transcode(key)
+        self.logger.info('<<< Stopped transcoder')
+        pass
+
+    def get_stats(self):
+        """ get the transcoder and cache statistics (dictionary) """
+        stats = self.cache.get_stats()
+        stats.update({"queued": self._queue.qsize(),
+                      "transcoded": self.transcoded,
+                      "errors": self.errors})
+        return stats
+
+    def terminate_thread(self):
+        """ stop running this thread, called when main thread terminates """
+        self.keep_running = False
+        self._queue.put(None) # wake up
+        proc = self._process
+        if proc is not None:
+            proc.kill() # do not wait for the transcode to end
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
@@ -6,11 +6,12 @@ import os
 import threading
 import collections
 from enum import Enum
-from netcam.database import database
+from cameras import timeline
 
 BUFFER = 10 # must be larger than PREFIX or POSTFIX
 PREFIX = 4  # frames before first motion detected
 POSTFIX = 4 # frames after last motion detected
+SMOOTHING = 0.1 # [default] weight of the newest stage timing (exponential average)
 
 
 class Status(Enum):
@@ -35,6 +36,7 @@ class Snapshot(threading.Thread):
     def __init__(self, frame, filename, logger):
         """ initialize snapshot class """
         threading.Thread.__init__(self)
+        self.name = 'Snapshot'
         self.frame = frame
         self.filename = filename
         self.logger = logger
@@ -52,9 +54,10 @@ class Snapshot(threading.Thread):
 class VideoClip(threading.Thread):
     """ class for making video clips for one physical video cameras """
 
-    def __init__(self, idx, cnfg, cam, mtn, lggr):
+    def __init__(self, idx, cnfg, cam, mtn, lggr, dbw):
         """ initialize the video clip maker """
         super().__init__()
+        self.name = 'VideoClip-' + str(idx)
         self.idx = idx # camera number 0, 1, 2 etc.
         self.cnfg = cnfg # configuration
         self.camera = cam # frame buffer mpeg
@@ -70,9 +73,13 @@ class VideoClip(threading.Thread):
         self._rcount = 0
         self._pixel_areas = []
         self._frame_counters = []
-        self.db = database.Database() # sqlite3 database (register video files)
+        self.dbw = dbw # asynchronous database writer (register video files)
         self._max_pixel_area = 0 # pixel area with motion detected
         self._max_frame = None # frame with max motion area
+        self._stats = {} # motion statistics of the current clip
+        self._timeline = timeline.Timeline() # motion per recorded frame of the current clip
+        self._timings = {"wait": 0.0, "motion": 0.0, "record": 0.0} # stage timings (ms, exponential average)
+        self._last_qa = None # quality of the last clip (percent)
 
     def _set_snapshot(self, pixel_area, current_frame):
         """ take a snapshot with a maximum of motion """
@@ -97,6 +104,48 @@ class VideoClip(threading.Thread):
             self.logger.error('Snapshot frame is missing (None).')
         pass
 
+    def _reset_statistics(self):
+        """ reset the motion statistics of the current clip """
+        self._stats = {"first": None, "last": None, "peak": 0, "sum": 0, "bbox": None}
+        self._timeline = timeline.Timeline()
+
+    def _add_statistics(self, frame_counter, timestamp, pixel_area, bbox):
+        """ add the motion of one recorded frame to the statistics and the timeline """
+        self._timeline.add(frame_counter, timestamp, pixel_area, bbox)
+        if self._stats["first"] is None:
+            self._stats["first"] = timestamp
+        self._stats["last"] = timestamp
+        self._stats["peak"] = max(self._stats["peak"], pixel_area)
+        self._stats["sum"] += pixel_area
+        if bbox is not None:
+            ubox = self._stats["bbox"]
+            if ubox is None:
+                self._stats["bbox"] = list(bbox)
+            else:
+                # union of bounding boxes: x1, y1, x2, y2
+                self._stats["bbox"] = [min(ubox[0], bbox[0]), min(ubox[1], bbox[1]),
+                                       max(ubox[2], bbox[2]), max(ubox[3], bbox[3])]
+        pass
+
+    def _get_statistics(self, qpct):
+        """ get the clip attributes (json) for the database """
+        frms = len(self._frame_counters)
+        try:
+            size = os.path.getsize(self.filename) # closed video file
+        except OSError:
+            size = 0
+        dur = 0.0
+        if self._stats["first"] is not None:
+            dur = self._stats["last"] - self._stats["first"] + 1 / self.nfps
+        return {
+            "dur": round(dur, 2), # seconds
+            "frms": frms,
+            "qa": round(qpct, 1), # percent
+            "peak": self._stats["peak"], # pixels
+            "mean": round(self._stats["sum"] / frms, 1) if frms > 0 else 0.0, # pixels
+            "bbox": self._stats["bbox"], # union of bounding boxes [x1, y1, x2, y2] or None
+            "bytes": size } # file size
+
     def _open_file(self, frame):
         """ open file for writing, order of height, width is critical """
         self.filename, self.timestamp = self.cnfg.get_video_filename(self.idx)
@@ -111,12 +160,14 @@ class VideoClip(threading.Thread):
             success = False
         #
         self._reset_snapshot() # reset snapshot frame to None
+        self._reset_statistics()
         return success
 
-    def _write_to_file(self, frame):
-        """ write one frame to file """
+    def _write_to_file(self, fifo):
+        """ write one frame (fifo entry) to file, add its motion to the statistics """
         if self.vout is not None:
-            self.vout.write(frame)
+            self.vout.write(fifo[0])
+            self._add_statistics(fifo[1], fifo[2], fifo[3], fifo[4])
         pass
 
     def _close_file(self, qpct):
@@ -127,13 +178,13 @@ class VideoClip(threading.Thread):
             self.vout = None
         # build statistics
         if qpct > 0.0:
-            qa = str(round(qpct,1))
-            frms = len(self._frame_counters)
-            dt = self.timestamp.replace('.', '') # remove dots
-            # register clip in database
-            self.db.set_clip(self.filename, self.idx, dt, {"qa":qa, "frms": frms})
+            infos = self._get_statistics(qpct)
+            ts = time.mktime(time.strptime(self.timestamp, '%Y.%m.%d.%H.%M.%S')) # epoch seconds
+            # register clip in database (queued, never blocks)
+            self.dbw.set_clip(self.filename, self.idx, ts, infos, self._timeline.pack())
             # log closure event
-            self.logger.debug('<<< close video file '+self.filename+', QA: '+qa+'%, frames: '+str(frms))
+            self._last_qa = infos["qa"]
+            self.logger.debug('<<< close video file '+self.filename+', QA: '+str(infos["qa"])+'%, frames: '+str(infos["frms"]))
             # save snapshot to file
             self._save_snapshot(self.filename)
         pass
@@ -176,7 +227,7 @@ class VideoClip(threading.Thread):
                     if self._open_file(frame):
                         # successfully opened .avi file
                         self._frame_counters.append(frame_counter) # add frame counter to list
-                        self._write_to_file(frame) # write first frame to file
+                        self._write_to_file(fifo) # write first frame to file
                         self._rstate = Status.RECORDING.value
                         self._pixel_areas = []
                     else:
@@ -189,14 +240,14 @@ class VideoClip(threading.Thread):
 
         elif self._rstate == Status.RECORDING.value:
             self._frame_counters.append(frame_counter) # add frame counter to list
-            self._write_to_file(frame) # write next frame to file
+            self._write_to_file(fifo) # write next frame to file
             if not motion_detected:
                 self._rstate = Status.STOPPING.value # change state
                 self._rcount = 1 # set counter, first missing motion detected
 
         elif self._rstate == Status.STOPPING.value:
             self._frame_counters.append(frame_counter) # add frame counter to list
-            self._write_to_file(frame)  # write next frame to file
+            self._write_to_file(fifo)  # write next frame to file
             if motion_detected:
                 self._rstate = Status.RECORDING.value  # change state
             else:
@@ -213,6 +264,20 @@ class VideoClip(threading.Thread):
             self._rstate = Status.WAITING.value # try again
         pass
 
+    def _add_timing(self, stage, secs):
+        """ add the duration of one stage (per frame) to its exponential average """
+        self._timings[stage] = (1 - SMOOTHING) * self._timings[stage] + SMOOTHING * secs * 1000
+        pass
+
+    def get_metrics(self):
+        """ get the recording state, quality and stage timings (dictionary) """
+        return {"rec_state": Status(self._rstate).name,
+                "rec_qa": self._last_qa,
+                "rec_fifo": len(self.fifo),
+                "tm_wait": round(self._timings["wait"], 2),
+                "tm_mtn": round(self._timings["motion"], 2),
+                "tm_rec": round(self._timings["record"], 2)}
+
     def run(self):
         """
         connect to camera through the frame buffer, detect motion and make video clips
@@ -221,18 +286,26 @@ class VideoClip(threading.Thread):
         self.logger.info(">>> Started video clip recorder in " + threading.currentThread().getName())
         while self.keep_running:
             # get video frame from camara buffer
+            t0 = time.time()
             frame, frame_counter = self.camera.get_frame_clone() # thread safe buffer (blocking)
+            t1 = time.time()
+            self._add_timing("wait", t1 - t0)
 
             # detect motions
             motion_detected, pixel_area, decorated_frame = self.motion.parse_frame(frame)
             if motion_detected:
                 self._set_snapshot(pixel_area, decorated_frame)  # set snapshot of maximum motion
 
-            # add frame to left side of bounded FIFO buffer
-            self.fifo.appendleft((frame, frame_counter))
+            # add frame (with its motion) to left side of bounded FIFO buffer
+            bbox = self.motion.get_bounding_box() if motion_detected else None
+            self.fifo.appendleft((frame, frame_counter, time.time(), pixel_area, bbox))
+
+            t2 = time.time()
+            self._add_timing("motion", t2 - t1)
 
             # get right side frame from FIFO buffer and write to file conditionally
             self._record(motion_detected, pixel_area, self.fifo[-1])
+            self._add_timing("record", time.time() - t2)
             pass
 
         if self._rstate == Status.RECORDING.value or self._rstate == Status.STOPPING.value:
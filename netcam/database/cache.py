@@ -0,0 +1,84 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# in-process query result cache for the Flask application:
+# - LRU with a maximum number of entries and a time to live per entry
+# - invalidated as a whole when the database change counter moves (new or deleted clips)
+
+import collections
+import os
+import threading
+import time
+
+MAX_ENTRIES = 2048 # [default] cached query results
+TTL = 300          # [default] seconds an entry stays valid
+
+
+class QueryCache:
+    """ LRU/TTL cache of database query results """
+
+    def __init__(self, db, max_entries=MAX_ENTRIES, ttl=TTL):
+        """ initialize an empty cache for database 'db' """
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict() # key: (expiry time, value)
+        self._lock = threading.Lock()
+        self._version = None # database change counter of the cached entries
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def sync(self):
+        """ drop all entries when the database changed, called once per request (one indexed read) """
+        version = self.db.get_change_counter()
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self._invalidations += 1
+                self._entries.clear()
+                self._version = version
+        pass
+
+    def get(self, key, loader, *args):
+        """ get the cached value of 'key', call loader(*args) on a miss """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key) # most recently used
+                self._hits += 1
+                return entry[1]
+            self._misses += 1
+            version = self._version
+        value = loader(*args) # query outside the lock
+        with self._lock:
+            if version != self._version:
+                return value # invalidated meanwhile, the value may be stale: do not cache
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False) # least recently used
+        return value
+
+    def clear(self):
+        """ drop all entries """
+        with self._lock:
+            self._entries.clear()
+        pass
+
+    def get_stats(self):
+        """ get the cache statistics (dictionary) """
+        with self._lock:
+            total = self._hits + self._misses
+            return {"hits": self._hits,
+                    "misses": self._misses,
+                    "rate": round(self._hits / total * 100, 1) if total > 0 else 0.0, # percent
+                    "entries": len(self._entries),
+                    "invalidations": self._invalidations}
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
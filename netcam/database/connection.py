@@ -0,0 +1,76 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# connection manager for the netcam sqlite3 database:
+# - one connection per thread and database file, reused for all queries
+# - WAL journal mode, readers (Flask) never block the writers (recorders)
+# - statements are prepared once per connection (sqlite3 statement cache)
+
+import sqlite3
+import threading
+import os
+
+JOURNAL_MODE = 'WAL'      # [default] write ahead log, concurrent readers and one writer
+SYNCHRONOUS = 'NORMAL'    # [default] safe with WAL, no fsync per commit
+CACHE_SIZE = -8000        # [default] page cache per connection, negative: KiB
+BUSY_TIMEOUT = 5000       # [default] msecs waiting for a locked database
+CACHED_STATEMENTS = 256   # [default] prepared statements kept per connection
+
+
+class Connections:
+    """ per-thread sqlite3 connections, shared by all Database instances of a process """
+
+    _local = threading.local() # thread local storage: {dbfile: connection}
+    _lock = threading.Lock()
+    _count = 0 # number of connections opened in this process
+
+    @classmethod
+    def get(cls, dbfile):
+        """ get the connection to 'dbfile' for the current thread, open it once """
+        cons = getattr(cls._local, 'cons', None)
+        if cons is None:
+            cons = cls._local.cons = {}
+        con = cons.get(dbfile)
+        if con is None:
+            con = cls._open(dbfile)
+            cons[dbfile] = con
+        return con
+
+    @classmethod
+    def _open(cls, dbfile):
+        """ open and tune a new connection """
+        con = sqlite3.connect(
+            dbfile,
+            timeout=BUSY_TIMEOUT / 1000,
+            isolation_level=None, # autocommit, explicit transactions only
+            cached_statements=CACHED_STATEMENTS)
+        con.row_factory = sqlite3.Row # access columns by index or by name
+        con.execute('PRAGMA journal_mode=' + JOURNAL_MODE)
+        con.execute('PRAGMA synchronous=' + SYNCHRONOUS)
+        con.execute('PRAGMA cache_size=' + str(CACHE_SIZE))
+        con.execute('PRAGMA busy_timeout=' + str(BUSY_TIMEOUT))
+        con.execute('PRAGMA temp_store=MEMORY')
+        with cls._lock:
+            cls._count += 1
+        return con
+
+    @classmethod
+    def close(cls, dbfile=None):
+        """ close the connection(s) of the current thread """
+        cons = getattr(cls._local, 'cons', {})
+        for key in list(cons.keys()):
+            if dbfile is None or key == dbfile:
+                cons.pop(key).close()
+        pass
+
+    @classmethod
+    def get_count(cls):
+        """ get the number of connections opened in this process """
+        with cls._lock:
+            return cls._count
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
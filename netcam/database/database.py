@@ -1,10 +1,199 @@
 # Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
 
 # database class for the netcam application
+#
+# schema versions (PRAGMA user_version):
+#   0: empty database file
+#   1: legacy table clips(filename, idx, ymdhms TEXT, infos), no version stamp
+#   2: clips with unique id, camera, epoch timestamp, generated local day, indexes,
+#      legacy rows which cannot be migrated are kept in table 'clips_rejected'
+#   3: clip attributes (infos) as json, motion statistics as generated columns
+#   4: index for the clip pages of one camera
+#   5: summary table 'days' per day and camera, maintained by triggers
+#   6: motion timelines (packed blob per clip, see cameras/timeline.py)
+#   7: change counter of the clips (cache invalidation in the Flask application)
+#   8: summary trigger recomputes the peak of a day only when the deleted clip had it
 
-import sqlite3
 import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from netcam.database.connection import Connections
+
+SCHEMA_VERSION = 8 # [default] latest version of the database schema
+PAGE_SIZE = 50 # [default] clips per page
+CURSOR_FIRST = (2**62, 0) # keyset cursor (ts, cam) before the newest clip
+
+logger = logging.getLogger(__name__)
+
+SQL_CREATE_CLIPS = """
+    CREATE TABLE clips (
+        id INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL UNIQUE,
+        cam INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        tzoff INTEGER NOT NULL,
+        day INTEGER GENERATED ALWAYS AS (
+            CAST(strftime('%Y%m%d', ts + tzoff, 'unixepoch') AS INTEGER)) STORED,
+        infos TEXT NOT NULL
+    )"""
+SQL_CREATE_CLIPS_DAY = "CREATE INDEX clips_day ON clips (day, ts, cam)"
+SQL_CREATE_CLIPS_TS = "CREATE UNIQUE INDEX clips_ts ON clips (ts, cam)"
+
+# convert the legacy local 'yyyymmddhhmmss' text into epoch seconds (utc) and the local offset,
+# the clip id is the legacy rowid: the rows which were not migrated are found afterwards
+SQL_MIGRATE_CLIPS_V1 = """
+    INSERT OR IGNORE INTO clips (id, filename, cam, ts, tzoff, infos)
+    SELECT rowid, filename, idx, ts, naive - ts, infos FROM (
+        SELECT rowid, filename, idx, infos,
+               CAST(strftime('%s', dt, 'utc') AS INTEGER) AS ts,
+               CAST(strftime('%s', dt) AS INTEGER) AS naive
+        FROM (SELECT rowid, filename, idx, infos,
+                     substr(ymdhms,1,4)||'-'||substr(ymdhms,5,2)||'-'||substr(ymdhms,7,2)||' '||
+                     substr(ymdhms,9,2)||':'||substr(ymdhms,11,2)||':'||substr(ymdhms,13,2) AS dt
+              FROM clips_v1))
+    WHERE ts IS NOT NULL
+    ORDER BY ts"""
+# legacy rows with an unparseable timestamp or a duplicate filename/timestamp, kept for a manual repair
+SQL_REJECT_CLIPS_V1 = """
+    CREATE TABLE clips_rejected AS
+    SELECT rowid AS id, * FROM clips_v1
+    WHERE rowid NOT IN (SELECT id FROM clips)"""
+
+# clip attributes, see VideoClip._get_statistics: dur, frms, qa, peak, mean, bbox
+SQL_CONVERT_INFOS_V2 = """
+    UPDATE clips SET infos = json_set(json(replace(infos, '''', '"')),
+                                      '$.qa', CAST(json_extract(replace(infos, '''', '"'), '$.qa') AS REAL))
+    WHERE NOT json_valid(infos) AND json_valid(replace(infos, '''', '"'))"""
+SQL_ADD_STATISTICS = [
+    "ALTER TABLE clips ADD COLUMN dur REAL GENERATED ALWAYS AS (json_extract(infos, '$.dur')) VIRTUAL",
+    "ALTER TABLE clips ADD COLUMN frms INTEGER GENERATED ALWAYS AS (json_extract(infos, '$.frms')) VIRTUAL",
+    "ALTER TABLE clips ADD COLUMN qa REAL GENERATED ALWAYS AS (json_extract(infos, '$.qa')) VIRTUAL",
+    "ALTER TABLE clips ADD COLUMN peak INTEGER GENERATED ALWAYS AS (json_extract(infos, '$.peak')) VIRTUAL",
+    "ALTER TABLE clips ADD COLUMN mean REAL GENERATED ALWAYS AS (json_extract(infos, '$.mean')) VIRTUAL",
+    "CREATE INDEX clips_peak ON clips (peak)"]
+
+SQL_CREATE_CLIPS_CAM = "CREATE INDEX clips_cam ON clips (cam, day, ts)"
+
+# summary per day and camera, updated in the same transaction as every insert/delete of a clip
+SQL_CREATE_SUMMARY = [
+    "ALTER TABLE clips ADD COLUMN bytes INTEGER GENERATED ALWAYS AS (json_extract(infos, '$.bytes')) VIRTUAL",
+    """CREATE TABLE days (
+        day INTEGER NOT NULL,
+        cam INTEGER NOT NULL,
+        clips INTEGER NOT NULL,
+        dur REAL NOT NULL,
+        bytes INTEGER NOT NULL,
+        peak INTEGER NOT NULL,
+        PRIMARY KEY (day, cam)
+    ) WITHOUT ROWID""",
+    """CREATE TRIGGER clips_insert AFTER INSERT ON clips BEGIN
+        INSERT INTO days (day, cam, clips, dur, bytes, peak)
+        VALUES (new.day, new.cam, 1, IFNULL(new.dur, 0), IFNULL(new.bytes, 0), IFNULL(new.peak, 0))
+        ON CONFLICT (day, cam) DO UPDATE SET
+            clips = clips + 1,
+            dur = dur + excluded.dur,
+            bytes = bytes + excluded.bytes,
+            peak = MAX(peak, excluded.peak);
+    END""",
+    """CREATE TRIGGER clips_delete AFTER DELETE ON clips BEGIN
+        UPDATE days SET
+            clips = clips - 1,
+            dur = dur - IFNULL(old.dur, 0),
+            bytes = bytes - IFNULL(old.bytes, 0),
+            peak = IFNULL((SELECT MAX(peak) FROM clips WHERE cam = old.cam AND day = old.day), 0)
+        WHERE day = old.day AND cam = old.cam;
+        DELETE FROM days WHERE day = old.day AND cam = old.cam AND clips <= 0;
+    END"""]
+SQL_REBUILD_SUMMARY = [
+    "DELETE FROM days",
+    """INSERT INTO days (day, cam, clips, dur, bytes, peak)
+        SELECT day, cam, COUNT(*), TOTAL(dur), IFNULL(SUM(bytes), 0), IFNULL(MAX(peak), 0) FROM clips
+        GROUP BY day, cam"""]
+
+SQL_CREATE_TIMELINES = [
+    """CREATE TABLE timelines (
+        id INTEGER PRIMARY KEY,
+        data BLOB NOT NULL
+    )""",
+    """CREATE TRIGGER clips_delete_timeline AFTER DELETE ON clips BEGIN
+        DELETE FROM timelines WHERE id = old.id;
+    END"""]
+
+SQL_CREATE_COUNTERS = [
+    """CREATE TABLE counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID""",
+    "INSERT INTO counters (name, value) VALUES ('clips', 0)",
+    """CREATE TRIGGER clips_insert_counter AFTER INSERT ON clips BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'clips';
+    END""",
+    """CREATE TRIGGER clips_delete_counter AFTER DELETE ON clips BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'clips';
+    END"""]
+SQL_GET_COUNTER = "SELECT value FROM counters WHERE name = ?"
+
+# a bulk delete (retention) scans the remaining clips of a day only when the deleted clip had the peak
+SQL_REPLACE_DELETE_TRIGGER = [
+    "DROP TRIGGER clips_delete",
+    """CREATE TRIGGER clips_delete AFTER DELETE ON clips BEGIN
+        UPDATE days SET
+            clips = clips - 1,
+            dur = dur - IFNULL(old.dur, 0),
+            bytes = bytes - IFNULL(old.bytes, 0),
+            peak = CASE WHEN IFNULL(old.peak, 0) < peak OR peak = 0 THEN peak
+                   ELSE IFNULL((SELECT MAX(peak) FROM clips WHERE cam = old.cam AND day = old.day), 0) END
+        WHERE day = old.day AND cam = old.cam;
+        DELETE FROM days WHERE day = old.day AND cam = old.cam AND clips <= 0;
+    END"""]
+
+SQL_CLIPS_PER_DAY = """
+    SELECT day, SUM(clips) AS clps, SUM(dur) AS dur, SUM(bytes) AS bytes, MAX(peak) AS peak FROM days
+    GROUP BY day
+    ORDER BY day DESC"""
+SQL_CLIPS_FOR_DAY = """
+    SELECT id, cam, ts, tzoff, frms, qa, dur, peak FROM clips
+    WHERE day = ?
+    ORDER BY ts DESC, cam DESC"""
+# keyset pages (ts, cam) descending: older = next page, newer = previous page (reversed)
+SQL_CLIPS_PAGE_OLDER = """
+    SELECT id, cam, ts, tzoff, frms, qa, dur, peak FROM clips
+    WHERE day = ? AND (ts, cam) < (?, ?)
+    ORDER BY ts DESC, cam DESC LIMIT ?"""
+SQL_CLIPS_PAGE_NEWER = """
+    SELECT id, cam, ts, tzoff, frms, qa, dur, peak FROM clips
+    WHERE day = ? AND (ts, cam) > (?, ?)
+    ORDER BY ts ASC, cam ASC LIMIT ?"""
+SQL_CAMERA_PAGE_OLDER = """
+    SELECT id, cam, ts, tzoff, frms, qa, dur, peak FROM clips
+    WHERE cam = ? AND day = ? AND ts < ?
+    ORDER BY ts DESC LIMIT ?"""
+SQL_CAMERA_PAGE_NEWER = """
+    SELECT id, cam, ts, tzoff, frms, qa, dur, peak FROM clips
+    WHERE cam = ? AND day = ? AND ts > ?
+    ORDER BY ts ASC LIMIT ?"""
+SQL_PREVIOUS_CLIP = """
+    SELECT id FROM clips
+    WHERE (ts, cam) < (SELECT ts, cam FROM clips WHERE id = ?)
+    ORDER BY ts DESC, cam DESC LIMIT 1"""
+SQL_NEXT_CLIP = """
+    SELECT id FROM clips
+    WHERE (ts, cam) > (SELECT ts, cam FROM clips WHERE id = ?)
+    ORDER BY ts ASC, cam ASC LIMIT 1"""
+SQL_CLIPS_BY_MOTION = """
+    SELECT id, cam, ts, tzoff, frms, qa, dur, peak, mean FROM clips
+    WHERE peak IS NOT NULL
+    ORDER BY peak DESC LIMIT ?"""
+SQL_DELETE_CLIPS_BEFORE = "DELETE FROM clips WHERE ts < ? RETURNING filename"
+SQL_GET_CLIP = "SELECT id, filename, cam, ts, tzoff, infos FROM clips WHERE id = ?"
+SQL_CLIPS_AFTER = "SELECT id, filename, cam, ts, tzoff, day, frms FROM clips WHERE id > ? ORDER BY id LIMIT ?"
+SQL_LAST_CLIP = "SELECT max(id) AS id FROM clips"
+SQL_SET_CLIP = "INSERT INTO clips (filename, cam, ts, tzoff, infos) VALUES (?,?,?,?,?)"
+SQL_GET_TIMELINE = "SELECT data FROM timelines WHERE id = ?"
+SQL_SET_TIMELINE = "INSERT INTO timelines (id, data) VALUES (?,?)"
 
 
 class Database:
@@ -12,24 +201,131 @@ class Database:
 
     DBFILE = 'database/netcam.db'
 
-    def __init__(self):
-        """ initialise the database """
-        with sqlite3.connect(self.DBFILE) as con:
-            cur = con.cursor()
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS clips (
-                    filename PRIMARY KEY, 
-                    idx INTEGER NOT NULL, 
-                    ymdhms TEXT NOT NULL, 
-                    infos TEXT NOT NULL
-                )
-            """)
-            # check for success
-            res = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='clips';")
-            if res is None:
-                raise BaseException("Error: cannot build mandatory database 'netcam', table 'clips'!")
+    _ready = set() # database files with a checked schema (this process)
+    _ready_lock = threading.Lock()
+
+    def __init__(self, dbfile=None):
+        """ initialise the database, the schema is checked once per process """
+        self.dbfile = dbfile if dbfile is not None else self.DBFILE
+        with self._ready_lock:
+            if self.dbfile not in self._ready:
+                self._init_schema()
+                self._ready.add(self.dbfile)
+        pass
+
+    def _init_schema(self):
+        """ build or migrate the mandatory tables, one transaction per version step """
+        upgrades = [
+            (2, self._upgrade_v2),
+            (3, self._upgrade_v3),
+            (4, self._upgrade_v4),
+            (5, self._upgrade_v5),
+            (6, self._upgrade_v6),
+            (7, self._upgrade_v7),
+            (8, self._upgrade_v8),
+        ]
+        for version, upgrade in upgrades:
+            with self.transaction() as cur:
+                # read the version inside the write lock, other processes may migrate concurrently
+                current = self._get_version(cur)
+                if current < version:
+                    upgrade(cur)
+                    cur.execute('PRAGMA user_version = ' + str(version))
+        # check for success
+        res = self._get_rows("SELECT name FROM sqlite_master WHERE type='table' AND name='clips'")
+        if len(res) == 0:
+            raise BaseException("Error: cannot build mandatory database 'netcam', table 'clips'!")
+        pass
+
+    def _get_version(self, cur):
+        """ get the schema version, legacy databases have no version stamp """
+        version = cur.execute('PRAGMA user_version').fetchone()[0]
+        if version == 0:
+            res = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='clips'")
+            if res.fetchone() is not None:
+                version = 1 # legacy table 'clips'
+        return version
+
+    def _upgrade_v2(self, cur):
+        """ typed and indexed clips table, copy the rows of a legacy table """
+        res = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='clips'")
+        legacy = res.fetchone() is not None
+        if legacy:
+            cur.execute('ALTER TABLE clips RENAME TO clips_v1')
+        cur.execute(SQL_CREATE_CLIPS)
+        cur.execute(SQL_CREATE_CLIPS_DAY)
+        cur.execute(SQL_CREATE_CLIPS_TS)
+        if legacy:
+            migrated = cur.execute(SQL_MIGRATE_CLIPS_V1).rowcount
+            cur.execute(SQL_REJECT_CLIPS_V1)
+            rejected = cur.execute('SELECT COUNT(*) FROM clips_rejected').fetchone()[0]
+            cur.execute('DROP TABLE clips_v1')
+            logger.info('Migrated ' + str(migrated) + ' legacy clips, rejected ' + str(rejected) +
+                        ' (kept in table clips_rejected).')
+        pass
+
+    def _upgrade_v3(self, cur):
+        """ json clip attributes with queryable motion statistics """
+        cur.execute(SQL_CONVERT_INFOS_V2)
+        for sql in SQL_ADD_STATISTICS:
+            cur.execute(sql)
+        pass
+
+    def _upgrade_v4(self, cur):
+        """ index for the clip pages of one camera """
+        cur.execute(SQL_CREATE_CLIPS_CAM)
+        pass
+
+    def _upgrade_v5(self, cur):
+        """ summary table per day and camera, filled from the existing clips """
+        for sql in SQL_CREATE_SUMMARY:
+            cur.execute(sql)
+        self.rebuild_summary()
+        pass
+
+    def _upgrade_v6(self, cur):
+        """ motion timelines, one blob per clip """
+        for sql in SQL_CREATE_TIMELINES:
+            cur.execute(sql)
+        pass
+
+    def _upgrade_v7(self, cur):
+        """ change counter of the clips, moved by every insert and delete """
+        for sql in SQL_CREATE_COUNTERS:
+            cur.execute(sql)
+        pass
+
+    def _upgrade_v8(self, cur):
+        """ summary trigger without a scan of the day for every deleted clip """
+        for sql in SQL_REPLACE_DELETE_TRIGGER:
+            cur.execute(sql)
         pass
 
+    # ----------
+    def _get_connection(self):
+        """ get the (reused) connection of the current thread """
+        return Connections.get(self.dbfile)
+
+    @contextmanager
+    def transaction(self):
+        """
+        run statements in one transaction: commit on success, rollback on error
+        nested calls join the transaction which is already open
+        """
+        con = self._get_connection()
+        cur = con.cursor()
+        if con.in_transaction:
+            yield cur # nested, outer transaction commits
+            return
+        cur.execute('BEGIN IMMEDIATE') # take the write lock now, no deadlocks on upgrade
+        try:
+            yield cur
+        except BaseException:
+            con.rollback()
+            raise
+        else:
+            con.commit()
+
     # ----------
     def _get_time_frame(self, fromhr, tohr):
         """ get timestamps now-fromhr and now-tohr  """
@@ -39,92 +335,147 @@ class Database:
         return fromdt, todt
 
     # ----------
-    def _get_rows(self, sql):
-        """ get all rows for the sql statement """
-        with sqlite3.connect(self.DBFILE) as con:
-            cur = con.cursor()
-            cur.execute(sql)
-            return cur.fetchall()
+    def _get_rows(self, sql, params=()):
+        """ get all rows for the sql statement (prepared once per connection) """
+        cur = self._get_connection().execute(sql, params)
+        return cur.fetchall()
+
+    # ----------
+    def get_change_counter(self, name='clips'):
+        """ get the change counter of table 'name', changes with every insert or delete """
+        rows = self._get_rows(SQL_GET_COUNTER, (name, ))
+        return rows[0]['value'] if len(rows) > 0 else 0
 
     # ----------
     def get_clips_per_day(self):
-        """ get the number of clips, by date, descending """
-        sql = """
-          SELECT ymd, COUNT(ymd) as clps
-          FROM (SELECT SUBSTR(CAST(ymdhms AS varchar(14)),1,8) as 'ymd' FROM clips) as days
-          GROUP BY ymd
-          ORDER BY ymd DESC
-        """
-        return self._get_rows(sql)
+        """ get the number of clips, duration, bytes and peak motion by day (yyyymmdd), descending """
+        return self._get_rows(SQL_CLIPS_PER_DAY)
 
     # ----------
-    def get_clips_for_day(self, idx):
-        """ get clip data for day 'idx' (yyyymmdd) """
-        sql = """
-        SELECT * FROM clips
-        WHERE SUBSTR(CAST(ymdhms AS varchar(14)),1,8) = '?'
-        ORDER BY ymdhms DESC
+    def rebuild_summary(self):
+        """ rebuild the summary table 'days' from all clips """
+        with self.transaction() as cur:
+            for sql in SQL_REBUILD_SUMMARY:
+                cur.execute(sql)
+        pass
+
+    # ----------
+    def get_clips_for_day(self, day):
+        """ get clip data for day (yyyymmdd) """
+        return self._get_rows(SQL_CLIPS_FOR_DAY, (int(day), ))
+
+    # ----------
+    def get_clips_page(self, day, cursor=None, size=PAGE_SIZE, cam=None, newer=False):
+        """
+        get one page of clips for day (yyyymmdd), newest first, using keyset cursors
+            cursor: (ts, cam) of the last clip shown, None for the first page
+            size: clips per page
+            cam: camera index, None for all cameras
+            newer: page towards newer clips (previous page), else towards older clips
+        returns rows, cursor of the newer page (or None), cursor of the older page (or None)
         """
-        sql = sql.replace("?", idx)
-        return self._get_rows(sql)
+        first = cursor is None
+        ts, cm = CURSOR_FIRST if first else (int(cursor[0]), int(cursor[1]))
+        if cam is None:
+            sql = SQL_CLIPS_PAGE_NEWER if newer else SQL_CLIPS_PAGE_OLDER
+            params = (int(day), ts, cm, int(size) + 1)
+        else:
+            sql = SQL_CAMERA_PAGE_NEWER if newer else SQL_CAMERA_PAGE_OLDER
+            params = (int(cam), int(day), ts, int(size) + 1)
+        rows = self._get_rows(sql, params)
+        more = len(rows) > size # one extra row: is there another page?
+        rows = rows[:size]
+        if newer:
+            rows.reverse() # always newest first
+            has_newer, has_older = more, True
+        else:
+            has_newer, has_older = not first, more
+        if len(rows) == 0:
+            return rows, None, None
+        newer_cursor = (rows[0]['ts'], rows[0]['cam']) if has_newer else None
+        older_cursor = (rows[-1]['ts'], rows[-1]['cam']) if has_older else None
+        return rows, newer_cursor, older_cursor
 
     # ----------
     def get_previous_clip_index(self, idx):
         """ get the clip before clip 'idx' """
-        sql = """
-        SELECT * FROM clips
-        WHERE ymdhms < ?
-        ORDER BY ymdhms DESC LIMIT 1
-        """
-        sql = sql.replace("?", idx)
-        rows = self._get_rows(sql)
+        rows = self._get_rows(SQL_PREVIOUS_CLIP, (int(idx), ))
         if len(rows) == 0:
-            return idx # no previous row
+            return int(idx) # no previous row
         else:
-            return rows[0][2] # previous in database
+            return rows[0]['id'] # previous in database
 
     # ----------
     def get_next_clip_index(self, idx):
         """ get the clip after clip 'idx' """
-        sql = """
-        SELECT * FROM clips
-        WHERE ymdhms > ?
-        ORDER BY ymdhms ASC LIMIT 1
-        """
-        sql = sql.replace("?", idx)
-        rows = self._get_rows(sql)
+        rows = self._get_rows(SQL_NEXT_CLIP, (int(idx), ))
         if len(rows) == 0:
-            return idx # no next row
+            return int(idx) # no next row
         else:
-            return rows[0][2] # next in database
+            return rows[0]['id'] # next in database
+
+    # ----------
+    def get_clips_by_motion(self, limit=10):
+        """ get the clips with the largest motion (peak pixel area), descending """
+        return self._get_rows(SQL_CLIPS_BY_MOTION, (int(limit), ))
+
+    # ----------
+    def get_clip(self, idx):
+        """ get the clip with the unique id 'idx' """
+        return self._get_rows(SQL_GET_CLIP, (int(idx), ))
+
+    # ----------
+    def get_clips_after(self, idx, limit=PAGE_SIZE):
+        """ get the clips registered after clip 'idx', ascending, e.g. for background jobs and live updates """
+        return self._get_rows(SQL_CLIPS_AFTER, (int(idx), int(limit)))
 
     # ----------
-    def get_clip(self, ymdhms):
-        """ get the clip with index ydmhms """
-        with sqlite3.connect(self.DBFILE) as con:
-            cur = con.cursor()
-            sql = "SELECT * FROM clips WHERE ymdhms = ?"
-            cur.execute(sql, (ymdhms, ))
-            return cur.fetchall()
+    def get_last_clip_index(self):
+        """ get the id of the most recently registered clip, 0 if there are none """
+        rows = self._get_rows(SQL_LAST_CLIP)
+        return rows[0]['id'] or 0
 
     # ----------
-    def set_clip(self, file, idx, ymdhms, infos):
+    def set_clip(self, file, cam, ts, infos, timeline=None):
         """ register clip in the database as soon as the file(clip) is closed
               filename: fully qualified filename and -path
-              ymdhms: date and time the clip was created (yyyymmddhhmmss)
-              infos: the clips attributes (dictionary)
+              cam: camera index
+              ts: date and time the clip was created (epoch seconds)
+              infos: the clips attributes (dictionary, stored as json)
+              timeline: the packed motion timeline (bytes) or None
+            returns the unique id of the clip
         """
-        with sqlite3.connect(self.DBFILE) as con:
-            cur = con.cursor()
-            # start transaction (implicit)
-            sql = "INSERT INTO clips (filename, idx, ymdhms, infos) VALUES (?,?,?,?)"
-            cur.execute(sql, (file, int(idx), ymdhms, str(infos)))
-            con.commit() # close transaction
-        pass
+        ts = int(ts)
+        tzoff = int(datetime.fromtimestamp(ts).astimezone().utcoffset().total_seconds())
+        with self.transaction() as cur:
+            cur.execute(SQL_SET_CLIP, (file, int(cam), ts, tzoff, json.dumps(infos)))
+            idx = cur.lastrowid
+            if timeline is not None:
+                cur.execute(SQL_SET_TIMELINE, (idx, timeline))
+            return idx
+
+    # ----------
+    def get_timeline(self, idx):
+        """ get the packed motion timeline (bytes) of clip 'idx', None if missing """
+        rows = self._get_rows(SQL_GET_TIMELINE, (int(idx), ))
+        if len(rows) == 0:
+            return None
+        return rows[0]['data']
+
+    # ----------
+    def delete_clips_before(self, ts):
+        """
+        delete the clips created before ts (epoch seconds), retention policy
+        the summary table is updated in the same transaction
+        returns the filenames of the deleted clips (files are deleted by the caller)
+        """
+        with self.transaction() as cur:
+            rows = cur.execute(SQL_DELETE_CLIPS_BEFORE, (int(ts), )).fetchall()
+            return [row['filename'] for row in rows]
 
 # ----------
 if __name__ == '__main__':
     print(
         'So sorry, the ' +
         os.path.basename(__file__) +
-        ' module does not run as a standalone.')
\ No newline at end of file
+        ' module does not run as a standalone.')
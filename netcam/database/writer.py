@@ -0,0 +1,178 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# asynchronous database writer for the netcam-recorder.py processes:
+# the recording threads only enqueue writes (never blocking), this thread
+# commits them in short batched transactions and retries a busy database.
+
+import os
+import collections
+import queue
+import sqlite3
+import threading
+import time
+from netcam.database import database
+
+BATCH_SIZE = 50    # [default] maximum writes per transaction
+BATCH_WAIT = 0.2   # [default] seconds waiting for more writes before committing
+RETRIES = 10       # [default] attempts per batch when the database is busy
+BACKOFF = 0.05     # [default] seconds, first backoff delay, doubled per attempt
+BACKOFF_MAX = 2.0  # [default] seconds, maximum backoff delay
+REQUEUE_MAX = 3    # [default] attempts per write before it is dropped
+REQUEUE_SIZE = 500 # [default] failed writes waiting for their next attempt
+
+
+class DatabaseWriter(threading.Thread):
+    """ queue of database writes (method name, arguments), committed in batches """
+
+    def __init__(self, lggr, dbfile=None):
+        """ initialize the writer thread """
+        threading.Thread.__init__(self)
+        self.name = 'DatabaseWriter'
+        self.logger = lggr
+        self.dbfile = dbfile
+        self.db = None # opened in the writer thread (per-thread connections)
+        self.queue = queue.Queue() # unbounded, put never blocks the recording loop
+        self._requeued = collections.deque() # failed writes, committed before the queue (writer thread only)
+        self.keep_running = True
+        self._lock = threading.Lock()
+        self._commits = 0 # number of committed transactions
+        self._writes = 0 # number of committed writes
+        self._failed = 0 # number of writes dropped after errors
+        self._latency = 0.0 # last commit latency (secs)
+        self._latency_sum = 0.0 # sum of the commit latencies (secs), running mean: sum / count
+        self._latency_count = 0 # number of measured commit latencies
+
+    def submit(self, method, *args):
+        """ enqueue the call of Database.<method>(*args), called from any thread """
+        self.queue.put_nowait((method, args, 0)) # 0: attempts
+        pass
+
+    def set_clip(self, *args):
+        """ enqueue Database.set_clip(file, cam, ts, infos) """
+        self.submit('set_clip', *args)
+        pass
+
+    def _get_batch(self):
+        """ get the next batch of writes, failed writes first, wait a short while for more writes """
+        batch = []
+        while len(self._requeued) > 0 and len(batch) < BATCH_SIZE:
+            batch.append(self._requeued.popleft())
+        if len(batch) == 0:
+            try:
+                batch = [self.queue.get(timeout=BATCH_WAIT)]
+            except queue.Empty:
+                return []
+        deadline = time.time() + BATCH_WAIT
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self.queue.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _is_busy(self, err):
+        """ is the error a locked/busy database (SQLITE_BUSY)? """
+        msg = str(err).lower()
+        return isinstance(err, sqlite3.OperationalError) and ('locked' in msg or 'busy' in msg)
+
+    def _execute(self, batch):
+        """ run all writes of the batch in one transaction """
+        with self.db.transaction():
+            for method, args, _ in batch:
+                getattr(self.db, method)(*args)
+        pass
+
+    def _commit(self, batch):
+        """ commit the batch, retry with backoff while the database is busy """
+        delay = BACKOFF
+        for attempt in range(RETRIES):
+            t0 = time.perf_counter()
+            try:
+                self._execute(batch)
+                self._set_metrics(len(batch), time.perf_counter() - t0)
+                return True
+            except sqlite3.Error as err:
+                if not self._is_busy(err):
+                    break # not recoverable by waiting
+                self.logger.warning('Database busy, retry '+str(attempt+1)+' in '+str(round(delay, 2))+' secs.')
+                time.sleep(delay)
+                delay = min(delay * 2, BACKOFF_MAX)
+        # failed batch: write one by one, put the bad writes back
+        for write in batch:
+            try:
+                self._execute([write])
+                self._set_metrics(1, 0.0)
+            except sqlite3.Error as err:
+                self._requeue(write, err)
+        return False
+
+    def _requeue(self, write, err):
+        """
+        put a write which failed on a busy database back for a later batch, drop it after REQUEUE_MAX
+        attempts; other errors (e.g. IntegrityError, bad data) fail again, the write is dropped at once
+        """
+        method, args, attempts = write
+        if self._is_busy(err) and attempts + 1 < REQUEUE_MAX and len(self._requeued) < REQUEUE_SIZE:
+            self._requeued.append((method, args, attempts + 1))
+            self.logger.warning('Database write '+method+' failed, retry later: '+str(err))
+        else:
+            with self._lock:
+                self._failed += 1
+            name = str(args[0]) if len(args) > 0 else '' # set_clip: filename of the clip
+            self.logger.error('Database write '+method+' dropped: '+name+', '+str(err))
+        pass
+
+    def _set_metrics(self, writes, latency):
+        """ update the commit metrics """
+        with self._lock:
+            self._commits += 1
+            self._writes += writes
+            if latency > 0.0:
+                self._latency = latency
+                self._latency_sum += latency
+                self._latency_count += 1
+        pass
+
+    def get_queue_depth(self):
+        """ get the number of pending writes """
+        return self.queue.qsize() + len(self._requeued)
+
+    def get_commit_latency(self):
+        """ get the last and average (running mean since the start) commit latency in msecs """
+        with self._lock:
+            avg = self._latency_sum / self._latency_count if self._latency_count > 0 else 0.0
+            return round(self._latency * 1000, 1), round(avg * 1000, 1)
+
+    def get_metrics(self):
+        """ get all metrics of the writer (dictionary) """
+        last, avg = self.get_commit_latency()
+        with self._lock:
+            return {"db_que": self.get_queue_depth(),
+                    "db_lat": last,
+                    "db_lat_avg": avg,
+                    "db_cmt": self._commits,
+                    "db_wrt": self._writes,
+                    "db_err": self._failed}
+
+    def run(self):
+        """ commit the queued writes until terminated, then flush the queue """
+        self.db = database.Database(self.dbfile)
+        self.logger.info(">>> Started database writer in " + threading.current_thread().name)
+        while self.keep_running or not self.queue.empty() or len(self._requeued) > 0:
+            batch = self._get_batch()
+            if len(batch) > 0:
+                self._commit(batch)
+        self.logger.info("<<< Stopped database writer in " + threading.current_thread().name)
+        pass
+
+    def terminate_thread(self):
+        """ stop running this thread after flushing all pending writes """
+        self.keep_running = False
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
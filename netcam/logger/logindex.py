@@ -0,0 +1,172 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the logs page of the Flask application: the log file is indexed incrementally
+# (byte offset, level and logger of each record, only the bytes appended since the last request are
+# read), pages of records are then read with seeks, from the newest page back, filtered by level or camera.
+
+import array
+import bisect
+import os
+import threading
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL') # see logging, format of Config.set_logging
+UNKNOWN = 255        # level code of records without a level, e.g. the start of a truncated file
+SEPARATOR = b' | '   # between asctime, levelname, name and message
+CHUNK_SIZE = 1024**2 # [default] bytes, read per step while indexing
+RECORDER = 'recorder.' # [default] logger name prefix of the recorders, followed by the camera index
+
+
+class LogIndex:
+    """ index of the records of one log file, extended as the file grows """
+
+    def __init__(self):
+        """ initialize an empty index """
+        self._lock = threading.Lock()
+        self._clear(None)
+
+    def _clear(self, path):
+        """ forget the index, e.g. new log file or truncated file """
+        self.path = path
+        self._ident = None # (device, inode) of the indexed file
+        self._end = 0 # indexed bytes, up to the end of the last complete line
+        self._offsets = array.array('Q') # byte offset of each record
+        self._levels = bytearray() # level code of each record
+        self._loggers = array.array('H') # logger code of each record
+        self._names = [] # logger names, index: logger code
+        self._codes = {} # logger name: logger code
+        self._by_level = {} # level code: record numbers, ascending
+        self._by_logger = {} # logger code: record numbers, ascending
+        pass
+
+    def _get_logger_code(self, name):
+        """ get the code of logger 'name', new loggers are added """
+        code = self._codes.get(name)
+        if code is None:
+            code = len(self._names)
+            self._names.append(name)
+            self._codes[name] = code
+        return code
+
+    def _add_record(self, offset, level, name):
+        """ add one record to the index """
+        number = len(self._offsets)
+        logger = self._get_logger_code(name)
+        self._offsets.append(offset)
+        self._levels.append(level)
+        self._loggers.append(logger)
+        self._by_level.setdefault(level, array.array('L')).append(number)
+        self._by_logger.setdefault(logger, array.array('L')).append(number)
+        pass
+
+    def _index_lines(self, data, offset):
+        """ index the complete lines of 'data' (bytes read at 'offset'), lines without a level continue a record """
+        start = 0
+        while start < len(data):
+            stop = data.index(b'\n', start) + 1
+            chnks = data[start:stop].split(SEPARATOR, 3)
+            level = chnks[1].decode('ascii', 'replace') if len(chnks) == 4 else None
+            if level in LEVELS:
+                self._add_record(offset + start, LEVELS.index(level), chnks[2].decode('utf-8', 'replace'))
+            elif len(self._offsets) == 0:
+                self._add_record(offset + start, UNKNOWN, '') # no record to continue
+            start = stop # continuation line, e.g. a traceback
+        pass
+
+    def _update(self, path):
+        """ index the lines appended to log file 'path' since the last update """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._clear(path) # e.g. no log file yet
+            return
+        if path != self.path or (stat.st_dev, stat.st_ino) != self._ident or stat.st_size < self._end:
+            self._clear(path) # new or truncated (rewritten) log file
+            self._ident = (stat.st_dev, stat.st_ino)
+        if stat.st_size == self._end:
+            return # nothing appended
+        with open(path, 'rb') as fp:
+            fp.seek(self._end)
+            while True:
+                data = fp.read(CHUNK_SIZE)
+                if len(data) == CHUNK_SIZE and b'\n' not in data:
+                    data += fp.readline() # very long line
+                last = data.rfind(b'\n')
+                if last < 0:
+                    break # incomplete line, indexed with the next update
+                self._index_lines(data[:last + 1], self._end)
+                self._end += last + 1
+                if last + 1 < len(data):
+                    fp.seek(self._end) # read the incomplete line again
+        pass
+
+    # ----------
+    def _get_numbers(self, level, camera):
+        """ get the (ascending) record numbers matching the filter, None: all records """
+        numbers = None
+        if level is not None:
+            numbers = self._by_level.get(LEVELS.index(level), array.array('L'))
+        if camera is not None:
+            logger = self._codes.get(RECORDER + str(camera))
+            cameras = self._by_logger.get(logger, array.array('L'))
+            if numbers is None:
+                numbers = cameras
+            else: # both: select from the shorter list
+                code = LEVELS.index(level)
+                numbers = [number for number in min(numbers, cameras, key=len)
+                           if self._levels[number] == code and self._loggers[number] == logger]
+        return numbers
+
+    def _read_records(self, numbers):
+        """ read the records 'numbers' (ascending) with seeks, one string per record """
+        records = []
+        with open(self.path, 'rb') as fp:
+            for number in numbers:
+                start = self._offsets[number]
+                stop = self._offsets[number + 1] if number + 1 < len(self._offsets) else self._end
+                fp.seek(start)
+                records.append(fp.read(stop - start).decode('utf-8', 'replace').rstrip('\n'))
+        return records
+
+    def get_page(self, path, size, before=None, after=None, level=None, camera=None):
+        """
+        get one page of records of log file 'path', filtered by 'level' (e.g. 'ERROR') and 'camera'
+        (logger recorder.N), and the cursors of the neighbour pages (record numbers, None if no page)
+            before: the page before this record number, after: the page after it, none: newest page
+        returns: records (ascending), older cursor, newer cursor
+        """
+        with self._lock:
+            self._update(path)
+            numbers = self._get_numbers(level, camera)
+            total = len(self._offsets) if numbers is None else len(numbers)
+            def number(n):
+                return n if numbers is None else numbers[n]
+            def position(cursor):
+                return cursor if numbers is None else bisect.bisect_left(numbers, cursor)
+            if after is not None:
+                first = position(after + 1)
+                last = min(first + size, total)
+            else:
+                last = total if before is None else min(position(before), total)
+                first = max(last - size, 0)
+            page = [number(n) for n in range(first, last)]
+            if len(page) == 0:
+                return [], None, None
+            records = self._read_records(page)
+            older = page[0] if first > 0 else None
+            newer = page[-1] if last < total else None
+        return records, older, newer
+
+    def get_stats(self):
+        """ get the index statistics (dictionary) """
+        with self._lock:
+            return {"path": self.path,
+                    "records": len(self._offsets),
+                    "bytes": self._end,
+                    "loggers": len(self._names)}
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
@@ -0,0 +1,304 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the structured log store of the Flask application: all log records (app and
+# recorders) are also written to sqlite segment files (time, level, logger and message of each
+# record, indexed by time). A segment is closed after SEGMENT_SECONDS or SEGMENT_BYTES, closed
+# segments are compressed (messages packed into zlib blocks, the indexed columns stay as they
+# are) and deleted after RETENTION_DAYS. Queries by time range, level and logger only open the
+# segments of the time range and only decompress the blocks of the returned records.
+
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from logger import shipper
+
+STORE_FOLDER = 'logs/store/'  # [default] below the standard path
+SEGMENT_SECONDS = 86400       # [default] seconds, a new segment at least once per day
+SEGMENT_BYTES = 64 * 1024**2  # [default] bytes, a new segment when the open segment is larger
+RETENTION_DAYS = 31           # [default] days, older segments are deleted
+BLOCK_RECORDS = 256           # [default] messages per compressed block
+BATCH_SIZE = 1000             # [default] records per transaction
+FLUSH_INTERVAL = 1.0          # [default] seconds, upper limit for records waiting in the queue
+QUERY_LIMIT = 500             # [default] records per query
+SEGMENT_NAME = re.compile(r'^segment-(\d+)\.db$') # first timestamp of the segment (epoch seconds)
+
+SQL_CREATE_SEGMENT = [
+    """CREATE TABLE IF NOT EXISTS loggers (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE)""",
+    """CREATE TABLE IF NOT EXISTS records (
+        ts REAL NOT NULL,
+        level INTEGER NOT NULL,
+        logger INTEGER NOT NULL,
+        msg TEXT,
+        block INTEGER,
+        pos INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS blocks (
+        id INTEGER PRIMARY KEY,
+        data BLOB NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS records_ts ON records (ts)",
+    "CREATE INDEX IF NOT EXISTS records_level ON records (level, ts)",
+    "CREATE INDEX IF NOT EXISTS records_logger ON records (logger, ts)"]
+SQL_INSERT_LOGGER = "INSERT OR IGNORE INTO loggers (name) VALUES (?)"
+SQL_GET_LOGGERS = "SELECT id, name FROM loggers"
+SQL_INSERT_RECORD = "INSERT INTO records (ts, level, logger, msg) VALUES (?,?,?,?)"
+SQL_GET_MESSAGES = "SELECT rowid, msg FROM records WHERE msg IS NOT NULL ORDER BY rowid"
+SQL_INSERT_BLOCK = "INSERT INTO blocks (data) VALUES (?)"
+SQL_SET_BLOCK = "UPDATE records SET msg = NULL, block = ?, pos = ? WHERE rowid = ?"
+SQL_GET_BLOCK = "SELECT data FROM blocks WHERE id = ?"
+COMPRESSED = 1 # user_version of a compressed segment
+
+
+def get_level_codes(level):
+    """ get the level numbers of 'level' and above, e.g. 'WARNING': 30, 40, 50 """
+    minimum = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    if not isinstance(minimum, int):
+        raise ValueError('Unknown log level: ' + str(level))
+    return [code for code in (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)
+            if code >= minimum]
+
+
+class LogStore(threading.Thread):
+    """ write the log records of the application into rotated sqlite segments """
+
+    def __init__(self, folder, lggr):
+        """ initialize the store in 'folder', compress the closed segments of a previous run """
+        threading.Thread.__init__(self)
+        self.name = 'LogStore'
+        self.daemon = True
+        self.folder = folder
+        self.logger = lggr.getChild('logstore') # errors of the store, not written to the store
+        os.makedirs(folder, exist_ok=True)
+        self.queue = queue.Queue(maxsize=shipper.QUEUE_SIZE)
+        self.handler = shipper.DroppingQueueHandler(self.queue) # log calls never wait for the disk
+        self.handler.addFilter(self._is_storable)
+        self._con = None # connection of the open segment (store thread)
+        self._path = None
+        self._opened = 0.0 # first timestamp of the open segment
+        self._loggers = {} # logger name: id, open segment
+        self.written = 0
+        self.rotations = 0
+        self.keep_running = True
+
+    def _is_storable(self, record):
+        """ filter of the handler: a failing store would write its own errors (again and again) """
+        return record.name != self.logger.name
+
+    def get_handler(self):
+        """ get the handler for the loggers of this process (root logger) """
+        return self.handler
+
+    # ----------
+    def get_segments(self):
+        """ get the segments as a list of (first timestamp, path), ascending """
+        segments = []
+        for name in os.listdir(self.folder):
+            match = SEGMENT_NAME.match(name)
+            if match:
+                segments.append((int(match.group(1)), os.path.join(self.folder, name)))
+        return sorted(segments)
+
+    def _open_segment(self, ts):
+        """ open a new segment, starting at 'ts' """
+        self._path = os.path.join(self.folder, 'segment-' + str(int(ts)) + '.db')
+        self._opened = int(ts)
+        self._con = sqlite3.connect(self._path, check_same_thread=False)
+        self._con.execute('PRAGMA journal_mode = WAL') # concurrent queries
+        self._con.execute('PRAGMA synchronous = NORMAL')
+        with self._con:
+            for sql in SQL_CREATE_SEGMENT:
+                self._con.execute(sql)
+        self._loggers = {name: idx for idx, name in self._con.execute(SQL_GET_LOGGERS)}
+        pass
+
+    def _close_segment(self, path):
+        """ close segment 'path' (open or left by a previous run), compress it in the background """
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+        thrd = threading.Thread(target=self._compress_segment, args=(path, ), daemon=True)
+        thrd.name = 'LogStoreCompress'
+        thrd.start()
+        pass
+
+    def _compress_segment(self, path):
+        """ pack the messages of a closed segment into zlib blocks, keep the indexed columns """
+        try:
+            con = sqlite3.connect(path)
+            try:
+                if con.execute('PRAGMA user_version').fetchone()[0] == COMPRESSED:
+                    return
+                with con:
+                    rows = con.execute(SQL_GET_MESSAGES).fetchall()
+                    for first in range(0, len(rows), BLOCK_RECORDS):
+                        chunk = rows[first:first + BLOCK_RECORDS]
+                        data = zlib.compress(json.dumps([msg for rowid, msg in chunk]).encode('utf-8'), 9)
+                        block = con.execute(SQL_INSERT_BLOCK, (data, )).lastrowid
+                        con.executemany(SQL_SET_BLOCK, [(block, pos, rowid) for pos, (rowid, msg) in enumerate(chunk)])
+                    con.execute('PRAGMA user_version = ' + str(COMPRESSED))
+                con.execute('PRAGMA journal_mode = DELETE') # closed: no wal file
+                con.execute('VACUUM') # give back the space of the messages
+            finally:
+                con.close()
+        except sqlite3.Error as err:
+            self.logger.error('Log store cannot compress '+os.path.basename(path)+': '+str(err))
+        pass
+
+    def _delete_segments(self, now):
+        """ delete the segments older than the retention period (their successor started before) """
+        segments = self.get_segments()
+        for n in range(len(segments) - 1):
+            if segments[n + 1][0] < now - RETENTION_DAYS * 86400:
+                for ext in ('', '-wal', '-shm'):
+                    try:
+                        os.remove(segments[n][1] + ext)
+                    except OSError:
+                        pass # missing, or still open by a query (removed next time)
+        pass
+
+    def _rotate(self, now):
+        """ start a new segment when the open one is too old or too large """
+        if self._con is not None:
+            size = os.path.getsize(self._path) + (os.path.getsize(self._path + '-wal')
+                                                  if os.path.exists(self._path + '-wal') else 0)
+            if now - self._opened < SEGMENT_SECONDS and size < SEGMENT_BYTES:
+                return
+            self._close_segment(self._path)
+            self.rotations += 1
+        segments = self.get_segments()
+        if self.rotations == 0 and segments and now - segments[-1][0] < SEGMENT_SECONDS:
+            self._open_segment(segments[-1][0]) # continue the segment of a previous run
+        else:
+            if self.rotations == 0 and segments:
+                self._close_segment(segments[-1][1]) # last segment of a previous run
+            self._open_segment(max(now, segments[-1][0] + 1) if segments else now)
+        self._delete_segments(now)
+        pass
+
+    def _add_loggers(self, names):
+        """ register new logger names in the open segment, committed before the records that use them """
+        names = [name for name in set(names) if name not in self._loggers]
+        if len(names) > 0:
+            with self._con:
+                self._con.executemany(SQL_INSERT_LOGGER, [(name, ) for name in names])
+            self._loggers = {name: idx for idx, name in self._con.execute(SQL_GET_LOGGERS)}
+        pass
+
+    def _write(self, records):
+        """ write one batch of records in one transaction """
+        self._rotate(time.time())
+        self._add_loggers([record.name for record in records])
+        with self._con:
+            self._con.executemany(SQL_INSERT_RECORD, [
+                (record.created, record.levelno, self._loggers[record.name], record.msg)
+                for record in records])
+        self.written += len(records)
+        pass
+
+    def run(self):
+        """ write batches until terminated, then write the remaining records """
+        for first, path in self.get_segments()[:-1]:
+            self._compress_segment(path) # closed by a previous run
+        while self.keep_running or not self.queue.empty():
+            records = shipper.get_batch(self.queue, BATCH_SIZE, FLUSH_INTERVAL)
+            if len(records) == 0:
+                continue
+            try:
+                self._write(records)
+            except sqlite3.Error as err: # e.g. disk full, the records are lost
+                self.handler.dropped += len(records)
+                self.logger.error('Log store cannot write '+str(len(records))+' records: '+str(err))
+        if self._con is not None:
+            self._con.close()
+        pass
+
+    # ----------
+    def _query_segment(self, path, since, until, levels, logger, limit):
+        """ query one segment, records newest first """
+        con = sqlite3.connect('file:' + path + '?mode=ro', uri=True, check_same_thread=False)
+        try:
+            loggers = dict(con.execute(SQL_GET_LOGGERS).fetchall())
+            sql = 'SELECT ts, level, logger, msg, block, pos FROM records WHERE ts >= ? AND ts < ?'
+            args = [since, until]
+            if levels is not None:
+                sql += ' AND level IN (' + ','.join(['?'] * len(levels)) + ')'
+                args.extend(levels)
+            if logger is not None:
+                ids = [idx for idx, name in loggers.items() if name == logger]
+                if len(ids) == 0:
+                    return []
+                sql += ' AND logger = ?'
+                args.append(ids[0])
+            sql += ' ORDER BY ts DESC LIMIT ?'
+            args.append(limit)
+            rows = con.execute(sql, args).fetchall()
+            blocks = {} # decompressed blocks of this query
+            records = []
+            for ts, level, idx, msg, block, pos in rows:
+                if msg is None and block is not None:
+                    if block not in blocks:
+                        data = con.execute(SQL_GET_BLOCK, (block, )).fetchone()[0]
+                        blocks[block] = json.loads(zlib.decompress(data))
+                    msg = blocks[block][pos]
+                records.append({"ts": ts, "level": logging.getLevelName(level),
+                                "logger": loggers.get(idx), "msg": msg})
+            return records
+        finally:
+            con.close()
+
+    def query(self, since=None, until=None, level=None, logger=None, limit=QUERY_LIMIT):
+        """
+        get the log records between 'since' and 'until' (epoch seconds, None: unlimited), newest first
+            level: minimum level, e.g. 'WARNING' (warnings, errors and critical records)
+            logger: logger name, e.g. 'recorder.2'
+        returns: list of dictionaries (ts, level, logger, msg), at most 'limit' records
+        """
+        since = since if since is not None else 0.0
+        until = until if until is not None else float('inf')
+        levels = get_level_codes(level) if level is not None else None
+        segments = self.get_segments()
+        records = []
+        for n in range(len(segments) - 1, -1, -1): # newest segment first
+            first, path = segments[n]
+            if first >= until:
+                continue
+            if n + 1 < len(segments) and segments[n + 1][0] < since:
+                break # this and older segments end before 'since'
+            try:
+                records.extend(self._query_segment(path, since, until, levels, logger, limit - len(records)))
+            except sqlite3.Error:
+                continue # e.g. deleted meanwhile
+            if len(records) >= limit:
+                break
+        return records
+
+    def get_stats(self):
+        """ get the store statistics (dictionary) """
+        segments = self.get_segments()
+        return {"segments": len(segments),
+                "bytes": sum([os.path.getsize(path) for first, path in segments if os.path.exists(path)]),
+                "written": self.written,
+                "dropped": self.handler.dropped,
+                "rotations": self.rotations}
+
+    def terminate_thread(self):
+        """ stop running this thread (after the remaining records are written) """
+        self.keep_running = False
+        try:
+            self.queue.put_nowait(None) # wake up
+        except queue.Full:
+            pass # wakes up after the timeout
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
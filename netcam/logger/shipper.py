@@ -0,0 +1,154 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+#
+# class modul for the logging of the recorder processes: log calls only put the record into a
+# bounded queue (full queue: the record is dropped and counted), a shipper thread sends the queued
+# records in batches over one persistent connection to the log receiver of the Flask application
+# (logger/tcpserver.py, same frames as logging.handlers.SocketHandler) and writes them to the console.
+
+import logging
+import logging.handlers
+import os
+import pickle
+import queue
+import socket
+import struct
+import threading
+import time
+
+QUEUE_SIZE = 10000     # [default] records waiting for the shipper, more are dropped
+BATCH_SIZE = 500       # [default] records per send
+CONNECT_TIMEOUT = 1.0  # [default] seconds
+SEND_TIMEOUT = 5.0     # [default] seconds, a blocked receiver drops the connection
+RECONNECT_DELAY = 5.0  # [default] seconds, before reconnecting to the Flask application
+
+
+def get_batch(que, size, timeout):
+    """ wait for the next record, then take the queued records without waiting (one batch) """
+    records = []
+    try:
+        record = que.get(timeout=timeout)
+        while record is not None:
+            records.append(record)
+            if len(records) >= size:
+                break
+            record = que.get_nowait()
+    except queue.Empty:
+        pass
+    return records
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ put records into a bounded queue, never blocks: records are dropped (and counted) when full """
+
+    def __init__(self, que):
+        """ initialize the handler for queue 'que' """
+        logging.handlers.QueueHandler.__init__(self, que)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """ put the (prepared) record into the queue, drop it when the queue is full """
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        pass
+
+
+def get_frame(record):
+    """ get the frame of a prepared record: 4-byte length, followed by the record in pickle format """
+    d = dict(record.__dict__)
+    d['args'] = None # merged into msg by QueueHandler.prepare
+    d['exc_info'] = None # traceback text merged into msg
+    d.pop('message', None) # redundant with 'msg'
+    s = pickle.dumps(d, pickle.HIGHEST_PROTOCOL)
+    return struct.pack('>L', len(s)) + s
+
+
+class LogShipper(threading.Thread):
+    """ send the queued log records in batches to the Flask application """
+
+    def __init__(self, host='localhost', port=logging.handlers.DEFAULT_TCP_LOGGING_PORT, handlers=()):
+        """
+        initialize the shipper
+            handlers: local handlers (e.g. console), called by the shipper thread for every record
+        """
+        threading.Thread.__init__(self)
+        self.name = 'LogShipper'
+        self.daemon = True
+        self.address = (host, port)
+        self.handlers = list(handlers)
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.handler = DroppingQueueHandler(self.queue)
+        self._sock = None
+        self._retry = 0.0 # time of the next connection attempt
+        self.shipped = 0
+        self.lost = 0 # records not sent, e.g. Flask application not running
+        self.batches = 0
+        self.keep_running = True
+
+    def get_handler(self):
+        """ get the handler for the loggers of this process (root logger) """
+        return self.handler
+
+    def _connect(self):
+        """ open the persistent connection, None if the application is not reachable """
+        if self._sock is None and time.time() >= self._retry:
+            try:
+                self._sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+                self._sock.settimeout(SEND_TIMEOUT)
+            except OSError:
+                self._retry = time.time() + RECONNECT_DELAY
+        return self._sock
+
+    def _send(self, records):
+        """ send one batch of records, drop it when the application is not reachable """
+        if self._connect() is None:
+            self.lost += len(records)
+            return
+        try:
+            self._sock.sendall(b''.join([get_frame(record) for record in records]))
+            self.shipped += len(records)
+            self.batches += 1
+        except (OSError, pickle.PicklingError, TypeError):
+            self._sock.close()
+            self._sock = None
+            self._retry = time.time() + RECONNECT_DELAY
+            self.lost += len(records)
+        pass
+
+    def run(self):
+        """ ship batches until terminated, then ship the remaining records """
+        while self.keep_running or not self.queue.empty():
+            records = get_batch(self.queue, BATCH_SIZE, 1.0)
+            if len(records) == 0:
+                continue
+            for hndlr in self.handlers:
+                for record in records:
+                    if record.levelno >= hndlr.level:
+                        hndlr.handle(record)
+            self._send(records)
+        if self._sock is not None:
+            self._sock.close()
+        pass
+
+    def get_metrics(self):
+        """ get the logging metrics (dictionary): shipped, dropped (queue full or not sent), queue depth """
+        return {"log_shp": self.shipped,
+                "log_drp": self.handler.dropped + self.lost,
+                "log_que": self.queue.qsize()}
+
+    def terminate_thread(self):
+        """ stop running this thread (after the remaining records are shipped) """
+        self.keep_running = False
+        try:
+            self.queue.put_nowait(None) # wake up
+        except queue.Full:
+            pass # wakes up after the timeout
+        pass
+
+
+if __name__ == '__main__':
+    print(
+        'So sorry, the ' +
+        os.path.basename(__file__) +
+        ' module does not run as a standalone.')
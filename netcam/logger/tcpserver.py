@@ -6,81 +6,157 @@
 import pickle
 import logging
 import logging.handlers
-import socketserver
+import selectors
+import socket
 import struct
 import threading
 import os
 
-class LogRecordStreamHandler(socketserver.StreamRequestHandler):
+BUFFER_SIZE = 65536    # [default] bytes, initial receive buffer per connection, grows for larger records
+SELECT_TIMEOUT = 1.0   # [default] seconds, checks the abort flag in between
+HEADER = struct.Struct('>L') # 4-byte length, followed by the LogRecord in pickle format
+
+
+class LogRecordConnection:
     """
-    Handler for a streaming logging request.
-    This basically logs the record using whatever logging policy is
-    configured locally at the receiver.
+    one recorder connection: frames are received into a reusable buffer (recv_into),
+    complete frames are unpickled in place, a partial frame stays at the start of the buffer
     """
-    def handle(self):
+    def __init__(self, sock):
+        """ initialise the connection """
+        self.sock = sock
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.filled = 0 # received bytes in the buffer
+
+    def _grow(self, size):
+        """ enlarge the buffer for a frame of 'size' bytes (header included) """
+        length = len(self.buffer)
+        while length < size:
+            length *= 2
+        self.view.release() # a bytearray with exported views cannot be resized
+        self.buffer.extend(bytes(length - len(self.buffer)))
+        self.view = memoryview(self.buffer)
+        pass
+
+    def receive(self):
         """
-        Handle multiple requests - each expected to be a 4-byte length,
-        followed by the LogRecord in pickle format. Logs the record
-        according to whatever policy is configured locally.
+        receive the available bytes, return the complete records (dictionaries)
+        returns None when the recorder has closed the connection
         """
-        while True:
-            try:
-                chunk = self.connection.recv(4)
-            except ConnectionResetError:
-                # connection reset by peer
-                break # try again (silent)
-            if len(chunk) < 4:
-                break # try again (silent)
-            slen = struct.unpack('>L', chunk)[0]
-            chunk = self.connection.recv(slen)
-            while len(chunk) < slen:
-                chunk = chunk + self.connection.recv(slen - len(chunk))
-            obj = self.unPickle(chunk)
-            record = logging.makeLogRecord(obj)
-            self.handleLogRecord(record)
-
-    def unPickle(self, data):
-        return pickle.loads(data)
-
-    def handleLogRecord(self, record):
-        # if a name is specified, we use the named logger rather than the one
-        # implied by the record.
-        if self.server.logname is not None:
-            name = self.server.logname
-        else:
-            name = record.name
-        logger = logging.getLogger(name)
-        # N.B. EVERY record gets logged. This is because Logger.handle
-        # is normally called AFTER logger-level filtering. If you want
-        # to do filtering, do it at the client end to save wasting
-        # cycles and network bandwidth!
-        logger.handle(record)
-
-
-class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
+        try:
+            count = self.sock.recv_into(self.view[self.filled:])
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            return None # e.g. connection reset by peer
+        if count == 0:
+            return None
+        self.filled += count
+        objs = []
+        pos = 0
+        while self.filled - pos >= HEADER.size:
+            slen = HEADER.unpack_from(self.buffer, pos)[0]
+            end = pos + HEADER.size + slen
+            if end > self.filled:
+                break # partial frame
+            objs.append(pickle.loads(self.view[pos + HEADER.size:end]))
+            pos = end
+        if pos > 0: # move the partial frame to the start, same length assignment (no reallocation)
+            self.buffer[:self.filled - pos] = self.buffer[pos:self.filled]
+            self.filled -= pos
+        if self.filled >= HEADER.size:
+            size = HEADER.size + HEADER.unpack_from(self.buffer)[0]
+            if size > len(self.buffer):
+                self._grow(size) # record larger than the buffer
+        return objs
+
+    def close(self):
+        """ close the connection """
+        self.view.release()
+        self.sock.close()
+        pass
+
+
+class LogRecordReceiver:
     """
-    Simple TCP socket-based logging receiver suitable for testing.
+    receive the logging records of all recorders in one thread: one selector for the listening
+    socket and all connections, the records of each read are handled as one batch
     """
-    allow_reuse_address = True
-
     def __init__(self, host='localhost',
-                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT,
-                 handler=LogRecordStreamHandler):
-        socketserver.ThreadingTCPServer.__init__(self, (host, port), handler)
+                 port=logging.handlers.DEFAULT_TCP_LOGGING_PORT):
+        """ initialise the listening socket """
+        self.socket = socket.create_server((host, port))
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
         self.abort = 0
-        self.timeout = 1
+        self.timeout = SELECT_TIMEOUT
         self.logname = None
+        self.records = 0
+        self.batches = 0
+        self.errors = 0 # records which could not be unpickled
+
+    def _accept(self):
+        """ accept a new recorder connection """
+        try:
+            sock, addr = self.socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, LogRecordConnection(sock))
+        pass
+
+    def _receive(self, conn):
+        """ receive from one connection, handle the complete records """
+        try:
+            objs = conn.receive()
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError):
+            self.errors += 1
+            objs = None # out of step, drop the connection (the recorder reconnects)
+        if objs is None:
+            self.selector.unregister(conn.sock)
+            conn.close()
+        elif len(objs) > 0:
+            self.handleLogRecords([logging.makeLogRecord(obj) for obj in objs])
+        pass
+
+    def handleLogRecords(self, records):
+        """
+        log a batch of records using whatever logging policy is configured locally at the receiver
+        N.B. EVERY record gets logged. This is because Logger.handle is normally called AFTER
+        logger-level filtering. If you want to do filtering, do it at the client end to save
+        wasting cycles and network bandwidth!
+        """
+        for record in records:
+            # if a name is specified, we use the named logger rather than the one implied by the record.
+            name = self.logname if self.logname is not None else record.name
+            logging.getLogger(name).handle(record)
+        self.records += len(records)
+        self.batches += 1
+        pass
 
     def serve_until_stopped(self):
-        import select
-        abort = 0
-        while not abort:
-            rd, wr, ex = select.select([self.socket.fileno()],
-                                       [], [],
-                                       self.timeout)
-            if rd:
-                self.handle_request()
-            abort = self.abort
+        """ wait for connections and records until aborted """
+        while not self.abort:
+            for key, events in self.selector.select(self.timeout):
+                if key.data is None:
+                    self._accept()
+                else:
+                    self._receive(key.data)
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                key.data.close()
+        self.selector.close()
+        self.socket.close()
+        pass
+
+    def get_stats(self):
+        """ get the receiver statistics (dictionary) """
+        return {"connections": len(self.selector.get_map()) - 1,
+                "records": self.records,
+                "batches": self.batches,
+                "errors": self.errors}
 
 
 class Tcpserver(threading.Thread):
@@ -88,10 +164,12 @@ class Tcpserver(threading.Thread):
     handle the logging requests from all netcam-recorder.py processes
     this uses the same logging format as defined in netcam-app.py
     """
-    def __init__(self):
-        """ initialise the thread"""
+    def __init__(self, host='localhost', port=logging.handlers.DEFAULT_TCP_LOGGING_PORT, logname=None):
+        """ initialise the thread, logname: log all records with this logger (None: the recorder's logger) """
         threading.Thread.__init__(self) # init super class
-        self._tcpserver = LogRecordSocketReceiver()
+        self.name = 'Tcpserver'
+        self._tcpserver = LogRecordReceiver(host, port)
+        self._tcpserver.logname = logname
         pass # continue
 
     def run(self):
@@ -99,6 +177,10 @@ class Tcpserver(threading.Thread):
         self._tcpserver.serve_until_stopped()
         pass # continue here after abort = 1
 
+    def get_stats(self):
+        """ get the receiver statistics (dictionary) """
+        return self._tcpserver.get_stats()
+
     def terminate_thread(self):
         """ stop running this thread, called when main thread terminates """
         self._tcpserver.abort = 1
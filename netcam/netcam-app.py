@@ -5,8 +5,8 @@ import os.path
 # - Based upon some cheap ANNKE IP cameras (AN-I91BL0102),
 #   which have two video streams: main(8MP) and sub(640x480).
 # This Flask App uses long-running-child-processes (netcam-recorder.py)
-# - managed with: tbd
-# - IPC with:     tbd
+# - managed with: cameras/supervisor.py (start, heartbeat, restart with backoff)
+# - IPC with:     multiprocessing.connection (status, telemetry), logging sockets
 
 from flask import Flask
 from flask import render_template
@@ -17,18 +17,33 @@ from flask import Response
 from flask import session
 from flask import request
 from flask import send_file
+from flask import abort
+from flask import jsonify
+from flask import redirect
 from cameras import config
+from cameras import timeline
+from cameras import broadcast
+from cameras import adaptive
+from cameras import mosaic
+from cameras import transcode
+from cameras import status
+from cameras import telemetry
+from cameras import statehub
+from cameras import supervisor
 from logger import tcpserver
+from logger import logindex
+from logger import logstore
 import threading
 from threading import current_thread
-from multiprocessing.connection import Client
+import logging
 import cv2
 import sys
 import uuid
-import subprocess
+import time
 from netcam.database import database
-from datetime import datetime
-import json
+from netcam.database import cache
+from datetime import datetime, date
+from urllib.parse import urlsplit
 
 # FLASK CODE SECTION ===================================================
 
@@ -37,6 +52,15 @@ app = Flask(__name__)
 # CONSTANT DECLARATIONS:
 
 WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+PAGE_SIZE = 50 # [default] clips per page, overridden by request argument 'size'
+MAX_PAGE_SIZE = 500 # [default] upper limit of argument 'size'
+LOG_PAGE_SIZE = 200 # [default] log records per page, overridden by request argument 'size'
+
+# -----------------------------------------------------------
+@app.before_request
+def sync_query_cache():
+    """ invalidate cached query results when recorders have added or deleted clips """
+    qcache.sync()
 
 # -----------------------------------------------------------
 @app.route("/")
@@ -94,29 +118,69 @@ def get_bounded_camera_index(ndx):
 # -----------------------------------------------------------
 @app.route("/video_feed/<idx>/<concurrent>")
 def video_feed(idx, concurrent):
-    """ top level streaming page, referenced by home.html template """
-    userid = session['userid']
+    """
+    top level streaming page, referenced by home.html template
+    request arguments (optional): fps, width, quality (targets, adapted to the viewer's connection)
+    """
+    userid = session.get('userid', '') # [default] no session, e.g. a measurement tool
+    ctrl = get_rate_controller()
     return Response(
-        stream_with_context(generate_frames(userid, idx, int(concurrent))),
+        stream_with_context(generate_frames(userid, idx, int(concurrent), ctrl)),
         mimetype='multipart/x-mixed-replace; boundary=frame')
 
-def generate_frames(userid, idx, concurrent):
-    """ get synced frame from cameras[idx] (blocking) """
-    rtsp_url = cnfg.get_rtsp_url(int(idx), stream='sub')  # 640 x 480 pixel substream
-    stream = cv2.VideoCapture(rtsp_url)
-    while True:
-        try:
-            success, frame = stream.read() # read one frame 640 x 480
-            if success and frame is not None:
-                retval, buffer = cv2.imencode('.jpg', frame)
-                # stream to template and user's browser
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-        except cv2.error:
-            app.logger.error("Cannot connect to camera "+idx)
-            break
+def get_rate_controller():
+    """ get a rate controller for the viewer's targets: request arguments fps, width, quality """
+    adaptive.limit_send_buffer(request.environ.get('werkzeug.socket')) # Flask development server
+    return adaptive.get_controller(
+        request.args.get('fps', None, type=float),
+        request.args.get('width', None, type=int),
+        request.args.get('quality', None, type=int))
+
+def generate_frames(userid, idx, concurrent, ctrl):
+    """ get the newest encoded frame of cameras[idx] from its broadcaster (shared by all viewers) """
+    yield from generate_pictures(lambda: broadcasters.subscribe(get_bounded_camera_index(int(idx))), ctrl)
+
+def generate_pictures(subscribe, ctrl):
+    """ stream the pictures of a broadcaster subscription, adapted to the viewer's connection """
+    sub = subscribe()
+    try:
+        while not sub.closed:
+            ctrl.pace() # frame rate of this viewer
+            picture = sub.get(timeout=1.0) # newest frame only, stale frames are dropped
+            if picture is not None:
+                width, quality = ctrl.get_params(picture.get_width())
+                jpeg = picture.get_jpeg(width, quality) # each variant is encoded once for all viewers
+                # stream to template and user's browser, measure the (blocking) write
+                t0 = time.time()
+                yield broadcast.get_frame_part(jpeg, picture.timestamp, quality)
+                ctrl.sent(len(jpeg), time.time() - t0)
+    finally:
+        sub.close() # viewer has left (generator closed by Flask)
     pass # managed by Flask
 
+@app.route("/mosaic_feed")
+def mosaic_feed():
+    """
+    grid of all cameras in one stream, referenced by tiles.html template
+    request arguments (optional): fps, width, quality (targets, adapted to the viewer's connection)
+    """
+    ctrl = get_rate_controller()
+    indices = list(range(len(cnfg.get_ip_address_list())))
+    return Response(
+        stream_with_context(generate_pictures(lambda: mosaic.subscribe(broadcasters, indices, app.logger), ctrl)),
+        mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.context_processor
+def inject_stream_url():
+    """ prefix of the stream urls in the templates: the asyncio stream server (own port) or Flask """
+    port = cnfg.get_stream_port()
+    if port is None:
+        return {"stream_url": ""}
+    host = urlsplit('//' + request.host).hostname
+    if ':' in host:
+        host = '[' + host + ']' # ipv6
+    return {"stream_url": '//' + host + ':' + str(port)}
+
 # -----------------------------------------------------------
 @app.route("/menu/main")
 def menu_main():
@@ -139,11 +203,7 @@ def tiles():
     for x in range(len(cnfg.get_ip_address_list())):
         indices.append(str(x))
     conc = len(indices) # number of concurrent cameras
-    # calculate the width or each camera display
-    concwidth = 100.0
-    if 2<= conc <= 4: concwidth = 49.8 # two columns
-    elif 5 <= conc <= 9: concwidth = 33.1 # three columns
-    # build response (using template)
+    # build response (using template), one composed stream for all cameras
     rsp = make_response(
         render_template(
             template_name_or_list=template,
@@ -151,8 +211,8 @@ def tiles():
                 "icon": "cross",
                 "url": url_for("home", _external=True)},
             indices=indices,
-            concurrent=str(conc),
-            widthpercent=concwidth
+            columns=mosaic.get_columns(conc),
+            rows=mosaic.get_rows(conc)
         ))
     return rsp
 
@@ -161,7 +221,7 @@ def tiles():
 @app.route("/clips/<index>")
 def clips(index=''):
     template = 'clips.html'
-    infos = get_infos(index)
+    infos, pages = get_infos(index)
     rsp = make_response(
         render_template(
             template_name_or_list=template,
@@ -170,103 +230,177 @@ def clips(index=''):
                 "url": url_for("home", _external=True)},
             attributes={
                 "date": index,
-                "infos": infos
+                "infos": infos,
+                "pages": pages
             }
         ))
     return rsp
 
-def get_weekday(dtstrng):
-    """ convert date string to the weekday: Monday, Tuesday, etc. """
-    date_object = datetime.strptime(dtstrng, "%Y-%m-%d")
+def get_weekday(day):
+    """ convert day (integer yyyymmdd) to the weekday: Monday, Tuesday, etc. """
+    date_object = date(day // 10000, day // 100 % 100, day % 100)
     day_of_week = date_object.weekday() # integer: where 0 is Monday
     return WEEKDAYS[day_of_week]
 
+def get_local_time(ts, tzoff, fmt='%H:%M:%S'):
+    """ convert epoch seconds and the local time offset (database) to a string """
+    return datetime.utcfromtimestamp(ts + tzoff).strftime(fmt)
+
+def _get_cursor(arg):
+    """ convert request argument 'ts.cam' to a keyset cursor (ts, cam) """
+    chnks = request.args.get(arg, '').split('.')
+    if len(chnks) == 2 and chnks[0].isdigit() and chnks[1].isdigit():
+        return int(chnks[0]), int(chnks[1])
+    return None
+
+def _get_page_args(cursor, arg, size, cam):
+    """ build the request arguments of a neighbour page, None if there is no such page """
+    if cursor is None:
+        return None
+    args = {arg: str(cursor[0])+'.'+str(cursor[1]), 'size': size}
+    if cam is not None:
+        args['camera'] = cam
+    return args
+
 def get_infos(day):
-    """ get the infos for video clips """
+    """
+    get the infos for video clips and the arguments of the neighbour pages
+    request arguments (day only): camera, size, older=ts.cam or newer=ts.cam (keyset cursors)
+    """
     infs = []
-    db = database.Database()
+    pages = {"newer": None, "older": None}
     if day == '' or day is None:
-        rows = db.get_clips_per_day()
+        rows = qcache.get(('days', ), db.get_clips_per_day)
         for row in rows:
-            key = row[0]
+            key = str(row['day']) # yyyymmdd
             ymd = key[0:4]+'-'+key[4:6]+'-'+key[6:8]
-            wkdy = get_weekday(ymd)
-            cnt = str(row[1])
+            wkdy = get_weekday(row['day'])
+            cnt = str(row['clps'])
             infs.append((key, wkdy, ymd, cnt)) # tuple: key(hidden), weekday, date string, counter
-        return infs
-    else:
-        # get the infos of all videoclips for day
-        rows = db.get_clips_for_day(day)
+        return infs, pages
+    elif day.isdigit():
+        # get the infos of one page of videoclips for day
+        size = min(max(request.args.get('size', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        cam = request.args.get('camera', None, type=int)
+        newer = _get_cursor('newer')
+        if newer is not None:
+            rows, newer, older = qcache.get(
+                ('page', day, newer, size, cam, True), db.get_clips_page, day, newer, size, cam, True)
+        else:
+            older = _get_cursor('older')
+            rows, newer, older = qcache.get(
+                ('page', day, older, size, cam, False), db.get_clips_page, day, older, size, cam)
+        pages["newer"] = _get_page_args(newer, 'newer', size, cam)
+        pages["older"] = _get_page_args(older, 'older', size, cam)
         for row in rows:
-            # fname = row[0] # filename
-            idx = row[1] # idx
-            key = row[2] # ymdhms
-            tod = key[8:10]+':'+key[10:12]+':'+key[12:]
-            inf = row[3]
-            dctny = json.loads(inf.replace("'", '"'))
-            # qa = dctny['qa']
-            frms = dctny['frms']
-            infs.append((key, tod, str(frms), str(idx) )) # tuple: key(hidden), time of day, no of frames, camera number
-        return infs
+            key = row['id'] # unique clip id
+            tod = get_local_time(row['ts'], row['tzoff'])
+            frms = row['frms'] # motion statistics are columns, no json parsing
+            infs.append((key, tod, str(frms), str(row['cam']) )) # tuple: key(hidden), time of day, no of frames, camera number
+        return infs, pages
+    else:
+        return infs, pages # illegal day, expected yyyymmdd
 
 # -----------------------------------------------------------
 @app.route("/clip")
-@app.route("/clip/<key>")
-@app.route("/clip/<key>/<action>")
+@app.route("/clip/<int:key>")
+@app.route("/clip/<int:key>/<action>")
 def clip(key='', action=''):
     """
-    render the videoclip defined by the clip date time
-    :param key: string, format: yyyymmddhhmmss
+    render the videoclip defined by the unique clip id
+    :param key: string, clip id (integer)
     :return: template rendered with information
     """
+    if key == '':
+        return redirect(url_for('home')) # /clip: base url of the templates, no clip
     mode = 'jpg'
     current_key = key
-    db = database.Database()
+    start = max(request.args.get('start', 0, type=int), 0) # first frame of playback
     if action == "previous":
-        current_key = db.get_previous_clip_index(key)
+        current_key = qcache.get(('previous', key), db.get_previous_clip_index, key)
     elif action == "next":
-        current_key = db.get_next_clip_index(key)
+        current_key = qcache.get(('next', key), db.get_next_clip_index, key)
     elif action == "play":
         mode = 'avi'
     # ignore other actions
+    tml = timeline.unpack(qcache.get(('timeline', current_key), db.get_timeline, current_key))
+    if action == "peak":
+        mode = 'avi'
+        start = max(timeline.get_peak_frame(tml) - 4, 0) # jump to peak, a few frames earlier
+    video = None # transcoded clip, played (and seeked) by the browser
+    if mode == 'avi':
+        path = transcoder.cache.get_path(current_key)
+        if path is None:
+            transcoder.request(current_key) # meanwhile play the mjpeg stream
+        else:
+            video = transcode.get_mimetype(path)
     template = 'clip.html'
     rsp = make_response(
         render_template(
             template_name_or_list=template,
             key=current_key,
             mode=mode,
+            start=start,
+            offset=int(tml['ms'][start]) / 1000 if start < len(tml) else 0.0, # seconds, for the video element
+            video=video,
+            intensity=timeline.get_intensity(tml), # motion intensity bar
+            duration=int(tml['ms'][-1]) / 1000 if len(tml) > 0 else 0.0,
             navigation={
                 "icon": "cross",
                 "url": url_for("home", _external=True)}
         ))
     return rsp
 
-@app.route("/picture_feed/<key>")
+@app.route("/picture_feed/<int:key>")
 def picture_feed(key):
     """ display picture 'key' on web client """
     imgpath = get_image_path(key, type=".jpg")
     return send_file(imgpath, mimetype='image/jpg')
 
-@app.route("/clip_feed/<key>")
+@app.route("/clip_file/<int:key>")
+def clip_file(key):
+    """ transcoded video file, with http range requests for seeking in the browser """
+    path = transcoder.cache.get_path(key)
+    if path is None:
+        transcoder.request(key)
+        abort(404) # not transcoded (yet)
+    return send_file(path, mimetype=transcode.get_mimetype(path), conditional=True)
+
+@app.route("/clip_feed/<int:key>")
 def clip_feed(key):
-    """ display video file """
+    """
+    display video file, optionally starting at frame 'start'
+    request arguments (optional): fps, width, quality (targets, adapted to the viewer's connection)
+    """
+    start = max(request.args.get('start', 0, type=int), 0)
+    ctrl = get_rate_controller()
     return Response(
-        stream_with_context(generate_clips(key)),
+        stream_with_context(generate_clips(key, start, ctrl)),
         mimetype='multipart/x-mixed-replace; boundary=frame')
 
-def generate_clips(key):
-    """ get frames from local video file """
+def generate_clips(key, start=0, ctrl=None):
+    """ get frames from local video file, paced at the clip's frame rate """
+    if ctrl is None:
+        ctrl = adaptive.RateController()
     imgpath = get_image_path(key, type=".avi")
     vcap = cv2.VideoCapture(imgpath)
+    if start > 0:
+        vcap.set(cv2.CAP_PROP_POS_FRAMES, start) # seek, e.g. to the peak of motion
+    fps = vcap.get(cv2.CAP_PROP_FPS)
+    ctrl.set_source_fps(fps)
     while vcap.isOpened():
         try:
+            for n in range(ctrl.get_skip(fps)):
+                vcap.grab() # slow viewer: skip frames without decoding
             success, frame = vcap.read() # read one frame
             if success and frame is not None:
-                rframe = cv2.resize(frame, (1920, 1080)) # use HD resolution for web
-                retval, buffer = cv2.imencode('.jpg', rframe)
-                # stream to template and user's browser
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+                width, quality = ctrl.get_params(frame.shape[1])
+                jpeg = broadcast.encode(frame, width, quality) # source resolution unless degraded
+                # stream to template and user's browser, measure the (blocking) write
+                ctrl.pace()
+                t0 = time.time()
+                yield broadcast.get_frame_part(jpeg, time.time(), quality)
+                ctrl.sent(len(jpeg), time.time() - t0)
             else:
                 break # end of video file
         except cv2.error:
@@ -277,9 +411,10 @@ def generate_clips(key):
 
 def get_image_path(key, type=".avi"):
     """ get the path to the image which is associated with key """
-    db = database.Database()
-    dict = db.get_clip(key)
-    avi= dict[0][0]
+    rows = qcache.get(('clip', key), db.get_clip, key) # filename lookup
+    if len(rows) == 0:
+        return app.root_path + "/static/lightning.jpg" # unknown clip
+    avi = rows[0]['filename']
     if type == ".avi":
         if os.path.isfile(avi):
             return avi
@@ -326,8 +461,83 @@ def get_state_items():
             'Camera: '+str(idx)+
             ', frames per second: '+str(info.get('cam_fps'))+
             ', frames: '+str(info.get('frm_cnt'))+
-            ', skipped: '+str(info.get('frm_skp'))
+            ', skipped: '+str(info.get('frm_skp'))+
+            ', db queue: '+str(info.get('db_que'))+
+            ', db commit: '+str(info.get('db_lat'))+' ms'+
+            ', updated: '+str(info.get('age'))+' secs ago'
+        )
+        state_items.append(
+            'Logging: shipped: '+str(info.get('log_shp'))+
+            ', dropped: '+str(info.get('log_drp'))+
+            ', queued: '+str(info.get('log_que'))
+        )
+        state_items.append(
+            'Recording: '+str(info.get('rec_state'))+
+            ', QA: '+str(info.get('rec_qa'))+'%'+
+            ', fifo: '+str(info.get('rec_fifo'))+
+            ', wait: '+str(info.get('tm_wait'))+' ms'+
+            ', motion: '+str(info.get('tm_mtn'))+' ms'+
+            ', record: '+str(info.get('tm_rec'))+' ms'+
+            ', fps (min, avg, max) last minute: '+str(telemetries.get_summary(idx, 'cam_fps'))
+        )
+    for stats in recorders.get_stats():
+        state_items.append(
+            'Recorder: '+str(stats['idx'])+
+            ', state: '+stats['state']+
+            ', pid: '+str(stats['pid'])+
+            ', uptime: '+str(stats['uptime'])+' secs'+
+            ', restarts: '+str(stats['restarts'])+
+            ', start latency: '+str(stats['start_latency'])+' secs'+
+            ', first frame: '+str(stats['first_frame'])+' secs'+
+            ', last exit code: '+str(stats['exit_code'])
         )
+    stats = poller.get_stats()
+    state_items.append(
+        'Status poller: polls: '+str(stats['polls'])+
+        ', connected: '+str(stats['connected'])+
+        ', errors: '+str(stats['errors'])
+    )
+    stats = hub.get_stats()
+    state_items.append(
+        'State hub: events: '+str(stats['version'])+
+        ', backlog: '+str(stats['backlog'])+
+        ', listeners: '+str(stats['listeners'])
+    )
+    stats = logidx.get_stats()
+    state_items.append('LOG INDEX')
+    state_items.append(
+        'Records: '+str(stats['records'])+
+        ', indexed: '+str(round(stats['bytes'] / 1000000, 1))+' MB'+
+        ', loggers: '+str(stats['loggers'])
+    )
+    stats = logs_store.get_stats()
+    state_items.append(
+        'Log store: segments: '+str(stats['segments'])+
+        ', size: '+str(round(stats['bytes'] / 1000000, 1))+' MB'+
+        ', written: '+str(stats['written'])+
+        ', dropped: '+str(stats['dropped'])+
+        ', rotations: '+str(stats['rotations'])
+    )
+    # get query cache info -----
+    stats = qcache.get_stats()
+    state_items.append('QUERY CACHE')
+    state_items.append(
+        'Hit rate: '+str(stats['rate'])+'%'+
+        ', hits: '+str(stats['hits'])+
+        ', misses: '+str(stats['misses'])+
+        ', entries: '+str(stats['entries'])+
+        ', invalidations: '+str(stats['invalidations'])
+    )
+    stats = transcoder.get_stats()
+    state_items.append('CLIP CACHE')
+    state_items.append(
+        'Files: '+str(stats['files'])+
+        ', size: '+str(round(stats['bytes'] / 1000000, 1))+' of '+str(round(stats['max_bytes'] / 1000000))+' MB'+
+        ', evictions: '+str(stats['evictions'])+
+        ', queued: '+str(stats['queued'])+
+        ', transcoded: '+str(stats['transcoded'])+
+        ', errors: '+str(stats['errors'])
+    )
     # exit -----
     return state_items
 
@@ -351,100 +561,152 @@ def get_thread_position(thread):
 
 def get_camera_info(idx):
     """
-    get information from ipc server (camera port):
-    - open connection
-    - send request
-    - receive information
-    - close connection
+    get information of camera 'idx' from memory (no ipc in the request path):
+    the pushed telemetry when current, otherwise the cached status of the status poller
     """
-    address = ('localhost', cnfg.get_ipc_port(idx))
-    try:
-        with Client(address, authkey=cnfg.get_ipc_authkey()) as conn:
-            conn.send('information?') # information request
-            info = conn.recv() # wait for information response
-            if type(info) is dict:
-                return info
-            else:
-                app.logger.error('IPC response error: '+str(info))
-                return {"cnnprbl": True}
-    except Exception as exc:
-        # Connection refused [Errno 61]
-        return {"cnnprbl": True}
+    info = telemetries.get_latest(idx)
+    if info is None:
+        info = poller.get_info(idx)
+    return info
+
+@app.route("/events")
+def events():
+    """
+    server-sent events of the state hub: 'cameras' (changed values per camera index) and 'clips'
+    (new clips), the browser resumes after a reconnect with the Last-Event-ID header;
+    without the stream server, each request gets the pending events only and the browser reconnects
+    (polls) after POLL_RETRY, so the viewers do not hold a Werkzeug thread each
+    """
+    version = statehub.get_version(request.headers.get('Last-Event-ID', request.args.get('since')))
+    if cnfg.get_stream_port() is None:
+        generator = generate_pending_events(version)
+    else:
+        generator = generate_events(version)
+    return Response(
+        stream_with_context(generator),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def generate_events(version):
+    """ stream the events of the state hub (shared by all viewers), a comment line when idle """
+    yield statehub.get_retry()
+    while hub.keep_running:
+        events = hub.wait(version)
+        if len(events) == 0:
+            yield statehub.get_keepalive()
+        for version, event, data in events:
+            yield statehub.get_message(version, event, data)
+    pass # managed by Flask
+
+def generate_pending_events(version):
+    """ send the pending events of the state hub and end the stream, the browser reconnects """
+    yield statehub.get_retry(statehub.POLL_RETRY)
+    for version, event, data in hub.get_events(version):
+        yield statehub.get_message(version, event, data)
+    pass # managed by Flask
+
+@app.route("/telemetry/<int:idx>")
+def telemetry_series(idx):
+    """
+    time series of one telemetry value of camera 'idx', e.g. for charts
+    request arguments: key (e.g. cam_fps, tm_mtn, db_que), seconds (optional, default: all)
+    """
+    key = request.args.get('key', 'cam_fps')
+    seconds = request.args.get('seconds', None, type=float)
+    return jsonify(telemetries.get_series(idx, key, seconds))
+
+@app.route("/threads")
+def thread_names():
+    """ names of the threads of this process by native thread id, e.g. for netcam-tool-cpu.py """
+    return jsonify({str(thrd.native_id): thrd.name for thrd in threading.enumerate()})
+
+@app.route("/motion/<int:idx>", methods=['GET', 'POST'])
+def motion_settings(idx):
+    """
+    motion settings of the running recorder 'idx' (roi, fg_min_area, bg_sub_methode, history, threshold),
+    POST: change them (json, e.g. {"fg_min_area": 800}) at the next frame, without restarting the recorder
+    """
+    if not (0 <= idx <= cnfg.get_max_camera_index()):
+        abort(404)
+    if request.method == 'POST':
+        settings = request.get_json(silent=True)
+        if not isinstance(settings, dict):
+            abort(400, 'Motion settings must be a json object.')
+        answer = status.ask_recorder(cnfg, idx, ('configure!', settings))
+    else:
+        answer = status.ask_recorder(cnfg, idx, 'settings?')
+    if answer is None:
+        abort(503, 'Recorder '+str(idx)+' is not running.')
+    if isinstance(answer, dict) and answer.get('ok') is False:
+        return jsonify(answer), 400
+    return jsonify(answer)
 
 # -----------------------------------------------------------
 @app.route("/logs")
 @app.route("/logs/<index>")
 def logs(index=''):
-    """ display logs page """
+    """
+    display logs page, one page of log records, newest page first
+    request arguments (optional): camera, size, before=n or after=n (record numbers, keyset cursors)
+    """
     template = 'logs.html'
-    log_items = get_log_items(index)
+    log_items, pages = get_log_items(index)
     rsp = make_response(
         render_template(
             template_name_or_list=template,
             navigation={
                 "icon": "cross",
                 "url": url_for("home", _external=True)},
-            logs=log_items
+            index=index,
+            logs=log_items,
+            pages=pages
         ))
     return rsp
 
 def get_log_items(index):
-    """ get filtered logs """
-    log_items = []
-    fltr = index.upper()
-    fp = open(cnfg.get_log_filename())
-    while True:
-        item = fp.readline()
-        if len(item) == 0:
-            break
-        if (index != '') and (index != 'all'):
-            if item.find(fltr) != -1:
-                log_items.append(item) # filtered item
-        else:
-            log_items.append(item) # unfiltered item
+    """ get one page of filtered logs (level 'index' and camera) from the log index, seeks only """
+    level = index.upper() if index.upper() in logindex.LEVELS else None # [default] all levels
+    size = min(max(request.args.get('size', LOG_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    cam = request.args.get('camera', None, type=int)
+    log_items, older, newer = logidx.get_page(
+        cnfg.get_log_filename(), size,
+        request.args.get('before', None, type=int), request.args.get('after', None, type=int), level, cam)
+    pages = {"older": None, "newer": None}
+    for key, cursor, arg in (("older", older, 'before'), ("newer", newer, 'after')):
+        if cursor is not None:
+            pages[key] = {arg: cursor, 'size': size}
+            if cam is not None:
+                pages[key]['camera'] = cam
     if len(log_items) == 0:
         log_items.append('No log items available.')
-    return log_items
+    return log_items, pages
 
-# MAIN CODE SECTION ===========================================================
+@app.route("/log_records")
+def log_records():
+    """
+    log records of the structured log store (all segments), newest first, as json
+    request arguments (optional): since, until (epoch seconds or local time yyyy-mm-ddThh:mm:ss),
+                                  level (minimum level, e.g. WARNING), logger (e.g. recorder.2), limit
+    """
+    try:
+        records = logs_store.query(
+            _get_epoch('since'), _get_epoch('until'), request.args.get('level'), request.args.get('logger'),
+            min(max(request.args.get('limit', logstore.QUERY_LIMIT, type=int), 1), logstore.QUERY_LIMIT))
+    except ValueError as err: # e.g. unknown level or illegal time
+        abort(400, str(err))
+    return jsonify(records)
+
+def _get_epoch(arg):
+    """ convert request argument 'arg' (epoch seconds or local iso time) to epoch seconds, None if missing """
+    value = request.args.get(arg)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
 
-def get_process_infos(key):
-    """ get name + index of each netcam-recorder.py application running as a process """
-    subp = subprocess.Popen(["ps -ax | grep "+key], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    subc = subp.communicate() # get stdout and stderr
-    stdout = subc[0].decode("utf-8") # stdout to string
-    idxs = [] # return value
-    for line in stdout.splitlines():
-        chnks = line.split()
-        idx = chnks[-1] # camera index
-        cmd = chnks[-2] # command with scriptname
-        if idx.isnumeric() and key in cmd:
-            idxs.append(int(idx))
-    return idxs
-
-def start_long_running_processes(cnfg):
-    """ setup long-running processes (netcam-recorder.py) """
-    ips = cnfg.get_ip_address_list()
-    pexe = "/Users/mart/Projects/netcam-git/venv/bin/python3.9"  # [default] macbook dev environment
-    papp = "netcam-recorder.py" # [default] subprocess name
-    keys = get_process_infos(papp) # indexes of running netcan-recorder processes
-    for idx, ip in enumerate(ips):
-        if idx not in keys:
-            try:
-                # start python netcam-recorder.py script
-                p = subprocess.Popen(
-                    [pexe, papp, str(idx)],
-                    stdin=subprocess.DEVNULL,
-                    stdout=open('netcam.log', 'w'),
-                    stderr=subprocess.STDOUT,
-                    start_new_session=True,
-                    shell=False)
-                app.logger.info("Started new subprocess "+papp+" "+str(idx))
-            except subprocess.CalledProcessError as e:
-                app.logger.error("Cannot start new subprocess "+papp+" "+str(idx))
-        else:
-            app.logger.info("Continue using subprocess "+papp+" "+str(idx))
-    pass
+# MAIN CODE SECTION ===========================================================
 
 def start_threads():
     """ setup all threads needed for this app """
@@ -470,6 +732,12 @@ if __name__ == "__main__":
     # setup configuration and logging -----
     cnfg = config.Config()
     cnfg.set_logging()
+    db = database.Database() # sqlite3 connections are reused per thread
+    qcache = cache.QueryCache(db) # query results, invalidated by new clips
+    logidx = logindex.LogIndex() # log records, extended as the log file grows
+    logs_store = logstore.LogStore(cnfg.get_standard_path() + logstore.STORE_FOLDER, app.logger)
+    logging.getLogger().addHandler(logs_store.get_handler()) # app and recorder records, queued
+    logs_store.start()
     app.logger.info(">>> Start Flask application '"+app.name+"'")
     errors = cnfg.get_error_messages()
     if len(errors) >0:
@@ -486,9 +754,30 @@ if __name__ == "__main__":
 
     # start all threads needed in this application -----
     thrds = start_threads()
+    poller = status.StatusPoller(cnfg, app.logger) # camera status cache, read by the pages
+    poller.start()
+    thrds.append(poller)
+    telemetries = telemetry.TelemetryListener(cnfg, app.logger) # pushed by the recorders
+    telemetries.start()
+    thrds.append(telemetries)
+    hub = statehub.StateHub(db, get_camera_info, len(cnfg.get_ip_address_list()), app.logger) # /events
+    hub.start()
+    thrds.append(hub)
+    broadcasters = broadcast.BroadcasterPool(cnfg, app.logger) # live view, started per camera on demand
+    transcoder = transcode.Transcoder(db, transcode.ClipCache(cnfg.get_standard_path() + transcode.CACHE_FOLDER), app.logger)
+    transcoder.start() # clip playback, browser playable files
+    thrds.append(transcoder)
+    if cnfg.get_stream_port() is not None:
+        # multipart streams served by an event loop, not one Flask thread per viewer
+        from cameras import streamserver # deferred: asyncio is only needed with a stream port
+        strmsrvr = streamserver.StreamServer(cnfg.get_stream_port(), broadcasters, cnfg, get_image_path, app.logger, hub)
+        strmsrvr.start()
+        thrds.append(strmsrvr)
 
     # start all processes needed for the application -----
-    start_long_running_processes(cnfg)
+    recorders = supervisor.Supervisor(cnfg, get_camera_info, app.logger) # starts, watches and restarts them
+    recorders.start()
+    thrds.append(recorders)
 
     # run Flask server -----
     if cnfg.is_debug_mode():
@@ -502,8 +791,11 @@ if __name__ == "__main__":
         app.run(debug=False, use_debugger=False, use_reloader=False)
 
     # kill threads -----
+    broadcasters.terminate_thread()
     kill_threads(thrds)
 
     # finish app
     app.logger.info("<<< Stop Flask application '"+app.name+"'")
+    logs_store.terminate_thread() # writes the remaining records
+    logs_store.join()
     sys.exit()
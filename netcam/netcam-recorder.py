@@ -5,106 +5,190 @@
 # other than ipc communication commands:
 #     'information?' request for information from the camera
 #     'terminate!'   request for termination of the recording process
+#     'settings?'    request for the motion settings (roi, thresholds)
+#     ('configure!', {settings}) change the motion settings of the running recorder
+#     'telemetry?'   request for one telemetry sample (e.g. netcam-tool-cpu.py)
+#     'threads?'     request for the names of the threads, by native thread id (e.g. netcam-tool-cpu.py)
 #
-# and logging events sent through socket DEFAULT_TCP_LOGGING_PORT.
+# telemetry samples pushed to the Flask ipc port (once per second)
+# and logging events queued and sent in batches through socket DEFAULT_TCP_LOGGING_PORT.
+
+import time
+START_TIME = time.time() # before the (heavy) imports, for the time to first frame
 
 from cameras import config
 from cameras import videoclip
 from cameras import motion
 from cameras import camera, frame
+from cameras import telemetry
+from netcam.database import writer
+from logger import shipper
 import logging, logging.handlers
 import argparse
 from multiprocessing.connection import Listener
-import time
+from multiprocessing import AuthenticationError
+import threading
 import sys
+import os
+from urllib.parse import urlsplit
+
+SWAP_TIMEOUT = 2.0 # [default] seconds, waiting for the next frame (new motion settings)
+
+def _get_time_to_first_frame(cam):
+    """ get the seconds from the start of this process to the first frame, None if there is none yet """
+    first = cam.get_first_frame_time()
+    return round(first - START_TIME, 2) if first is not None else None
 
 def _get_camera_info():
     """ get camera infos for ipc server """
     cam = thrds[0] # camera always first thread
+    dbw = thrds[-1] # database writer always last thread
     info = {"cam_idx": recorder_index,
+            "pid": os.getpid(), # for the supervisor of the Flask application
             "cam_fps": cam.get_fps(),
             "frm_cnt": cam.get_frame_count(),
             "frm_skp": cam.get_skipped_count(),
-            "cnnprbl": cam.has_connection_problem()}
+            "cnnprbl": cam.has_connection_problem(),
+            "ttff": _get_time_to_first_frame(cam)}
+    info.update(dbw.get_metrics()) # queue depth and commit latency
     return info
 
-def run_ipc_server(lggr):
-    """
-    inter process communication (in main thread):
-        client: open connection, send command, receive answer, close connection
-        server: open connection, (EOF) wait for cmd, send answer, repeat EOF ...
-    """
-    terminate_origin = 'n/a'
-    address = ('localhost', cnfg.get_ipc_port(recorder_index))  # AF_INET - TCP socket
-    listener = Listener(address, authkey=cnfg.get_ipc_authkey())
-    while True: # outer loop
+def _configure_motion(settings):
+    """ change the motion settings at the next frame boundary, without interrupting the recording """
+    mtn = thrds[1].motion # videoclip always second thread
+    try:
+        swapped = mtn.set_settings(settings)
+    except ValueError as err:
+        return {"ok": False, "error": str(err), "settings": mtn.get_settings()}
+    if not swapped.wait(SWAP_TIMEOUT):
+        return {"ok": True, "pending": True, "settings": mtn.get_settings()} # e.g. no frames (connection problem)
+    answer = {"ok": "rejected" not in mtn.last_swap, "pending": False}
+    answer.update(mtn.last_swap)
+    return answer
+
+def _get_telemetry():
+    """ get one telemetry sample: camera infos, recording state and stage timings """
+    clp = thrds[1] # videoclip always second thread
+    info = _get_camera_info()
+    info.update(clp.get_metrics())
+    info.update(shppr.get_metrics()) # shipped and dropped log records
+    return info
+
+def serve_ipc_connection(conn, lggr, stop):
+    """ serve one ipc client (own thread) until it closes the connection or sends 'terminate!' """
+    with conn:
         try:
-            conn = listener.accept()
-            while True: # inner loop
-                msg = conn.recv()
-                # do something with msg
+            while not stop.is_set():
+                msg = conn.recv() # wait for the next command
                 if msg == 'terminate!':
                     lggr.debug('**** IPC connection TERMINATE command.')
                     conn.send('OK')
-                    terminate_origin = 'ipc'
-                    # close connection and kill all threads in this app
-                    conn.close()
-                    break # end inner loop
+                    stop.set() # kill all threads in this app
                 elif msg == 'information?':
                     lggr.debug('**** IPC connection PROVIDE INFORMATION command.')
                     conn.send(_get_camera_info()) # send to Flask application
+                elif msg == 'telemetry?':
+                    conn.send(_get_telemetry())
+                elif msg == 'threads?':
+                    conn.send({thrd.native_id: thrd.name for thrd in threading.enumerate()})
+                elif msg == 'settings?':
+                    lggr.debug('**** IPC connection PROVIDE SETTINGS command.')
+                    conn.send(thrds[1].motion.get_settings())
+                elif isinstance(msg, tuple) and len(msg) == 2 and msg[0] == 'configure!':
+                    answer = _configure_motion(msg[1])
+                    if answer["ok"]:
+                        lggr.info('IPC changed the motion settings: '+str(msg[1]))
+                    else:
+                        lggr.error('IPC refused the motion settings: '+answer["error"])
+                    conn.send(answer)
                 else:
-                    lggr.error('IPC received illegal verb: '+msg)
-                    conn.send('Unknown verb: '+msg) # send to Flask application
-                continue # try again (inner loop)
-            # end of inner loop
-            if terminate_origin == 'ipc': break # end outer loop
-
-        except EOFError:
-            # client closed connection
+                    lggr.error('IPC received illegal verb: '+str(msg))
+                    conn.send('Unknown verb: '+str(msg)) # send to Flask application
+        except (EOFError, OSError):
+            pass # client closed connection
+    pass
+
+def accept_ipc_connections(listener, lggr, stop):
+    """ accept ipc clients, one thread per connection (e.g. the persistent status poller of Flask) """
+    while not stop.is_set():
+        try:
+            conn = listener.accept()
+        except (OSError, EOFError, AuthenticationError) as err:
+            if stop.is_set():
+                break # listener closed
+            lggr.error('IPC connection refused: '+str(err))
             time.sleep(0.1) # short delay for freeing resources
-            continue # try again (while loop)
+            continue
+        thrd = threading.Thread(target=serve_ipc_connection, args=(conn, lggr, stop), daemon=True)
+        thrd.name = 'IPC-connection'
+        thrd.start()
+    pass
 
-        except KeyboardInterrupt:
-            terminate_origin = 'keyboard'
-            listener.close()
-            break # end outer loop
-        pass # try again (outer loop)
+def run_ipc_server(lggr):
+    """
+    inter process communication (in main thread):
+        client: open connection, send command(s), receive answer(s), close connection
+        server: accept connections in a thread, serve each connection in its own thread,
+                wait for the 'terminate!' command (or a keyboard interrupt)
+    """
+    terminate_origin = 'ipc'
+    stop = threading.Event()
+    address = ('localhost', cnfg.get_ipc_port(recorder_index))  # AF_INET - TCP socket
+    listener = Listener(address, authkey=cnfg.get_ipc_authkey())
+    acceptor = threading.Thread(target=accept_ipc_connections, args=(listener, lggr, stop), daemon=True)
+    acceptor.name = 'IPC-server'
+    acceptor.start()
+    try:
+        while not stop.wait(1.0): # interruptible wait
+            pass
+    except KeyboardInterrupt:
+        terminate_origin = 'keyboard'
+        stop.set()
+    listener.close()
     #
     lggr.debug('<<<< IPC connection closed (TERMINATE command from '+terminate_origin+').')
-    pass # end of outer loop
+    pass
 
 def parse_cli():
-    """ parse the commandline: python3 netcam-recorder.py idx """
+    """ parse the commandline: python3 netcam-recorder.py idx [--source video.avi] """
     parser = argparse.ArgumentParser(
         description="Start video recordings.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("idx", help="Camera index (0..n).")
+    parser.add_argument("--source", default=None,
+                        help="Local video file (played in a loop) or stand-in url, instead of the camera.")
     args = parser.parse_args()
     cli = vars(args)
-    return int(cli["idx"])
+    return int(cli["idx"]), cli["source"]
 
 def setup_logger(recorder_index):
-    """setup logging, through sockets, to netcam-app """
-    rootLogger = logging.getLogger('')
-    rootLogger.setLevel(logging.DEBUG) # [default]
-    socketHandler = logging.handlers.SocketHandler(
-        'localhost', logging.handlers.DEFAULT_TCP_LOGGING_PORT)
-    rootLogger.addHandler(socketHandler)
-    # create console handler
+    """
+    setup logging, through sockets, to netcam-app: log calls only queue the records (never block),
+    the shipper thread sends them in batches and writes them to the console
+    """
+    # create console handler, called by the shipper thread
     consoleHandler = logging.StreamHandler()
     consoleHandler.setLevel(logging.DEBUG)
-    rootLogger.addHandler(consoleHandler)
+    shppr = shipper.LogShipper('localhost', logging.handlers.DEFAULT_TCP_LOGGING_PORT, [consoleHandler])
+    shppr.start()
+    rootLogger = logging.getLogger('')
+    rootLogger.setLevel(logging.DEBUG) # [default]
+    rootLogger.addHandler(shppr.get_handler())
     #
     myname = 'recorder.'+str(recorder_index)
-    return logging.getLogger(myname)
+    return logging.getLogger(myname), shppr
 
-def setup_threads(cnfg, idx, lggr):
-    """ setup all threads needed for this app """
+def setup_threads(cnfg, idx, lggr, source=None):
+    """ setup all threads needed for this app, source: video source instead of the camera (or 'src' in .env) """
     thrds = []
     frm = frame.Frame(None)
-    url = cnfg.get_rtsp_url(idx)
-    ip = cnfg.get_ip_address(idx)
+    source = source if source is not None else cnfg.get_source(idx)
+    if source is None:
+        url, ip = cnfg.get_rtsp_url(idx), cnfg.get_ip_address(idx) # network camera
+    elif '://' in source:
+        url, ip = source, urlsplit(source).hostname # stand-in server, e.g. rtsp://localhost:8554/cam
+    else:
+        url, ip = source, None # local video file
 
     # camera thread, connected to videoclip through frm, always thrds[0]
     cam = camera.Camera(idx, ip, url, frm, lggr)  # instantiate a camera feed
@@ -112,13 +196,19 @@ def setup_threads(cnfg, idx, lggr):
     cam.start()
     thrds.append(cam)
 
+    # database writer thread, always last: terminated after the videoclip thread (flush)
+    dbw = writer.DatabaseWriter(lggr)
+    dbw.daemon = True
+    dbw.start()
+
     # videoclip threads, connected to camera only
     roi = cnfg.get_roi(idx)
     mtn = motion.Motion(roi)
-    clp = videoclip.VideoClip(idx, cnfg, cam, mtn, lggr) # instantiate video clip maker
+    clp = videoclip.VideoClip(idx, cnfg, cam, mtn, lggr, dbw) # instantiate video clip maker
     clp.daemon = True
     clp.start()
     thrds.append(clp)
+    thrds.append(dbw)
     #
     return thrds
 
@@ -126,26 +216,34 @@ def setup_threads(cnfg, idx, lggr):
 if __name__ == "__main__":
     """ initialize the netcam-recorder app """
     # parse commandline -----
-    recorder_index = parse_cli()
+    recorder_index, source = parse_cli()
 
     # setup configuration infos
     cnfg = config.Config() # get common configuration information
     if not (0 <= recorder_index <= cnfg.get_max_camera_index()):
         raise ValueError('recorder_index out of bounds: ' + str(recorder_index))
-    logger = setup_logger(recorder_index)
+    logger, shppr = setup_logger(recorder_index)
     logger.info(">>> Start recorder application no. "+str(recorder_index))
 
     # build all threads: camera and videoclip -----
-    thrds = setup_threads(cnfg, recorder_index, logger)
+    thrds = setup_threads(cnfg, recorder_index, logger, source)
+
+    # push telemetry to the Flask application -----
+    sender = telemetry.TelemetrySender(cnfg, recorder_index, _get_telemetry, logger)
+    sender.start()
 
     # run ipc server (in main thread) -----
     run_ipc_server(logger)
 
     # kill threads -----
+    sender.terminate_thread()
+    sender.join()
     for thrd in thrds:
         thrd.terminate_thread()
         thrd.join()
 
     # finished, log message -----
     logger.info("<<< Stopped recorder application no. " + str(recorder_index))
+    shppr.terminate_thread() # ships the remaining records
+    shppr.join()
     sys.exit() # stop interpreter process
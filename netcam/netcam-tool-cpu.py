@@ -1,63 +1,305 @@
 # Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
 
-# Tool for measuring the average cpu load over a period of time.
+# Tool for measuring the cpu load over a period of time: system wide, per netcam process and per thread.
 # At the end of the measurement, the measurements are copied to a file.
 # The assessment is done offline with e.g. excel
+#
+# Call this tool with: python3 netcam-tool-cpu.py [--seconds 0] [--interval 1.0] [--top 10] [--app http://localhost:5000]
+# - seconds: duration of the measurement (0: until ^C)
+# - interval: seconds between two samples
+# - top: consumers (processes and threads) in the summary
+# - app: url of netcam-app.py, for the names of its threads (route /threads), 'none': no names
+# - discovers the processes of netcam-app.py and netcam-recorder.py (also restarted ones) in every sample
+# - per process: cpu (percent of one core), rss (MB), context switches (voluntary, involuntary) and io (kB) per sample
+# - per thread: cpu and context switches, thread names from the processes (native thread ids over ipc),
+#   threads without a python name (e.g. opencv and ffmpeg threads) are summed as 'native'
+# - per recorder (ipc 'telemetry?', needs the .env file): fps, skipped frames, clip quality and stage timings
+# - output: logs/netcam-tool-cpu-HHMMSS.csv (one row per sample, one column per value, time aligned),
+#           logs/netcam-tool-cpu-HHMMSS.log (json summary: top consumers, recorder averages)
 
 # References:
 # psutil library: https://pypi.org/project/psutil/
 # psutil documents: https://psutil.readthedocs.io/en/latest/
 
 import psutil
+import argparse
 import json
 import csv
+import os
+import re
+import time
+import urllib.request
 from datetime import datetime
+from multiprocessing import AuthenticationError
+from cameras import status
 
+ENTRIES = {'netcam-app.py': 'app', 'netcam-recorder.py': 'rec'} # [default] script: label (recorder: rec + index)
+NAMES_REFRESH = 5.0 # [default] seconds, between two requests for the names of new threads
+IPC_TIMEOUT = 1.0 # [default] seconds, answer of a recorder
+TELEMETRY = ('cam_fps', 'frm_skp', 'rec_qa', 'tm_wait', 'tm_mtn', 'tm_rec') # [default] correlated recorder values
 
-def run(vals):
-    """ execute the tool application """
-    # gives a single float value
-    pct = psutil.cpu_percent(interval=1) # ignore once
-    print('Acquiring CPU load data (once per second), quit with ^C ...')
+
+def discover():
+    """ find the netcam processes: list of (label, process), e.g. ('rec2', psutil.Process) """
+    procs = []
+    for proc in psutil.process_iter(['cmdline']):
+        cmdline = proc.info['cmdline'] or []
+        for n, arg in enumerate(cmdline):
+            label = ENTRIES.get(os.path.basename(arg))
+            if label == 'rec' and n + 1 < len(cmdline):
+                procs.append((label + cmdline[n + 1], proc))
+                break
+            elif label == 'app':
+                procs.append((label, proc))
+                break
+    return procs
+
+
+def get_thread_name(name):
+    """ group the numbered threads of python, e.g. 'Thread-12 (process_request_thread)' """
+    name = re.sub(r'^Thread-\d+ \((.*)\)$', r'\1', name)
+    return re.sub(r'^Thread-\d+$', 'Thread', name)
+
+
+def get_thread_switches(pid, tid):
+    """ get the context switches (voluntary, involuntary) of one thread, linux only: None elsewhere """
+    try:
+        with open('/proc/' + str(pid) + '/task/' + str(tid) + '/status') as fp:
+            values = dict(line.split(':', 1) for line in fp if 'ctxt_switches' in line)
+        return int(values['voluntary_ctxt_switches']), int(values['nonvoluntary_ctxt_switches'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class Sampler:
+    """ sample the netcam processes and their threads, one row (dictionary: column, value) per sample """
+
+    def __init__(self, cnfg, app_url):
+        """ initialize the sampler, cnfg: configuration (ipc ports) or None, app_url: None for no thread names """
+        self.cnfg = cnfg
+        self.app_url = app_url
+        self._last = {} # (pid, tid or None): last counters
+        self._names = {} # pid: {native thread id: name}
+        self._asked = {} # pid: time of the last request for names
+        self._conns = {} # recorder index: persistent ipc connection
+        self.time = None # time of the last sample
+
+    def _ask_recorder(self, idx, msg):
+        """ ask recorder 'idx' over a persistent connection, None if there is no answer """
+        if self.cnfg is None:
+            return None
+        conn = self._conns.get(idx)
+        try:
+            if conn is None:
+                conn = status.connect(('localhost', self.cnfg.get_ipc_port(idx)), self.cnfg.get_ipc_authkey(),
+                                      IPC_TIMEOUT) # a hanging recorder does not stop the sampling
+                self._conns[idx] = conn
+            conn.send(msg)
+            if conn.poll(IPC_TIMEOUT):
+                return conn.recv()
+        except (OSError, EOFError, AuthenticationError, TypeError):
+            pass
+        if conn is not None:
+            conn.close()
+        self._conns.pop(idx, None)
+        return None
+
+    def _get_names(self, label, proc, tids, now):
+        """ get the names of the threads of a process, asked again when it has new threads """
+        names = self._names.get(proc.pid, {})
+        if all([tid in names for tid in tids]) or now - self._asked.get(proc.pid, 0.0) < NAMES_REFRESH:
+            return names
+        self._asked[proc.pid] = now
+        answer = None
+        if label.startswith('rec'):
+            answer = self._ask_recorder(int(label[3:]), 'threads?')
+        elif self.app_url is not None:
+            try:
+                with urllib.request.urlopen(self.app_url + '/threads', timeout=IPC_TIMEOUT) as rsp:
+                    answer = json.loads(rsp.read())
+            except (OSError, ValueError):
+                pass
+        if isinstance(answer, dict):
+            names = {int(tid): get_thread_name(name) for tid, name in answer.items()}
+            self._names[proc.pid] = names
+        return names
+
+    def _get_delta(self, key, counters):
+        """ get the difference to the last counters of 'key' (None for the first sample) """
+        last = self._last.get(key)
+        self._last[key] = counters
+        if last is None or counters is None or len(last) != len(counters):
+            return None
+        return [value - previous for value, previous in zip(counters, last)]
+
+    def _sample_process(self, label, proc, row, secs, now):
+        """ add the columns of one process and its threads to the row """
+        with proc.oneshot():
+            times = proc.cpu_times()
+            rss = proc.memory_info().rss
+            ctx = proc.num_ctx_switches()
+            try:
+                io = proc.io_counters()
+                io = (io.read_bytes, io.write_bytes)
+            except (psutil.AccessDenied, AttributeError): # e.g. macOS
+                io = None
+            thrds = proc.threads()
+        delta = self._get_delta((proc.pid, None), (times.user + times.system, ctx.voluntary, ctx.involuntary))
+        row[label + '.rss'] = round(rss / 1024**2, 1)
+        row[label + '.threads'] = len(thrds)
+        if delta is not None:
+            row[label + '.cpu'] = round(delta[0] / secs * 100, 1)
+            row[label + '.ctx_vol'] = delta[1]
+            row[label + '.ctx_inv'] = delta[2]
+        delta = self._get_delta((proc.pid, 'io'), io)
+        if delta is not None:
+            row[label + '.io_read'] = round(delta[0] / 1024, 1)
+            row[label + '.io_write'] = round(delta[1] / 1024, 1)
+        names = self._get_names(label, proc, [thrd.id for thrd in thrds], now)
+        for thrd in thrds:
+            prefix = label + '.' + names.get(thrd.id, 'native')
+            ctx = get_thread_switches(proc.pid, thrd.id) or (0, 0)
+            delta = self._get_delta((proc.pid, thrd.id), (thrd.user_time + thrd.system_time, ctx[0], ctx[1]))
+            if delta is not None: # threads with the same name are summed
+                row[prefix + '.cpu'] = round(row.get(prefix + '.cpu', 0.0) + delta[0] / secs * 100, 1)
+                row[prefix + '.ctx'] = row.get(prefix + '.ctx', 0) + delta[1] + delta[2]
+        if label.startswith('rec'):
+            info = self._ask_recorder(int(label[3:]), 'telemetry?')
+            if isinstance(info, dict):
+                for key in TELEMETRY:
+                    row[label + '.' + key] = info.get(key)
+        pass
+
+    def sample(self):
+        """ take one sample of all netcam processes, the first sample has no rates (cpu, switches, io) """
+        now = time.time()
+        secs = now - self.time if self.time is not None else None
+        self.time = now
+        row = {"time": datetime.fromtimestamp(now).strftime('%H:%M:%S.%f')[:-3],
+               "system.cpu": psutil.cpu_percent(interval=None)}
+        for label, proc in discover():
+            try:
+                self._sample_process(label, proc, row, secs or 1.0, now)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass # e.g. terminated recorder
+        return row if secs is not None else None
+
+    def close(self):
+        """ close the ipc connections """
+        for conn in self._conns.values():
+            conn.close()
+        self._conns = {}
+        pass
+
+
+def run(sampler, seconds, interval):
+    """ execute the tool application: sample until the end of the measurement or ^C """
+    rows = []
+    sampler.sample() # ignore once, no rates
+    print('Acquiring cpu load data of the netcam processes (every '+str(interval)+' secs), quit with ^C ...')
+    end = time.time() + seconds if seconds > 0 else None
+    due = time.time()
     try:
-        while True:
-            pct = psutil.cpu_percent(interval=1) # blocking
-            vals.append(pct)
+        while end is None or time.time() < end:
+            due += interval
+            time.sleep(max(due - time.time(), 0.0)) # blocking
+            row = sampler.sample()
+            if row is not None:
+                rows.append(row)
         pass
     except KeyboardInterrupt:
         # catch Ctrl+C in IDE Console
         # set in Run/Debug configuration: Emuluate terminal in output console
         pass
-    return vals
+    sampler.close()
+    return rows
 
-def save_json(vals):
-    """ save the measurements to a json file """
+
+def get_columns(rows):
+    """ get the columns of all rows (new processes and threads add columns), time and system first """
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns[key] = None
+    return ['time', 'system.cpu'] + sorted([key for key in columns if key not in ('time', 'system.cpu')])
+
+
+def average(rows, column):
+    """ average value of a column, over the samples which have it """
+    values = [row[column] for row in rows if row.get(column) is not None]
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def summarize(rows, top):
+    """ summary of the measurement: top consumers by average cpu, recorder averages """
+    columns = get_columns(rows)
+    def ranked(select):
+        cpus = {column[:-len('.cpu')]: average(rows, column) for column in columns if select(column)}
+        cpus = {key: value for key, value in cpus.items() if value is not None}
+        return dict(sorted(cpus.items(), key=lambda item: -item[1])[:top])
+    processes = [column[:-len('.rss')] for column in columns if column.count('.') == 1 and column.endswith('.rss')]
+    recorders = sorted({column.split('.')[0] for column in columns if column.startswith('rec')})
+    return {"samples": len(rows),
+            "system_cpu": average(rows, 'system.cpu'),
+            "top_processes_cpu": ranked(lambda column: column.count('.') == 1 and column.endswith('.cpu')
+                                        and column != 'system.cpu'),
+            "top_threads_cpu": ranked(lambda column: column.count('.') >= 2 and column.endswith('.cpu')),
+            "max_rss_mb": {label: max([row.get(label + '.rss') or 0 for row in rows]) for label in processes},
+            "recorders": {label: {key: average(rows, label + '.' + key) for key in TELEMETRY} for label in recorders}}
+
+
+def save_json(summary, fname):
+    """ save the summary to a json file """
     # format data
-    json_string = json.dumps(vals, indent=4)
-    # build filename
-    now = datetime.now()
-    fname = now.strftime('logs/netcam-tool-cpu-%H%M%S.log')
+    json_string = json.dumps(summary, indent=4)
     # write to file
     with open(fname, 'w') as outfile:
         outfile.write(json_string)
     pass
 
-def save_csv(vals):
-    """ save data to a .csv file """
-    # build filename
-    now = datetime.now()
-    fname = now.strftime('logs/netcam-tool-cpu-%H%M%S.csv')
+
+def save_csv(rows, fname):
+    """ save data to a .csv file, one row per sample """
     # write to file
-    with open(fname, 'w') as outfile:
-        wr = csv.writer(outfile)
-        wr.writerow(vals)
+    with open(fname, 'w', newline='') as outfile:
+        wr = csv.DictWriter(outfile, fieldnames=get_columns(rows))
+        wr.writeheader()
+        wr.writerows(rows)
     pass
 
+
+def get_config():
+    """ get the configuration for the ipc ports, None without .env file """
+    try:
+        from cameras import config
+        return config.Config()
+    except (ImportError, TypeError, ValueError, AttributeError):
+        return None
+
+
+def parse_cli():
+    """ parse the commandline: python3 netcam-tool-cpu.py [options] """
+    parser = argparse.ArgumentParser(
+        description="Measure the cpu load per netcam process and thread.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=0, help="Duration of the measurement (0: until ^C).")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between two samples.")
+    parser.add_argument("--top", type=int, default=10, help="Top consumers in the summary.")
+    parser.add_argument("--app", default='http://localhost:5000', help="Url of netcam-app.py ('none': no thread names).")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
     """ initialize the tool application """
-    values = []
-    values = run(values)
-    save_json(values)
-    save_csv(values)
+    cli = parse_cli()
+    sampler = Sampler(get_config(), None if cli.app == 'none' else cli.app.rstrip('/'))
+    values = run(sampler, cli.seconds, cli.interval)
+    # build filenames
+    now = datetime.now()
+    os.makedirs('logs', exist_ok=True)
+    summary = summarize(values, cli.top)
+    save_json(summary, now.strftime('logs/netcam-tool-cpu-%H%M%S.log'))
+    save_csv(values, now.strftime('logs/netcam-tool-cpu-%H%M%S.csv'))
+    print(json.dumps(summary, indent=2))
     # finished
-    exit(0)
\ No newline at end of file
+    exit(0)
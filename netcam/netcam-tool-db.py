@@ -0,0 +1,246 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# Tool for benchmarking the netcam database (sqlite3).
+#
+# Call this tool with: python3 netcam-tool-db.py qps [--writers 4] [--readers 4] [--seconds 10]
+#                  or: python3 netcam-tool-db.py schema [--clips 1000000] [--legacy]
+#                  or: python3 netcam-tool-db.py rebuild [--dbfile database/netcam.db]
+#                  or: python3 netcam-tool-db.py prune --days 30 [--dbfile database/netcam.db] [--keep-files]
+# - qps: queries per second for the Flask UI access patterns (clips per day, clips of a day,
+#        clip lookup, previous/next clip), while several recorder processes insert clips.
+# - schema: latency of each UI query on a large database, optionally migrated from the legacy schema.
+# - rebuild: rebuild the summary table (clips per day and camera) of an existing database.
+# - prune: retention, delete the clips (database rows and video files) older than the given days.
+# The benchmarks use a scratch database file, never the production database.
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from netcam.database import database
+
+PRELOAD = 10000 # [default] clips in the database before measuring
+
+
+def _make_clip(cam, dt):
+    """ build the arguments of Database.set_clip for camera 'cam' at datetime 'dt' """
+    fname = '/tmp/videos/recorder.'+str(cam)+'.time.'+dt.strftime('%Y.%m.%d.%H.%M.%S')+'.avi'
+    frms = random.randint(20, 200)
+    peak = random.randint(500, 200000)
+    infos = {"dur": round(frms / 4, 2), "frms": frms, "qa": 99.0, "peak": peak,
+             "mean": round(peak / 3, 1), "bbox": [10, 20, 300, 400]}
+    return fname, cam, dt.timestamp(), infos
+
+def preload(dbfile, count):
+    """ fill the database with 'count' clips, spread over the last 30 days """
+    db = database.Database(dbfile)
+    start = datetime.now() - timedelta(days=30)
+    step = timedelta(days=30) / count
+    with db.transaction():
+        for n in range(count):
+            db.set_clip(*_make_clip(n % 4, start + n * step))
+    pass
+
+def writer(dbfile, cam, seconds, interval, results):
+    """ recorder process: insert one clip every 'interval' seconds """
+    db = database.Database(dbfile)
+    stop = time.time() + seconds
+    dt = datetime.now() + timedelta(days=cam+1) # unique timestamps per writer
+    latencies = []
+    while time.time() < stop:
+        dt += timedelta(seconds=1)
+        t0 = time.perf_counter()
+        db.set_clip(*_make_clip(cam, dt))
+        latencies.append(time.perf_counter() - t0)
+        time.sleep(interval)
+    results.put(('writer', cam, len(latencies), max(latencies, default=0.0)))
+    pass
+
+def reader(dbfile, seconds, counters, idx):
+    """ Flask thread: run the UI queries in a loop """
+    db = database.Database(dbfile)
+    days = [row['day'] for row in db.get_clips_per_day()]
+    stop = time.time() + seconds
+    queries, worst = 0, 0.0
+    while time.time() < stop:
+        t0 = time.perf_counter()
+        db.get_clips_per_day()
+        rows = db.get_clips_for_day(random.choice(days))
+        if len(rows) > 0:
+            key = random.choice(rows)['id']
+            db.get_clip(key)
+            db.get_previous_clip_index(key)
+            db.get_next_clip_index(key)
+            queries += 3
+        queries += 2
+        worst = max(worst, time.perf_counter() - t0)
+    counters[idx] = (queries, worst)
+    pass
+
+def run_qps(args):
+    """ measure UI queries per second with concurrent writers """
+    dbfile = os.path.join(tempfile.mkdtemp(), 'netcam-bench.db')
+    print('Preloading '+str(args.preload)+' clips into '+dbfile+' ...')
+    preload(dbfile, args.preload)
+    results = multiprocessing.Queue()
+    writers = [
+        multiprocessing.Process(target=writer, args=(dbfile, cam, args.seconds, args.interval, results))
+        for cam in range(args.writers)]
+    counters = [None] * args.readers
+    readers = [
+        threading.Thread(target=reader, args=(dbfile, args.seconds, counters, idx))
+        for idx in range(args.readers)]
+    for thrd in writers + readers:
+        thrd.start()
+    for thrd in readers:
+        thrd.join()
+    for thrd in writers:
+        thrd.join()
+    # report -----
+    queries = sum(cnt[0] for cnt in counters)
+    print('Readers: '+str(args.readers)+', writers: '+str(args.writers)+', seconds: '+str(args.seconds))
+    print('UI queries per second: '+str(round(queries / args.seconds)))
+    print('Worst UI page (5 queries): '+str(round(max(cnt[1] for cnt in counters) * 1000, 1))+' ms')
+    while not results.empty():
+        _, cam, inserts, worst = results.get()
+        print('Writer '+str(cam)+': '+str(inserts)+' inserts, worst commit '+str(round(worst * 1000, 1))+' ms')
+    pass
+
+def _fill_legacy(dbfile, count):
+    """ build a legacy (schema version 1) database with 'count' clips """
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / count
+    with sqlite3.connect(dbfile) as con:
+        con.execute("""
+            CREATE TABLE clips (
+                filename PRIMARY KEY, idx INTEGER NOT NULL, ymdhms TEXT NOT NULL, infos TEXT NOT NULL)""")
+        rows = []
+        for n in range(count):
+            fname, cam, ts, infos = _make_clip(n % 4, start + n * step)
+            ymdhms = datetime.fromtimestamp(ts).strftime('%Y%m%d%H%M%S')
+            legacy = {"qa": str(infos["qa"]), "frms": infos["frms"]}
+            rows.append((fname, cam, ymdhms, str(legacy)))
+        con.executemany("INSERT OR IGNORE INTO clips VALUES (?,?,?,?)", rows)
+    pass
+
+def _fill_current(db, count):
+    """ insert 'count' clips into the current schema in one transaction """
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / count
+    with db.transaction() as cur:
+        tzoff = int(datetime.now().astimezone().utcoffset().total_seconds())
+        rows = []
+        for n in range(count):
+            fname, cam, ts, infos = _make_clip(n % 4, start + n * step)
+            rows.append((fname, cam, int(ts), tzoff, json.dumps(infos)))
+        cur.executemany(database.SQL_SET_CLIP, rows)
+    pass
+
+def _time_query(func, args, repeat):
+    """ average latency of 'func(*args)' in msecs """
+    t0 = time.perf_counter()
+    for n in range(repeat):
+        func(*args)
+    return (time.perf_counter() - t0) / repeat * 1000
+
+def run_schema(args):
+    """ measure the latency of each UI query on a large database """
+    dbfile = os.path.join(tempfile.mkdtemp(), 'netcam-bench.db')
+    if args.legacy:
+        print('Building legacy database with '+str(args.clips)+' clips ...')
+        _fill_legacy(dbfile, args.clips)
+        t0 = time.perf_counter()
+        db = database.Database(dbfile) # migrates to the latest schema
+        print('Migration: '+str(round(time.perf_counter() - t0, 2))+' s')
+    else:
+        db = database.Database(dbfile)
+        print('Building database with '+str(args.clips)+' clips ...')
+        _fill_current(db, args.clips)
+    days = db.get_clips_per_day()
+    day = days[len(days) // 2]['day']
+    rows = db.get_clips_for_day(day)
+    key = rows[len(rows) // 2]['id']
+    print('Clips: '+str(args.clips)+', days: '+str(len(days))+', clips on day '+str(day)+': '+str(len(rows)))
+    queries = [
+        ('get_clips_per_day', db.get_clips_per_day, (), database.SQL_CLIPS_PER_DAY),
+        ('get_clips_for_day', db.get_clips_for_day, (day, ), database.SQL_CLIPS_FOR_DAY),
+        ('get_clip', db.get_clip, (key, ), database.SQL_GET_CLIP),
+        ('get_previous_clip_index', db.get_previous_clip_index, (key, ), database.SQL_PREVIOUS_CLIP),
+        ('get_next_clip_index', db.get_next_clip_index, (key, ), database.SQL_NEXT_CLIP),
+        ('get_clips_by_motion', db.get_clips_by_motion, (10, ), database.SQL_CLIPS_BY_MOTION),
+    ]
+    con = sqlite3.connect(dbfile)
+    for name, func, params, sql in queries:
+        msecs = _time_query(func, params, args.repeat)
+        plans = con.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        print(name.ljust(24)+str(round(msecs, 3)).rjust(10)+' ms | '+'; '.join(plan[-1] for plan in plans))
+    con.close()
+    pass
+
+def run_rebuild(args):
+    """ rebuild the summary table of an existing database """
+    t0 = time.perf_counter()
+    db = database.Database(args.dbfile) # migrates to the latest schema
+    db.rebuild_summary()
+    print('Rebuilt summary of '+args.dbfile+' in '+str(round(time.perf_counter() - t0, 2))+' s, '
+          +str(len(db.get_clips_per_day()))+' days.')
+    pass
+
+def run_prune(args):
+    """ delete the clips older than args.days, rows and video files """
+    t0 = time.perf_counter()
+    db = database.Database(args.dbfile) # migrates to the latest schema
+    files = db.delete_clips_before((datetime.now() - timedelta(days=args.days)).timestamp())
+    secs = time.perf_counter() - t0
+    removed = 0
+    if not args.keep_files:
+        for fname in files:
+            try:
+                os.remove(fname)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    print('Deleted '+str(len(files))+' clips older than '+str(args.days)+' days from '+args.dbfile+' in '
+          +str(round(secs, 2))+' s, removed '+str(removed)+' video files.')
+    pass
+
+def parse_cli():
+    """ parse the commandline: python3 netcam-tool-db.py <command> [options] """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the netcam database.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    qps = commands.add_parser('qps', help='UI queries per second with concurrent writers.')
+    qps.add_argument('--writers', type=int, default=4, help='Recorder processes inserting clips.')
+    qps.add_argument('--readers', type=int, default=4, help='Flask threads running UI queries.')
+    qps.add_argument('--seconds', type=int, default=10, help='Duration of the measurement.')
+    qps.add_argument('--interval', type=float, default=0.01, help='Seconds between inserts per writer.')
+    qps.add_argument('--preload', type=int, default=PRELOAD, help='Clips in the database before measuring.')
+    qps.set_defaults(func=run_qps)
+    schema = commands.add_parser('schema', help='UI query latency on a large database.')
+    schema.add_argument('--clips', type=int, default=1000000, help='Clips in the database.')
+    schema.add_argument('--repeat', type=int, default=20, help='Repetitions per query.')
+    schema.add_argument('--legacy', action='store_true', help='Start from a legacy database, measure the migration.')
+    schema.set_defaults(func=run_schema)
+    rebuild = commands.add_parser('rebuild', help='Rebuild the summary table of a database.')
+    rebuild.add_argument('--dbfile', default=database.Database.DBFILE, help='Database file.')
+    rebuild.set_defaults(func=run_rebuild)
+    prune = commands.add_parser('prune', help='Delete the clips older than the given days (retention).')
+    prune.add_argument('--days', type=int, required=True, help='Keep the clips of the last days.')
+    prune.add_argument('--dbfile', default=database.Database.DBFILE, help='Database file.')
+    prune.add_argument('--keep-files', action='store_true', help='Delete the database rows only.')
+    prune.set_defaults(func=run_prune)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """ initialize the tool application """
+    cli = parse_cli()
+    cli.func(cli)
+    exit(0)
@@ -0,0 +1,507 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# Tool for load testing the complete stack (netcam-app.py with its supervised netcam-recorder.py processes)
+# with simulated cameras and web viewers, e.g. before adding a camera or after an upgrade.
+#
+# Call this tool with: python3 netcam-tool-load.py [--cameras 2] [--viewers 4] [--clip-viewers 1] [--seconds 60]
+#                      [--fps 10] [--size 640x480] [--loop 20] [--motion 5-10] [--video file.avi] [--report report.json]
+# - cameras: recorders, each plays the same looping local video file (key 'src' in FLASK_CAMn) as its camera
+# - viewers: concurrent /video_feed streams (round robin over the cameras), clip-viewers: concurrent /clip_feed
+#            streams, each plays the recorded clips one after the other
+# - fps, size, loop, motion: the generated video file, a static scene with a moving box (scripted motion)
+#   in the given seconds of each loop, e.g. --motion 2-6,12-15; --video: use this file instead
+# - seconds: measurement, after the recorders have their first frame and the warmup (background model)
+# - the app runs in a new working directory (FLASK_PATH, database, logs, videos) with its own --ipc-port,
+#   without the .env file (FLASK_DOTENV=0, checked in a child process before the start), its ports
+#   5000 (Flask) and 9020 (logging) are fixed: do not run next to a running netcam-app.py
+# - report (json): per camera sustained fps, skipped frames, clips with QA (VideoClip._check_quality),
+#   per viewer type fps, latency (capture to arrival) and errors, per process cpu and rss, startup times
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+import psutil
+from multiprocessing import AuthenticationError
+from cameras import status
+
+APP_PORT = 5000 # port of netcam-app.py (Flask, app.run)
+FOLDER = os.path.dirname(os.path.abspath(__file__)) # of netcam-app.py and netcam-recorder.py
+IPC_SECRET = 'netcam-tool-load' # [default] authkey of the test instance
+SEED = 2022 # [default] generated video, same file for every run (reproducible)
+BOX = 120 # [default] pixels, size of the moving box
+STARTUP_TIMEOUT = 60.0 # [default] seconds, app and first frames of all recorders
+STOP_TIMEOUT = 10.0 # [default] seconds, before a process is killed
+SAMPLE_INTERVAL = 1.0 # [default] seconds, recorder telemetry, cpu and rss
+
+
+def parse_motion(script):
+    """ parse the motion script, e.g. '2-6,12-15': list of (start, stop) seconds """
+    return [tuple([float(secs) for secs in part.split('-')]) for part in script.split(',') if part]
+
+
+def make_video(path, seconds, fps, width, height, motion):
+    """ write the looping video file: static scene, a box crosses the scene during the motion intervals """
+    rng = np.random.default_rng(SEED)
+    scene = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 6)
+    vout = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    for n in range(int(seconds * fps)):
+        frm = scene.copy()
+        secs = n / fps
+        for start, stop in motion:
+            if start <= secs < stop:
+                x = int((secs - start) / (stop - start) * (width - BOX))
+                y = (height - BOX) // 2
+                cv2.rectangle(frm, (x, y), (x + BOX, y + BOX), (0, 0, 255), -1)
+        vout.write(frm)
+    vout.release()
+    return path
+
+
+def get_percentile(values, pct):
+    """ get the percentile 'pct' of the values, None if there are none """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+class RecorderLink:
+    """ persistent ipc connection to one recorder """
+
+    def __init__(self, port):
+        """ initialize the link to the recorder on 'port' """
+        self.port = port
+        self.conn = None
+
+    def ask(self, msg):
+        """ send one command, None if the recorder does not answer """
+        try:
+            if self.conn is None:
+                self.conn = status.connect(('localhost', self.port), IPC_SECRET.encode('ascii'), SAMPLE_INTERVAL)
+            self.conn.send(msg)
+            if self.conn.poll(SAMPLE_INTERVAL):
+                return self.conn.recv()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+        self.close()
+        return None
+
+    def close(self):
+        """ close the connection """
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+        pass
+
+
+class Monitor(threading.Thread):
+    """ sample the recorder telemetry, cpu and rss of all processes once per interval """
+
+    def __init__(self, app, links):
+        """ initialize the monitor of process 'app' (psutil) and its recorders (links) """
+        threading.Thread.__init__(self)
+        self.name = 'Monitor'
+        self.daemon = True
+        self.app = app
+        self.links = links
+        self.samples = [] # (time, telemetry per recorder, {label: (cpu, rss)}, system cpu)
+        self._procs = {} # pid: psutil.Process, keeps the cpu counters between samples
+        self.keep_running = True
+
+    def _get_process(self, pid):
+        """ get the (cached) process 'pid', None if it has gone """
+        if pid not in self._procs:
+            try:
+                self._procs[pid] = psutil.Process(pid)
+                self._procs[pid].cpu_percent(None) # first call: no value
+            except psutil.NoSuchProcess:
+                return None
+        return self._procs[pid]
+
+    def run(self):
+        """ take one sample per interval until terminated """
+        psutil.cpu_percent(None)
+        due = time.time()
+        while self.keep_running:
+            due += SAMPLE_INTERVAL
+            time.sleep(max(due - time.time(), 0.0))
+            infos = [link.ask('telemetry?') for link in self.links]
+            usage = {}
+            for label, pid in [('app', self.app.pid)] + [('rec' + str(idx), info.get('pid'))
+                                                         for idx, info in enumerate(infos) if info and info.get('pid')]:
+                proc = self._get_process(pid)
+                try:
+                    usage[label] = (proc.cpu_percent(None), proc.memory_info().rss)
+                except (psutil.NoSuchProcess, AttributeError):
+                    pass
+            self.samples.append((time.time(), infos, usage, psutil.cpu_percent(None)))
+        pass
+
+    def terminate_thread(self):
+        """ stop running this thread """
+        self.keep_running = False
+        pass
+
+
+class Viewer(threading.Thread):
+    """ one simulated web viewer of a multipart stream (/video_feed or /clip_feed) """
+
+    def __init__(self, port, get_path):
+        """ initialize the viewer, get_path: function returning the path of the next stream, None: wait """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.port = port
+        self.get_path = get_path
+        self.frames = 0
+        self.bytes = 0
+        self.streams = 0 # streams played (clips)
+        self.errors = 0
+        self.latencies = [] # secs, capture (X-Timestamp) to arrival
+        self.first_frames = [] # secs, request to first frame of a stream
+        self.keep_running = True
+
+    def _read_part(self, rsp):
+        """ read one part of the multipart stream, returns its capture time, None at the end of the stream """
+        headers = {}
+        while True:
+            line = rsp.readline()
+            if line == b'':
+                return None # end of the stream (clip)
+            if line == b'\r\n' and len(headers) > 0:
+                break
+            if b':' in line:
+                key, val = line.split(b':', 1)
+                headers[key.strip().lower()] = val.strip()
+        jpeg = rsp.read(int(headers[b'content-length']))
+        rsp.readline() # \r\n after the picture
+        self.frames += 1
+        self.bytes += len(jpeg)
+        return float(headers.get(b'x-timestamp', 0.0))
+
+    def run(self):
+        """ play streams until terminated, reconnect after an error """
+        while self.keep_running:
+            path = self.get_path()
+            if path is None:
+                time.sleep(1.0) # e.g. no clips yet
+                continue
+            conn = http.client.HTTPConnection('localhost', self.port, timeout=10)
+            try:
+                t0 = time.time()
+                conn.request('GET', path)
+                rsp = conn.getresponse()
+                if rsp.status != 200:
+                    raise OSError('http status '+str(rsp.status))
+                first = True
+                while self.keep_running:
+                    timestamp = self._read_part(rsp)
+                    if timestamp is None:
+                        break
+                    now = time.time()
+                    if first:
+                        self.first_frames.append(now - t0)
+                        first = False
+                    self.latencies.append(now - timestamp)
+                self.streams += 1
+            except (OSError, http.client.HTTPException, ValueError, KeyError):
+                if self.keep_running:
+                    self.errors += 1
+                    time.sleep(1.0)
+            finally:
+                conn.close()
+        pass
+
+    def terminate_thread(self):
+        """ stop running this thread (after the current frame) """
+        self.keep_running = False
+        pass
+
+
+class ClipList:
+    """ the recorded clips of the test instance, played round robin by the clip viewers """
+
+    def __init__(self, dbfile):
+        """ initialize the list for database 'dbfile' """
+        self.dbfile = dbfile
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def get_ids(self):
+        """ get the ids of the recorded clips """
+        try:
+            con = sqlite3.connect('file:' + self.dbfile + '?mode=ro', uri=True, timeout=5)
+            try:
+                return [row[0] for row in con.execute('SELECT id FROM clips ORDER BY id')]
+            finally:
+                con.close()
+        except sqlite3.Error:
+            return [] # e.g. no database yet
+
+    def get_path(self):
+        """ get the path of the next clip stream, None if there are no clips """
+        ids = self.get_ids()
+        if len(ids) == 0:
+            return None
+        with self._lock:
+            key = ids[self._next % len(ids)]
+            self._next += 1
+        return '/clip_feed/' + str(key)
+
+
+def is_port_open(port):
+    """ check whether a server listens on 'port' (localhost) """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1.0)
+        return sock.connect_ex(('localhost', port)) == 0
+
+
+def wait_for(check, timeout):
+    """ wait until check() returns a value, returns the value and the seconds waited (None on timeout) """
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        value = check()
+        if value:
+            return value, round(time.time() - t0, 2)
+        time.sleep(0.2)
+    return None, None
+
+
+def get_environment(cli, workdir, video):
+    """ get the environment of the test instance: .env values of the cameras, ports and folders (no .env file) """
+    env = dict(os.environ)
+    env['FLASK_DOTENV'] = '0' # the .env of the developer would add its cameras and ports
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(FOLDER)] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['FLASK_SECRET'] = IPC_SECRET
+    env['FLASK_IPC_SECRET'] = IPC_SECRET
+    env['FLASK_IPC_PORT'] = str(cli.ipc_port)
+    env['FLASK_IPC_CAMS'] = str(cli.ipc_port + 1)
+    env['FLASK_PATH'] = workdir
+    env.pop('FLASK_STREAM_PORT', None)
+    if cli.stream_port:
+        env['FLASK_STREAM_PORT'] = str(cli.stream_port)
+    width, height = [int(value) for value in cli.size.split('x')]
+    for idx in range(10):
+        env.pop('FLASK_CAM' + str(idx), None)
+    for idx in range(cli.cameras):
+        env['FLASK_CAM' + str(idx)] = json.dumps({
+            "ttl": 'load ' + str(idx), "usr": '', "pw": '', "ip": '127.0.0.1', "fps": cli.fps,
+            "roi": str((0, 0, width, height)), "src": video})
+    return env
+
+
+def check_environment(cli, env):
+    """ check the configuration seen by the test instance: cameras and stream port, None if ok """
+    probe = 'from cameras import config; c = config.Config(); print(c.get_max_camera_index(), c.get_stream_port())'
+    done = subprocess.run([sys.executable, '-c', probe], cwd=FOLDER, env=env, capture_output=True, text=True)
+    if done.returncode != 0:
+        return done.stderr.strip()
+    max_idx, stream_port = done.stdout.split()
+    if int(max_idx) != cli.cameras - 1:
+        return 'max camera index is '+max_idx+', expected '+str(cli.cameras - 1)
+    if stream_port != str(cli.stream_port or None):
+        return 'stream port is '+stream_port+', expected '+str(cli.stream_port or None)
+    return None
+
+
+def stop_processes(app, links, pids):
+    """ stop the app first (its supervisor would restart the recorders), then the recorders """
+    app.send_signal(signal.SIGINT) # like ^C
+    try:
+        app.wait(STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        app.kill()
+        app.wait()
+    for link in links:
+        link.ask('terminate!')
+        link.close()
+    procs = []
+    for pid in pids:
+        try:
+            procs.append(psutil.Process(pid))
+        except psutil.NoSuchProcess:
+            pass
+    gone, alive = psutil.wait_procs(procs, timeout=STOP_TIMEOUT)
+    for proc in alive:
+        proc.kill()
+    pass
+
+
+def get_camera_report(monitor, links, dbfile, nominal):
+    """ get the report of each camera: sustained fps, skipped frames, clips and their quality """
+    cameras = []
+    try:
+        con = sqlite3.connect('file:' + dbfile + '?mode=ro', uri=True, timeout=5)
+        clips = {row[0]: row[1:] for row in con.execute(
+            'SELECT cam, COUNT(*), AVG(qa), MIN(qa), AVG(json_extract(infos, \'$.dur\')) FROM clips GROUP BY cam')}
+        con.close()
+    except sqlite3.Error:
+        clips = {}
+    for idx in range(len(links)):
+        counts = [(t, infos[idx]['frm_cnt']) for t, infos, usage, cpu in monitor.samples if infos[idx]]
+        rates = [(c1 - c0) / (t1 - t0) for (t0, c0), (t1, c1) in zip(counts, counts[1:]) if t1 > t0 and c1 >= c0]
+        skipped = [infos[idx]['frm_skp'] for t, infos, usage, cpu in monitor.samples if infos[idx]]
+        count, qa_avg, qa_min, dur = clips.get(idx, (0, None, None, None))
+        cameras.append({"idx": idx,
+                        "nominal_fps": nominal,
+                        "fps": round((counts[-1][1] - counts[0][1]) / (counts[-1][0] - counts[0][0]), 2)
+                               if len(counts) > 1 else None,
+                        "fps_min": round(min(rates), 2) if rates else None,
+                        "skipped_max": max(skipped) if skipped else None,
+                        "clips": count,
+                        "clip_secs_avg": round(dur, 1) if dur is not None else None,
+                        "qa_avg": round(qa_avg, 1) if qa_avg is not None else None,
+                        "qa_min": qa_min})
+    return cameras
+
+
+def get_viewer_report(viewers, seconds):
+    """ get the report of one type of viewers: fps, latency, first frame, errors """
+    latencies = [secs for viewer in viewers for secs in viewer.latencies]
+    first_frames = [secs for viewer in viewers for secs in viewer.first_frames]
+    rates = [viewer.frames / seconds for viewer in viewers]
+    def ms(secs):
+        return round(secs * 1000, 1) if secs is not None else None
+    return {"count": len(viewers),
+            "fps_avg": round(sum(rates) / len(rates), 2) if rates else None,
+            "fps_min": round(min(rates), 2) if rates else None,
+            "latency_ms_avg": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "latency_ms_p95": ms(get_percentile(latencies, 95)),
+            "latency_ms_max": ms(max(latencies)) if latencies else None,
+            "first_frame_ms_avg": ms(sum(first_frames) / len(first_frames)) if first_frames else None,
+            "streams": sum([viewer.streams for viewer in viewers]),
+            "kbytes_per_sec": round(sum([viewer.bytes for viewer in viewers]) / seconds / 1024, 1),
+            "errors": sum([viewer.errors for viewer in viewers])}
+
+
+def get_process_report(monitor):
+    """ get the cpu (percent of one core) and rss (MB) of each process """
+    processes = {}
+    for t, infos, usage, cpu in monitor.samples:
+        for label, (pct, rss) in usage.items():
+            processes.setdefault(label, []).append((pct, rss))
+    return {label: {"cpu_avg": round(sum([pct for pct, rss in values]) / len(values), 1),
+                    "cpu_max": round(max([pct for pct, rss in values]), 1),
+                    "rss_max_mb": round(max([rss for pct, rss in values]) / 1024**2, 1)}
+            for label, values in sorted(processes.items())}
+
+
+def get_commit():
+    """ get the git commit of the tested code, None outside of a git working copy """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=FOLDER, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_load_test(cli):
+    """ start the test instance, measure under load, stop it, return the report """
+    port = APP_PORT
+    if is_port_open(port):
+        raise SystemExit('Port '+str(port)+' is in use, stop the running netcam-app.py first.')
+    workdir = os.path.abspath(cli.workdir or tempfile.mkdtemp(prefix='netcam-load-'))
+    for folder in ('logs', 'videos', 'database'):
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+    width, height = [int(value) for value in cli.size.split('x')]
+    video = os.path.abspath(cli.video) if cli.video else make_video(
+        os.path.join(workdir, 'load.avi'), cli.loop, cli.fps, width, height, parse_motion(cli.motion))
+    env = get_environment(cli, workdir, video)
+    problem = check_environment(cli, env)
+    if problem is not None:
+        raise SystemExit('Test instance configuration: '+problem)
+    with open(os.path.join(workdir, 'logs', 'app.out'), 'a') as out:
+        app = subprocess.Popen([sys.executable, os.path.join(FOLDER, 'netcam-app.py')],
+                               cwd=workdir, env=env, stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT)
+    links = [RecorderLink(cli.ipc_port + 1 + idx) for idx in range(cli.cameras)]
+    pids = set()
+    try:
+        ready, app_secs = wait_for(lambda: is_port_open(port), STARTUP_TIMEOUT)
+        def first_frames():
+            infos = [link.ask('information?') for link in links]
+            pids.update([info['pid'] for info in infos if info])
+            return infos if all([info and info.get('ttff') is not None for info in infos]) else None
+        infos, recorder_secs = wait_for(first_frames, STARTUP_TIMEOUT) if ready else (None, None)
+        if infos is None:
+            raise SystemExit('Test instance did not start, see '+os.path.join(workdir, 'logs'))
+        time.sleep(cli.warmup) # background models, first clips
+        monitor = Monitor(psutil.Process(app.pid), links)
+        clips = ClipList(os.path.join(workdir, 'database', 'netcam.db'))
+        stream_port = cli.stream_port or port
+        viewers = [Viewer(stream_port, lambda idx=idx: '/video_feed/'+str(idx % cli.cameras)+'/1')
+                   for idx in range(cli.viewers)]
+        clip_viewers = [Viewer(stream_port, clips.get_path) for idx in range(cli.clip_viewers)]
+        monitor.start()
+        t0 = time.time()
+        for viewer in viewers + clip_viewers:
+            viewer.start()
+        time.sleep(cli.seconds)
+        for viewer in viewers + clip_viewers:
+            viewer.terminate_thread()
+        seconds = time.time() - t0
+        monitor.terminate_thread()
+        monitor.join()
+        for viewer in viewers + clip_viewers:
+            viewer.join(timeout=STOP_TIMEOUT)
+        pids.update([infos[idx]['pid'] for t, infos, usage, cpu in monitor.samples
+                     for idx in range(len(links)) if infos[idx]])
+    finally:
+        stop_processes(app, links, pids)
+    return {"settings": {"cameras": cli.cameras, "viewers": cli.viewers, "clip_viewers": cli.clip_viewers,
+                         "seconds": cli.seconds, "warmup": cli.warmup, "fps": cli.fps, "size": cli.size,
+                         "loop": cli.loop, "motion": cli.motion, "video": cli.video, "stream_port": cli.stream_port},
+            "environment": {"commit": get_commit(), "python": platform.python_version(), "opencv": cv2.__version__,
+                            "platform": platform.platform(), "cpus": psutil.cpu_count()},
+            "startup": {"app_secs": app_secs, "recorders_secs": recorder_secs,
+                        "first_frame_secs": [info['ttff'] for info in infos]},
+            "cameras": get_camera_report(monitor, links, os.path.join(workdir, 'database', 'netcam.db'), cli.fps),
+            "viewers": {"video": get_viewer_report(viewers, seconds),
+                        "clip": get_viewer_report(clip_viewers, seconds)},
+            "processes": get_process_report(monitor),
+            "system_cpu_avg": round(sum([cpu for t, i, u, cpu in monitor.samples]) / len(monitor.samples), 1)
+                              if monitor.samples else None,
+            "workdir": workdir}
+
+
+def parse_cli():
+    """ parse the commandline: python3 netcam-tool-load.py [options] """
+    parser = argparse.ArgumentParser(
+        description="Load test the Flask application and its recorders with simulated cameras and viewers.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--cameras", type=int, default=2, choices=range(1, 11), metavar='1..10',
+                        help="Simulated cameras (recorder processes).")
+    parser.add_argument("--viewers", type=int, default=4, help="Concurrent /video_feed viewers.")
+    parser.add_argument("--clip-viewers", type=int, default=1, help="Concurrent /clip_feed viewers.")
+    parser.add_argument("--seconds", type=float, default=60, help="Duration of the measurement.")
+    parser.add_argument("--warmup", type=float, default=15, help="Seconds after the first frames, before measuring.")
+    parser.add_argument("--fps", type=int, default=10, help="Frames per second of the simulated cameras.")
+    parser.add_argument("--size", default='640x480', help="Frame size of the generated video.")
+    parser.add_argument("--loop", type=float, default=20, help="Seconds of the generated video (one loop).")
+    parser.add_argument("--motion", default='5-10', help="Seconds with motion in each loop, e.g. 2-6,12-15.")
+    parser.add_argument("--video", default=None, help="Use this video file instead of the generated one.")
+    parser.add_argument("--stream-port", type=int, default=None, help="Serve the streams with the asyncio server.")
+    parser.add_argument("--ipc-port", type=int, default=19300, help="Telemetry port, recorders use the next ports.")
+    parser.add_argument("--workdir", default=None, help="Working directory of the test instance (default: new).")
+    parser.add_argument("--report", default=None, help="Also write the report (json) to this file.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """ initialize the tool application """
+    cli = parse_cli()
+    report = run_load_test(cli)
+    if cli.report:
+        with open(cli.report, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,154 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# Tool for measuring the throughput of the log receiver of netcam-app.py (logger/tcpserver.py).
+#
+# Call this tool with: python3 netcam-tool-logs.py [--recorders 10] [--records 20000] [--size 100] [--file netcam.log]
+#                      [--rate 0] [--queued] [--no-receiver]
+# - recorders: simulated netcam-recorder.py processes, each logs through its own socket handler
+# - records: log records per recorder, sent as fast as possible
+# - size: bytes of the message text per record
+# - rate: records per second and recorder (0: as fast as possible), like the sparse logging of a recorder
+# - file: also write the records to this log file (format of Config.set_logging), default: count only
+# - queued: the recorders log like netcam-recorder.py (queue and shipper thread, logger/shipper.py),
+#           default: a socket handler (send in the log call)
+# - no-receiver: no receiver is started (Flask application down), measures the log calls only
+# - the receiver runs in this process, its cpu time is reported per record,
+#   the time spent in the log calls is reported per recorder (average and maximum per call)
+
+import argparse
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import threading
+import time
+from logger import tcpserver
+from logger import shipper
+
+PORT = 19020 # [default] tcp port of the receiver, not the port of a running netcam-app.py
+LOGNAME = 'netcam-tool-logs' # receiver logger, no propagation to the root logger
+
+
+class CountingHandler(logging.Handler):
+    """ count the received records, signal when all are there """
+
+    def __init__(self, total):
+        """ initialize the handler for 'total' records """
+        logging.Handler.__init__(self)
+        self.total = total
+        self.count = 0
+        self.first = None # time of the first record
+        self.done = threading.Event()
+
+    def emit(self, record):
+        """ count one record """
+        if self.first is None:
+            self.first = time.time()
+        self.count += 1
+        if self.count >= self.total:
+            self.done.set()
+        pass
+
+
+def run_recorder(idx, port, records, size, rate, queued, results):
+    """ simulated recorder process: log 'records' records, measure the time spent in the log calls """
+    lggr = logging.getLogger('recorder.' + str(idx))
+    lggr.propagate = False
+    lggr.setLevel(logging.DEBUG)
+    if queued:
+        shppr = shipper.LogShipper('localhost', port)
+        shppr.start()
+        hndlr = shppr.get_handler()
+    else:
+        hndlr = logging.handlers.SocketHandler('localhost', port)
+    lggr.addHandler(hndlr)
+    text = 'x' * size
+    total = 0.0
+    slowest = 0.0
+    due = time.time()
+    for n in range(records):
+        if rate > 0:
+            due += 1.0 / rate
+            time.sleep(max(due - time.time(), 0.0))
+        t0 = time.perf_counter()
+        lggr.info('record %d of recorder %d: %s', n, idx, text)
+        call = time.perf_counter() - t0
+        total += call
+        slowest = max(slowest, call)
+    if queued:
+        shppr.terminate_thread()
+        shppr.join()
+        dropped = shppr.get_metrics()["log_drp"]
+    else:
+        hndlr.close()
+        dropped = None
+    results.put((total / records, slowest, dropped))
+    pass
+
+
+def run_benchmark(recorders, records, size, file, rate=0, queued=False, receiver=True):
+    """ start the receiver and the recorders, measure until all records are handled """
+    total = recorders * records
+    counter = CountingHandler(total)
+    lggr = logging.getLogger(LOGNAME)
+    lggr.propagate = False
+    lggr.setLevel(logging.DEBUG)
+    lggr.addHandler(counter)
+    if file is not None:
+        hndlr = logging.FileHandler(file, mode='w', encoding='utf-8')
+        hndlr.setFormatter(logging.Formatter('%(asctime)s | %(levelname)s | %(name)s | %(message)s'))
+        lggr.addHandler(hndlr)
+    server = tcpserver.Tcpserver(port=PORT, logname=LOGNAME) if receiver else None
+    if server is not None:
+        server.daemon = True
+        server.start()
+    results = multiprocessing.Queue()
+    cpu0 = time.process_time()
+    procs = [multiprocessing.Process(target=run_recorder, args=(idx, PORT, records, size, rate, queued, results))
+             for idx in range(recorders)]
+    t0 = time.time()
+    for proc in procs:
+        proc.start()
+    calls = [results.get() for proc in procs]
+    complete = counter.done.wait(timeout=max(60.0, total / 1000) if receiver else 0)
+    t1 = time.time()
+    cpu = time.process_time() - cpu0
+    for proc in procs:
+        proc.join()
+    stats = server.get_stats() if server is not None else {"records": 0, "batches": 0, "errors": 0}
+    if server is not None:
+        server.terminate_thread()
+        server.join()
+    seconds = t1 - (counter.first or t0)
+    return {"recorders": recorders,
+            "records": counter.count,
+            "complete": complete,
+            "seconds": round(seconds, 3),
+            "records_per_sec": round(counter.count / seconds) if seconds > 0 else None,
+            "records_per_batch": round(stats["records"] / stats["batches"], 1) if stats["batches"] else None,
+            "cpu_us_per_record": round(cpu / max(counter.count, 1) * 1000000, 1),
+            "errors": stats["errors"],
+            "call_us_avg": round(sum([call[0] for call in calls]) / len(calls) * 1000000, 1),
+            "call_us_max": round(max([call[1] for call in calls]) * 1000000, 1),
+            "dropped": sum([call[2] for call in calls]) if queued else None}
+
+
+def parse_cli():
+    """ parse the commandline: python3 netcam-tool-logs.py [options] """
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of the log receiver.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--recorders", type=int, default=10, help="Simulated recorder processes.")
+    parser.add_argument("--records", type=int, default=20000, help="Log records per recorder.")
+    parser.add_argument("--size", type=int, default=100, help="Bytes of message text per record.")
+    parser.add_argument("--file", default=None, help="Also write the records to this log file.")
+    parser.add_argument("--rate", type=float, default=0, help="Records per second and recorder (0: unpaced).")
+    parser.add_argument("--queued", action="store_true", help="Log through a queue and shipper thread.")
+    parser.add_argument("--no-receiver", dest="receiver", action="store_false", help="Do not start the receiver.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """ initialize the tool application """
+    cli = parse_cli()
+    print(json.dumps(run_benchmark(cli.recorders, cli.records, cli.size, cli.file, cli.rate, cli.queued, cli.receiver), indent=2))
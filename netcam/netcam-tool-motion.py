@@ -0,0 +1,183 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# Tool for checking the live reconfiguration of the motion detection (cameras/motion.py): the motion
+# settings are changed while frames are parsed at the camera frame rate, like a running recorder.
+#
+# Call this tool with: python3 netcam-tool-motion.py [--seconds 20] [--fps 25] [--interval 2.0] [--video file.avi]
+# - frames: a generated scene with a moving box (640x480), or the frames of a video file (looped, at least
+#           640x480 for the roi changes of SWAPS)
+# - swaps: every 'interval' seconds the next change of SWAPS (sensitivity, threshold, history, methode, roi),
+#          applied with Motion.set_settings() from a second thread, like the recorder ipc thread
+# - checked: no frame is lost or parsed twice (frame counter of Motion equals the frames fed), every swap
+#            is done at the next frame boundary, a roi outside of the frame is rejected and the current
+#            settings stay; the background model is only reset for a new methode or roi
+# - report (json, stdout): frames, swaps with first frame, reset and round trip (ms), failures; exit code 1
+#            when a check failed
+
+import argparse
+import json
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+from cameras import motion
+
+WIDTH, HEIGHT = 640, 480 # generated frames
+SEED = 2022 # [default] generated scene
+BOX = 80 # [default] pixels, size of the moving box
+SWAP_TIMEOUT = 2.0 # [default] seconds, like the recorder ('configure!')
+SWAPS = [ # [default] changes, applied one after the other (cyclic)
+    {"fg_min_area": 800},
+    {"threshold": 250.0},
+    {"history": 200},
+    {"bg_sub_methode": 'KNN'},
+    {"roi": (40, 40, 560, 400)},
+    {"roi": (5000, 5000, 100, 100)}, # outside of the frame: rejected
+    {"bg_sub_methode": 'MOG2', "roi": (0, 0, WIDTH, HEIGHT), "fg_min_area": 500},
+]
+
+
+class FrameSource:
+    """ frames of a video file (looped) or of a generated scene with a moving box """
+
+    def __init__(self, video):
+        """ initialize the source, video: path of a video file or None """
+        self.vcap = cv2.VideoCapture(video) if video is not None else None
+        rng = np.random.default_rng(SEED)
+        self.scene = cv2.GaussianBlur(rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8), (0, 0), 6)
+        self.count = 0
+
+    def get_size(self):
+        """ get the frame size (width, height) """
+        if self.vcap is not None and self.vcap.isOpened():
+            return int(self.vcap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.vcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        return WIDTH, HEIGHT
+
+    def read(self):
+        """ get the next frame """
+        self.count += 1
+        if self.vcap is not None:
+            success, frame = self.vcap.read()
+            if not success:
+                self.vcap.set(cv2.CAP_PROP_POS_FRAMES, 0) # end of the video file, play it again
+                success, frame = self.vcap.read()
+            if success:
+                return frame
+        frame = self.scene.copy()
+        x = (self.count * 8) % (WIDTH - BOX)
+        cv2.rectangle(frame, (x, (HEIGHT - BOX) // 2), (x + BOX, (HEIGHT + BOX) // 2), (0, 0, 255), -1)
+        return frame
+
+
+class Parser(threading.Thread):
+    """ parse the frames at the frame rate (videoclip thread of the recorder) """
+
+    def __init__(self, mtn, source, fps):
+        """ initialize the parser of 'source' with the motion detection 'mtn' """
+        threading.Thread.__init__(self)
+        self.name = 'Parser'
+        self.daemon = True
+        self.mtn = mtn
+        self.source = source
+        self.fps = fps
+        self.fed = 0 # frames given to parse_frame
+        self.lost = [] # frames with an unexpected frame counter of Motion (lost or parsed twice)
+        self.errors = [] # exceptions of parse_frame
+        self.keep_running = True
+
+    def run(self):
+        """ parse one frame per 1/fps seconds until terminated """
+        due = time.time()
+        while self.keep_running:
+            frame = self.source.read()
+            self.fed += 1
+            try:
+                self.mtn.parse_frame(frame)
+            except Exception as err:
+                self.errors.append(str(err))
+            if self.mtn._frames != self.fed:
+                self.lost.append(self.fed)
+            due += 1.0 / self.fps
+            time.sleep(max(due - time.time(), 0.0))
+        pass
+
+    def terminate_thread(self):
+        """ stop running this thread """
+        self.keep_running = False
+        pass
+
+
+def check_swap(change, before, answer, size):
+    """ check one swap of frames with 'size' (width, height): None if ok, otherwise the reason """
+    if answer is None:
+        return 'no swap within '+str(SWAP_TIMEOUT)+' secs'
+    rejected = "rejected" in answer
+    expected_reject = 'roi' in change and (change['roi'][0] + change['roi'][2] > size[0] or
+                                           change['roi'][1] + change['roi'][3] > size[1])
+    if rejected != expected_reject:
+        return 'rejected' if rejected else 'not rejected'
+    if rejected:
+        return None if answer["settings"] == before else 'settings changed by a rejected swap'
+    for key, value in change.items():
+        if answer["settings"][key] != (tuple(value) if key == 'roi' else value):
+            return 'setting '+key+' not swapped in'
+    reset = answer["settings"]["bg_sub_methode"] != before["bg_sub_methode"] or answer["settings"]["roi"] != before["roi"]
+    return None if answer["reset"] == reset else 'unexpected background model reset: '+str(answer["reset"])
+
+
+def run(args):
+    """ parse frames, change the settings every interval, report the checks """
+    source = FrameSource(args.video)
+    size = source.get_size()
+    mtn = motion.Motion((0, 0) + size)
+    parser = Parser(mtn, source, args.fps)
+    parser.start()
+    swaps = []
+    failures = []
+    stop = time.time() + args.seconds
+    n = 0
+    while time.time() + args.interval < stop:
+        time.sleep(args.interval)
+        change = SWAPS[n % len(SWAPS)]
+        n += 1
+        before = mtn.get_settings()
+        t0 = time.perf_counter()
+        swapped = mtn.set_settings(change)
+        answer = dict(mtn.last_swap) if swapped.wait(SWAP_TIMEOUT) else None
+        msecs = round((time.perf_counter() - t0) * 1000, 1)
+        reason = check_swap(change, before, answer, size)
+        swaps.append({"change": change, "frame": answer and answer["frame"], "reset": answer and answer["reset"],
+                      "rejected": answer and answer.get("rejected"), "ms": msecs, "ok": reason is None})
+        if reason is not None:
+            failures.append(str(change)+': '+reason)
+    parser.terminate_thread()
+    parser.join()
+    if parser.lost:
+        failures.append('frames lost or parsed twice: '+str(parser.lost[:10]))
+    failures.extend(['parse_frame: '+err for err in parser.errors[:10]])
+    return {"frames": parser.fed,
+            "parsed": mtn._frames,
+            "fps": args.fps,
+            "swaps": swaps,
+            "failures": failures}
+
+
+def parse_cli():
+    """ parse the commandline: python3 netcam-tool-motion.py [options] """
+    parser = argparse.ArgumentParser(
+        description="Check the live reconfiguration of the motion detection.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=20.0, help="Duration of the check.")
+    parser.add_argument("--fps", type=int, default=25, help="Frames parsed per second.")
+    parser.add_argument("--interval", type=float, default=2.0, help="Seconds between two swaps.")
+    parser.add_argument("--video", default=None, help="Video file instead of the generated frames.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """ initialize the tool application """
+    cli = parse_cli()
+    report = run(cli)
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report["failures"] else 0)
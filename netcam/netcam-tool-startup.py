@@ -0,0 +1,128 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# Tool for measuring the startup time of netcam-recorder.py and netcam-app.py (import and initialization time).
+#
+# Call this tool with: python3 netcam-tool-startup.py [--entry all] [--source rtsp://... | video.avi | 0] [--top 15]
+# - entry: recorder, app or all; each entry point is started in a new interpreter (cold start, like a restart),
+#          its module level code is run without its main part (no threads, no processes, no Flask server)
+# - source: recorder only, open this video source (rtsp url, video file or webcam index) and read the first frame
+# - top: modules and packages with the largest import time (own time, without the modules they import)
+# - reported per entry point: interpreter start, imports (total and per module), Config() (first and
+#   cached second instance), mount point (external disk), first frame, total time to first frame
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ENTRIES = {"recorder": 'netcam-recorder.py', "app": 'netcam-app.py'} # [default] in the folder of this tool
+RUN_NAME = 'netcam-tool-startup' # module name of the entry point, not '__main__'
+MARKER = '--- netcam-tool-startup: ' # stderr, between the import times of the tool and of the entry point
+
+
+def get_import_times(lines):
+    """
+    parse the output of 'python -X importtime' between the markers: own and cumulative time (ms) per module,
+    modules which were already imported by the tool (e.g. json) are not counted
+    """
+    modules = {}
+    lines = lines[lines.index(MARKER + 'imports') + 1:lines.index(MARKER + 'imported')]
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        name = fields[2].strip()
+        modules[name] = {"self_ms": int(fields[0]) / 1000, "cumulative_ms": int(fields[1]) / 1000,
+                         "toplevel": not fields[2][1:].startswith(' ')} # imported by the entry point itself
+    return modules
+
+
+def get_package_times(modules, top):
+    """ sum the own import times per package (first part of the module name), the 'top' largest sums """
+    packages = {}
+    for name, times in modules.items():
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0.0) + times["self_ms"]
+    return {package: round(ms, 1) for package, ms in sorted(packages.items(), key=lambda item: -item[1])[:top]}
+
+
+def run_child(entry, source):
+    """ (new interpreter) import the entry point, initialize, read the first frame: phase times on stdout """
+    import runpy
+    import pkgutil # imported by runpy.run_path, not by the entry point
+    phases = {"started": time.time()}
+    print(MARKER + 'imports', file=sys.stderr, flush=True)
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), ENTRIES[entry]), run_name=RUN_NAME)
+    print(MARKER + 'imported', file=sys.stderr, flush=True)
+    phases["imported"] = time.time()
+    from cameras import config
+    cnfg = config.Config()
+    phases["configured"] = time.time()
+    config.Config() # second instance, e.g. a tool in the same process
+    phases["configured_again"] = time.time()
+    cnfg.get_mount_point() # lazy, with the first path (logs, videos)
+    phases["mounted"] = time.time()
+    if source is not None:
+        import cv2
+        stream = cv2.VideoCapture(int(source) if source.isdigit() else source)
+        success, frm = stream.read()
+        stream.release()
+        phases["first_frame"] = time.time() if success else None
+    print(json.dumps(phases))
+    pass
+
+
+def profile_entry(entry, source, top):
+    """ start one entry point in a new interpreter, measure its phases and import times """
+    args = [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', entry]
+    if source is not None:
+        args += ['--source', source]
+    t0 = time.time()
+    proc = subprocess.run(args, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = proc.stderr.splitlines()
+    if proc.returncode != 0:
+        return {"entry": entry, "error": [line for line in lines if not line.startswith(('import time:', MARKER))][-5:]}
+    phases = json.loads(proc.stdout.splitlines()[-1])
+    modules = get_import_times(lines)
+    slowest = sorted(modules.items(), key=lambda item: -item[1]["self_ms"])[:top]
+    def ms(start, stop):
+        return round((phases[stop] - phases[start]) * 1000, 1) if phases.get(stop) is not None else None
+    phases["spawned"] = t0
+    return {"entry": entry,
+            "interpreter_ms": ms("spawned", "started"),
+            "imports_ms": ms("started", "imported"),
+            "config_ms": ms("imported", "configured"),
+            "config_cached_ms": ms("configured", "configured_again"),
+            "mount_point_ms": ms("configured_again", "mounted"),
+            "first_frame_ms": ms("mounted", "first_frame") if source is not None else None,
+            "total_ms": ms("spawned", "first_frame" if source is not None else "mounted"),
+            "modules": len(modules),
+            "entry_imports_ms": {name: round(times["cumulative_ms"], 1)
+                                 for name, times in modules.items() if times["toplevel"]},
+            "packages_ms": get_package_times(modules, top),
+            "slowest_modules_ms": {name: round(times["self_ms"], 1) for name, times in slowest}}
+
+
+def parse_cli():
+    """ parse the commandline: python3 netcam-tool-startup.py [options] """
+    parser = argparse.ArgumentParser(
+        description="Measure the startup time of the recorder and the Flask application.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--entry", default='all', choices=['all'] + list(ENTRIES), help="Entry point(s).")
+    parser.add_argument("--source", default=None, help="Recorder: video source for the first frame.")
+    parser.add_argument("--top", type=int, default=15, help="Slowest modules reported.")
+    parser.add_argument("--child", default=None, choices=list(ENTRIES), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """ initialize the tool application """
+    cli = parse_cli()
+    if cli.child is not None:
+        run_child(cli.child, cli.source)
+    else:
+        entries = list(ENTRIES) if cli.entry == 'all' else [cli.entry]
+        print(json.dumps([profile_entry(entry, cli.source if entry == 'recorder' else None, cli.top)
+                          for entry in entries], indent=2))
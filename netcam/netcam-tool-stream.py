@@ -0,0 +1,213 @@
+# Copyright (c) 2022 Martin Jonasse, Zug, Switzerland
+
+# Tool for measuring the latency of the MJPEG streams of netcam-app.py on a throttled connection.
+#
+# Call this tool with: python3 netcam-tool-stream.py <url> [--rate 200000] [--seconds 20] [--viewers 1,10,50 --pid 1234]
+# e.g. python3 netcam-tool-stream.py "http://localhost:5000/video_feed/0/1?fps=10&quality=80" --rate 100000
+# - viewers: load test, concurrent viewers per step (all on the same url), one report per step
+# - pid: process id of the server (netcam-app.py), its cpu load and number of threads are reported
+# - rate: bytes per second read by the simulated viewer (0: unthrottled), the small receive
+#         buffer makes the server feel the back pressure like a slow mobile connection.
+# - latency: time between frame capture in the app (X-Timestamp) and arrival of the complete frame,
+#            app and tool must run on the same host (same clock).
+
+import argparse
+import json
+import psutil
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+RCVBUF = 16384 # [default] bytes, socket receive buffer of the simulated viewer
+CHUNK = 4096   # [default] bytes per read
+
+
+class Viewer:
+    """ one simulated MJPEG viewer with a throttled connection """
+
+    def __init__(self, url, rate):
+        """ initialize the viewer """
+        self.url = urlsplit(url)
+        self.rate = rate # bytes per second, 0: unthrottled
+        self.sock = None
+        self.raw = b'' # received bytes
+        self.buffer = b'' # body bytes (without transfer encoding)
+        self.chunked = False
+        self.remaining = 0 # bytes left in the current chunk
+        self.received = 0
+        self.started = 0.0
+        self.latencies = [] # secs
+        self.qualities = []
+        self.sizes = []
+
+    def connect(self):
+        """ open the connection, send the request and read the response headers """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        self.sock.connect((self.url.hostname, self.url.port or 80))
+        path = self.url.path + ('?' + self.url.query if self.url.query else '')
+        request = 'GET ' + path + ' HTTP/1.1\r\nHost: ' + self.url.netloc + '\r\nConnection: close\r\n\r\n'
+        self.sock.sendall(request.encode('ascii'))
+        self.started = time.time()
+        while b'\r\n\r\n' not in self.raw:
+            self._recv()
+        headers, self.raw = self.raw.split(b'\r\n\r\n', 1)
+        self.chunked = b'transfer-encoding: chunked' in headers.lower()
+        pass
+
+    def _recv(self):
+        """ read one chunk, throttled to 'rate' bytes per second """
+        data = self.sock.recv(CHUNK)
+        if len(data) == 0:
+            raise EOFError('stream closed by server')
+        self.received += len(data)
+        if self.rate > 0:
+            ahead = self.received / self.rate - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        self.raw += data
+        pass
+
+    def _fill(self):
+        """ read more of the body, remove the chunked transfer encoding if any """
+        self._recv()
+        if not self.chunked:
+            self.buffer += self.raw
+            self.raw = b''
+            return
+        while True:
+            if self.remaining == 0:
+                if b'\r\n' not in self.raw:
+                    return
+                line, self.raw = self.raw.split(b'\r\n', 1)
+                if line == b'':
+                    continue # end of the previous chunk
+                self.remaining = int(line.split(b';')[0], 16)
+                if self.remaining == 0:
+                    raise EOFError('last chunk')
+            data = self.raw[:self.remaining]
+            self.raw = self.raw[len(data):]
+            self.remaining -= len(data)
+            self.buffer += data
+            if self.remaining > 0:
+                return
+        pass
+
+    def _read_until(self, marker):
+        """ read until marker, return the data before it """
+        while marker not in self.buffer:
+            self._fill()
+        data, self.buffer = self.buffer.split(marker, 1)
+        return data
+
+    def _read_bytes(self, count):
+        """ read exactly count bytes """
+        while len(self.buffer) < count:
+            self._fill()
+        data, self.buffer = self.buffer[:count], self.buffer[count:]
+        return data
+
+    def read_frame(self):
+        """ read one part of the multipart stream, register its latency """
+        headers = {}
+        for line in self._read_until(b'\r\n\r\n').split(b'\r\n'):
+            if b':' in line:
+                key, val = line.split(b':', 1)
+                headers[key.strip().lower()] = val.strip()
+        jpeg = self._read_bytes(int(headers[b'content-length']))
+        now = time.time()
+        if b'x-timestamp' in headers:
+            self.latencies.append(now - float(headers[b'x-timestamp']))
+        if b'x-quality' in headers:
+            self.qualities.append(int(headers[b'x-quality']))
+        self.sizes.append(len(jpeg))
+        pass
+
+    def run(self, seconds):
+        """ read frames for a number of seconds """
+        self.connect()
+        stop = time.time() + seconds
+        try:
+            while time.time() < stop:
+                self.read_frame()
+        except (EOFError, OSError):
+            pass
+        self.sock.close()
+        pass
+
+    def get_report(self, seconds):
+        """ get the measurements (dictionary) """
+        lats = sorted(self.latencies)
+        def pct(p):
+            return round(lats[min(int(len(lats) * p), len(lats) - 1)] * 1000, 1) if lats else None
+        return {"frames": len(self.sizes),
+                "fps": round(len(self.sizes) / seconds, 1),
+                "kbytes_per_sec": round(sum(self.sizes) / seconds / 1000, 1),
+                "frame_kbytes": round(sum(self.sizes) / len(self.sizes) / 1000, 1) if self.sizes else None,
+                "latency_ms_p50": pct(0.5),
+                "latency_ms_p95": pct(0.95),
+                "latency_ms_max": pct(1.0),
+                "quality_first": self.qualities[0] if self.qualities else None,
+                "quality_last": self.qualities[-1] if self.qualities else None}
+
+def merge_reports(viewers, seconds):
+    """ get the measurements of concurrent viewers (dictionary) """
+    merged = Viewer('http://localhost/', 0)
+    for viewer in viewers:
+        merged.latencies += viewer.latencies
+        merged.qualities += viewer.qualities
+        merged.sizes += viewer.sizes
+    report = merged.get_report(seconds)
+    report["viewers"] = len(viewers)
+    report["fps"] = round(report["fps"] / max(len(viewers), 1), 1) # per viewer
+    report["starved"] = len([viewer for viewer in viewers if len(viewer.sizes) == 0])
+    return report
+
+def run_load_test(url, rate, seconds, steps, pid):
+    """ run one step per number of concurrent viewers, measure the server process """
+    proc = psutil.Process(pid) if pid else None
+    reports = []
+    for count in steps:
+        viewers = [Viewer(url, rate) for n in range(count)]
+        thrds = [threading.Thread(target=viewer.run, args=(seconds, ), daemon=True) for viewer in viewers]
+        if proc is not None:
+            proc.cpu_percent() # start of the measurement
+        for thrd in thrds:
+            thrd.start()
+        time.sleep(seconds / 2)
+        threads = proc.num_threads() if proc is not None else None # with all viewers connected
+        for thrd in thrds:
+            thrd.join(seconds * 2)
+        report = merge_reports(viewers, seconds)
+        if proc is not None:
+            report["server_cpu"] = proc.cpu_percent() # percent of one core, average of the step
+            report["server_threads"] = threads
+        reports.append(report)
+        print(json.dumps(report))
+        time.sleep(2) # viewers leave, broadcasters keep running
+    return reports
+
+def parse_cli():
+    """ parse the commandline: python3 netcam-tool-stream.py <url> [options] """
+    parser = argparse.ArgumentParser(
+        description="Measure MJPEG stream latency on a throttled connection.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("url", help="Stream url, e.g. http://localhost:5000/video_feed/0/1?fps=10")
+    parser.add_argument("--rate", type=int, default=0, help="Bytes per second read by the viewer (0: unthrottled).")
+    parser.add_argument("--seconds", type=int, default=20, help="Duration of the measurement (per step).")
+    parser.add_argument("--viewers", type=str, default=None, help="Load test: concurrent viewers per step, e.g. 1,10,50.")
+    parser.add_argument("--pid", type=int, default=None, help="Process id of the server, for cpu load and threads.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """ initialize the tool application """
+    cli = parse_cli()
+    if cli.viewers is not None:
+        run_load_test(cli.url, cli.rate, cli.seconds, [int(n) for n in cli.viewers.split(',')], cli.pid)
+    else:
+        viewer = Viewer(cli.url, cli.rate)
+        viewer.run(cli.seconds)
+        print(json.dumps(viewer.get_report(cli.seconds), indent=4))
+    exit(0)